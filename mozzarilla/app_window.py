@@ -47,6 +47,7 @@
 from mozzarilla import editor_constants as e_c
 from mozzarilla.widgets.field_widget_picker import def_halo_widget_picker
 from mozzarilla.widgets.directory_frame import DirectoryFrame
+from mozzarilla.tagset.tags_dir_index import find_tag_fullpath
 from mozzarilla.windows.tag_window import HaloTagWindow, HaloConfigWindow
 from mozzarilla.windows.tools import \
      SearchAndReplaceWindow, SauceRemovalWindow, \
@@ -903,7 +904,7 @@ def save_tag(self, tag=None):
 
         # change the tags filepath to be relative to the current tags directory
         if hasattr(tag, "rel_filepath"):
-            full_filepath = tagpath_to_fullpath(tag.tags_dir, tag.rel_filepath)
+            full_filepath = find_tag_fullpath(tag.tags_dir, tag.rel_filepath)
             if full_filepath:
                 tag.filepath = full_filepath
             else:
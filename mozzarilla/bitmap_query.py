@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Headless bitmap search. Finds the bitmap tags in a directory that contain
+bitmaps of the given types and formats, using the same catalogue of bitmap
+metadata as the Bitmap Converter, without opening any windows. Only the
+bitmaps that changed since they were last cataloged are read.
+Run with --help for usage.
+
+Exit codes:
+    0   the search was run.
+    2   the search could not be run(bad arguments, missing directories, etc).
+    130 the search was cancelled with Ctrl+C.
+'''
+
+import argparse
+import json
+import os
+import sys
+
+from contextlib import redirect_stdout
+from traceback import format_exc
+
+from supyr_struct.util import path_normalize
+
+EXIT_CLEAN = 0
+EXIT_FAILED = 2
+EXIT_CANCELLED = 130
+
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "kb": 1024, "kib": 1024,
+              "m": 1024**2, "mb": 1024**2, "mib": 1024**2,
+              "g": 1024**3, "gb": 1024**3, "gib": 1024**3}
+
+
+def parse_size(size_string):
+    '''
+    Returns the number of bytes in size_string(ex: "4MiB", "512k", "100").
+    Raises ValueError if it isn't a size.
+    '''
+    size_string = size_string.strip().lower()
+    number = size_string.rstrip("bgikm ")
+    units = size_string[len(number):].strip()
+    try:
+        return int(float(number) * SIZE_UNITS[units])
+    except (KeyError, ValueError):
+        raise ValueError("'%s' is not a size." % size_string)
+
+
+def split_names(names_string):
+    return [name.strip() for name in names_string.split(",") if name.strip()]
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m mozzarilla.bitmap_query",
+        description="Finds the bitmap tags in a directory that contain "
+        "bitmaps of the given types and formats, and whose pixel data is "
+        "within the given size.")
+    parser.add_argument(
+        "bitmaps_dir", help="The directory to search for bitmap tags in.")
+    parser.add_argument(
+        "--types", default="",
+        help="Comma separated list of the bitmap types to find(texture_2d, "
+        "texture_3d, cubemap, white). Defaults to any type.")
+    parser.add_argument(
+        "--formats", default="",
+        help="Comma separated list of the bitmap formats to find(ex: "
+        "dxt1,dxt5,a8r8g8b8). Defaults to any format.")
+    parser.add_argument(
+        "--min-size", default=None,
+        help="Smallest pixel data size of the tags to find(ex: 4MiB).")
+    parser.add_argument(
+        "--max-size", default=None,
+        help="Largest pixel data size of the tags to find(ex: 512KiB).")
+    parser.add_argument(
+        "--json", dest="json_path", default=None,
+        help="Filepath to write the tags found to as JSON, with the "
+        "metadata of each of their bitmaps. Use - for stdout.")
+    parser.add_argument(
+        "--no-refresh", action="store_true",
+        help="Search the catalogue as it is, without reading the "
+        "bitmaps that changed since they were last cataloged.")
+    parser.add_argument(
+        "--catalogue-path", default=None,
+        help="Filepath of the bitmap catalogue to use instead of the "
+        "default.")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="Don't print progress messages.")
+    return parser
+
+
+def get_tag_record(filepath, metadata):
+    from mozzarilla.tagset.bitmap_metadata import BITMAP_TYPE_NAMES,\
+         BITMAP_FORMAT_NAMES
+
+    return dict(
+        filepath=filepath,
+        pixel_data_size=metadata.pixel_data_size,
+        tiff_data_size=metadata.tiff_data_size,
+        xbox=metadata.is_xbox_bitmap,
+        bitmaps=[dict(type=BITMAP_TYPE_NAMES.get(bitmap.type, bitmap.type),
+                      format=BITMAP_FORMAT_NAMES.get(bitmap.format,
+                                                     bitmap.format),
+                      width=bitmap.width, height=bitmap.height,
+                      depth=bitmap.depth, mipmaps=bitmap.mipmaps,
+                      swizzled=bitmap.swizzled)
+                 for bitmap in metadata.bitmaps])
+
+
+def format_tag_record(record):
+    return "%12s  %s  %s" % (
+        record["pixel_data_size"], record["filepath"], ", ".join(
+            "%s %s %sx%sx%s" % (bitmap["type"], bitmap["format"],
+                                bitmap["width"], bitmap["height"],
+                                bitmap["depth"])
+            for bitmap in record["bitmaps"]))
+
+
+def run_query(args, stdout):
+    '''
+    Runs the search described by the parsed command line arguments and
+    returns the exit code. Results written to "-" go to stdout.
+    '''
+    from mozzarilla.tagset.bitmap_catalogue import BitmapCatalogue
+    from mozzarilla.tagset.tags_dir_index import abs_path_normalize
+
+    bitmaps_dir = abs_path_normalize(args.bitmaps_dir)
+    if not os.path.isdir(bitmaps_dir):
+        print("Directory '%s' does not exist." % bitmaps_dir)
+        return EXIT_FAILED
+
+    try:
+        min_size = max_size = None
+        if args.min_size is not None:
+            min_size = parse_size(args.min_size)
+        if args.max_size is not None:
+            max_size = parse_size(args.max_size)
+    except ValueError as e:
+        print(e)
+        return EXIT_FAILED
+
+    if args.catalogue_path:
+        catalogue = BitmapCatalogue(
+            bitmaps_dir, path_normalize(args.catalogue_path))
+    else:
+        catalogue = BitmapCatalogue(bitmaps_dir)
+
+    try:
+        if not args.no_refresh:
+            print("Cataloging bitmaps...")
+            try:
+                for filepath in catalogue.refresh():
+                    print("Could not read: %s" % filepath)
+            finally:
+                catalogue.save()
+
+        try:
+            results = catalogue.query(
+                split_names(args.types), split_names(args.formats),
+                min_size, max_size)
+        except ValueError as e:
+            print(e)
+            return EXIT_FAILED
+    finally:
+        catalogue.close()
+
+    records = [get_tag_record(filepath, metadata)
+               for filepath, metadata in results]
+    print("Found %s bitmap tags." % len(records))
+    if args.json_path == "-":
+        json.dump(records, stdout, indent=1)
+        stdout.write("\n")
+    elif args.json_path:
+        with open(path_normalize(args.json_path), "w",
+                  encoding="utf-8") as f:
+            json.dump(records, f, indent=1)
+    else:
+        for record in records:
+            stdout.write(format_tag_record(record) + "\n")
+
+    return EXIT_CLEAN
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    stdout = sys.stdout
+    messages = open(os.devnull, "w") if args.quiet else sys.stderr
+
+    # progress messages go to stderr, so the
+    # results can be written to stdout by themselves.
+    try:
+        with redirect_stdout(messages):
+            return run_query(args, stdout)
+    except KeyboardInterrupt:
+        print("Bitmap search cancelled.", file=sys.stderr)
+        return EXIT_CANCELLED
+    except Exception:
+        print(format_exc(), file=sys.stderr)
+        return EXIT_FAILED
+    finally:
+        if messages is not sys.stderr:
+            messages.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,25 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Constants that don't depend on any GUI modules, so they are safe to use
+from the tools that run without a window, like the tag scanner.
+'''
+
+from pathlib import Path
+
+from binilla.editor_constants import IS_WIN, IS_LNX
+
+if IS_WIN:
+    SETTINGS_DIR = Path(Path.home(), "mek")
+else:
+    SETTINGS_DIR = Path(Path.home(), ".local", "share", "mek")
+
+TAG_SCAN_CACHE_PATH = Path(SETTINGS_DIR, "tag_scanner_cache.sqlite")
+REVERSE_REF_INDEX_PATH = Path(SETTINGS_DIR, "reverse_dependency_index.sqlite")
+BITMAP_CATALOGUE_PATH = Path(SETTINGS_DIR, "bitmap_catalogue.sqlite")
@@ -17,6 +17,8 @@
 
 from supyr_struct.defs.frozen_dict import FrozenDict
 
+from mozzarilla.constants import SETTINGS_DIR
+
 v2_mozz_color_names = v1_color_names + ("active_tags_directory", )
 mozz_color_names = color_names + ("active_tags_directory", )
 mozz_font_names = font_names + ("font_tag_preview", )
@@ -50,11 +52,6 @@
 WORKING_DIR = Path.cwd()
 MOZZLIB_DIR = Path(__file__).parent
 
-if b_e_c.IS_WIN:
-    SETTINGS_DIR = Path(Path.home(), "mek")
-else:
-    SETTINGS_DIR = Path(Path.home(), ".local", "share", "mek")
-
 MOZZ_ICON_PATH = Path(MOZZLIB_DIR, "mozzarilla.ico")
 if not MOZZ_ICON_PATH.is_file():
     MOZZ_ICON_PATH = Path(MOZZLIB_DIR, "icons", "mozzarilla.ico")
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Headless Tag Scanner. Scans a tags directory for broken dependencies and
+tag specific errors without opening any windows, so it can be run from
+build scripts and CI. Run with --help for usage.
+
+Exit codes:
+    0   no problems were found.
+    1   at least one tag could not be loaded, scanned, or has problems.
+    2   the scan could not be run(bad arguments, missing directories, no
+        tags of the requested types, etc).
+    130 the scan was cancelled with Ctrl+C.
+'''
+
+import argparse
+import os
+import sys
+
+from contextlib import redirect_stdout
+from pathlib import Path
+from time import time
+from traceback import format_exc
+
+from supyr_struct.util import path_normalize, is_in_dir
+
+EXIT_CLEAN = 0
+EXIT_PROBLEMS = 1
+EXIT_FAILED = 2
+EXIT_CANCELLED = 130
+
+# maps the names usable with --handler to the module and
+# class name of the handler. These are imported when needed
+# since building the definitions for every handler is slow.
+HANDLER_CLASSES = {
+    "halo1":    ("reclaimer.hek.handler", "HaloHandler"),
+    "halo1_os_v3": ("reclaimer.os_v3_hek.handler", "OsV3HaloHandler"),
+    "halo1_os_v4": ("reclaimer.os_v4_hek.handler", "OsV4HaloHandler"),
+    "stubbs":   ("reclaimer.stubbs.handler", "StubbsHandler"),
+    }
+
+# these tag types are massive, so by default dont scan them
+DEFAULT_SKIPPED_DEF_IDS = frozenset(("sbsp", "scnr"))
+
+
+def make_handler(handler_name, tags_dir):
+    from importlib import import_module
+    from mozzarilla.constants import IS_LNX
+
+    module_name, class_name = HANDLER_CLASSES[handler_name]
+    handler_class = getattr(import_module(module_name), class_name)
+    handler = handler_class(debug=0, case_sensitive=IS_LNX)
+    handler.tagsdir = tags_dir
+    return handler
+
+
+def get_def_ids(handler, types_string):
+    '''
+    Returns a list of the def_ids specified in the comma separated
+    types_string, which may contain def_ids or tag extensions.
+    Raises ValueError if any of them aren't recognized.
+    '''
+    if not types_string:
+        return [def_id for def_id in sorted(handler.id_ext_map)
+                if def_id not in DEFAULT_SKIPPED_DEF_IDS]
+
+    def_ids = []
+    for tag_type in types_string.split(","):
+        tag_type = tag_type.strip()
+        if not tag_type:
+            continue
+
+        def_id = tag_type
+        if def_id not in handler.id_ext_map:
+            def_id = handler.ext_id_map.get("." + tag_type.lstrip(".").lower())
+
+        if def_id is None:
+            raise ValueError("Unknown tag type '%s'" % tag_type)
+        elif def_id not in def_ids:
+            def_ids.append(def_id)
+
+    return def_ids
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m mozzarilla.scan",
+        description="Scans tags for broken dependencies and tag "
+        "specific errors, and writes the results as JSON.")
+    parser.add_argument(
+        "tags_dir", help="The tags directory the tags are in.")
+    parser.add_argument(
+        "scan_dir", nargs="?", default=None,
+        help="The directory to scan. Must be inside tags_dir. "
+        "Defaults to tags_dir.")
+    parser.add_argument(
+        "--handler", default="halo1", choices=sorted(HANDLER_CLASSES),
+        help="The tag set the tags belong to. Defaults to halo1.")
+    parser.add_argument(
+        "--types", default="",
+        help="Comma separated list of the tag types to scan, given as "
+        "fourccs or extensions(ex: bitm,snd!,collision_model). Defaults "
+        "to every type except %s." % ", ".join(
+            sorted(DEFAULT_SKIPPED_DEF_IDS)))
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of processes to scan with. 0 means one per cpu. "
+        "Defaults to 1.")
+    parser.add_argument(
+        "--json", dest="json_path", default=None,
+        help="Filepath to write the results to as a single JSON "
+        "document. Use - for stdout.")
+    parser.add_argument(
+        "--jsonl", dest="jsonl_path", default=None,
+        help="Filepath to write the results to as one JSON "
+        "record per line. Use - for stdout.")
+    parser.add_argument(
+        "--log", dest="log_path", default=None,
+        help="Filepath to append the same human readable log that "
+        "the Tag Scanner window writes to. Use - for stdout.")
+    parser.add_argument(
+        "--problems-only", action="store_true",
+        help="Only write JSON records for tags that have problems.")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Rescan every tag instead of reusing the cached "
+        "results of tags that haven't changed.")
+    parser.add_argument(
+        "--cache-path", default=None,
+        help="Filepath of the scan cache to use instead of the default.")
+    parser.add_argument(
+        "--rules", default="",
+        help="Comma separated list of python modules to import that "
+        "register additional tag specific rules(see tagset.tag_rules).")
+    parser.add_argument(
+        "--rule-times", action="store_true",
+        help="Print how long each tag specific rule took in total.")
+    parser.add_argument(
+        "--metrics", dest="metrics_path", default=None,
+        help="Filepath to write how long each stage of the scan took for "
+        "each tag type, tags/sec and peak memory usage to as JSON. A "
+        "summary of them is also printed and added to the --log and --json "
+        "outputs.")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="Don't print progress messages.")
+    return parser
+
+
+def open_report_writer(writer_class, filepath, stdout, *args, **kwargs):
+    if filepath == "-":
+        return writer_class(stdout, *args, **kwargs)
+    return writer_class(path_normalize(filepath), *args, **kwargs)
+
+
+def run_scan(args, stdout):
+    '''
+    Runs the scan described by the parsed command line arguments and
+    returns the exit code. Results written to "-" go to stdout.
+    '''
+    from mozzarilla.tagset.scan_cache import TagScanCache
+    from mozzarilla.tagset.scan_report import TextScanReportWriter,\
+         JsonlScanReportWriter, JsonScanReportWriter
+    from mozzarilla.tagset.scan_metrics import ScanMetrics
+    from mozzarilla.tagset.tag_rules import import_rule_modules,\
+         format_rule_times
+    from mozzarilla.tagset.tag_scanner import iter_scan_results
+    from mozzarilla.tagset.tags_dir_index import locate_tags,\
+         abs_path_normalize
+
+    # relative directories are relative to the current directory
+    tags_dir = abs_path_normalize(args.tags_dir)
+    scan_dir = abs_path_normalize(args.scan_dir or args.tags_dir)
+    if not os.path.isdir(tags_dir):
+        print("Tags directory '%s' does not exist." % tags_dir)
+        return EXIT_FAILED
+    elif not os.path.isdir(scan_dir):
+        print("Scan directory '%s' does not exist." % scan_dir)
+        return EXIT_FAILED
+    elif not is_in_dir(scan_dir, tags_dir):
+        print("Specified directory is not located within the tags directory")
+        return EXIT_FAILED
+
+    handler = make_handler(args.handler, tags_dir)
+    try:
+        def_ids = get_def_ids(handler, args.types)
+    except ValueError as e:
+        print(e)
+        return EXIT_FAILED
+
+    try:
+        import_rule_modules(name.strip() for name in args.rules.split(",")
+                            if name.strip())
+    except ImportError:
+        print(format_exc())
+        print("Could not import the tag rule modules.")
+        return EXIT_FAILED
+
+    process_count = args.jobs
+    if process_count < 0:
+        print("--jobs must not be negative.")
+        return EXIT_FAILED
+    elif process_count == 0:
+        process_count = None
+
+    s_time = time()
+    metrics = ScanMetrics(process_count or os.cpu_count() or 1)
+    print("Locating tags...")
+    with metrics.time_stage("locate"):
+        all_tag_paths = locate_tags(handler, scan_dir, def_ids)
+
+    if not any(all_tag_paths.values()):
+        # most likely the wrong directory, so don't report it as clean
+        print("No tags of the requested types found in '%s'." % scan_dir)
+        return EXIT_FAILED
+
+    scan_cache = None
+    if not args.no_cache:
+        try:
+            if args.cache_path:
+                scan_cache = TagScanCache(
+                    handler, path_normalize(args.cache_path))
+            else:
+                scan_cache = TagScanCache(handler)
+            scan_cache.remove_missing(
+                Path(scan_dir).relative_to(handler.tagsdir), all_tag_paths)
+        except Exception:
+            print(format_exc())
+            print("Could not load the tag scan cache.")
+            scan_cache = None
+
+    report_writers = []
+    exit_code = EXIT_CLEAN
+    tag_count = problem_count = 0
+    finished = False
+    results = iter_scan_results(
+        handler, all_tag_paths, process_count, scan_cache)
+    try:
+        for writer_class, filepath in (
+                (TextScanReportWriter, args.log_path),
+                (JsonScanReportWriter, args.json_path),
+                (JsonlScanReportWriter, args.jsonl_path)):
+            if filepath:
+                report_writers.append(open_report_writer(
+                    writer_class, filepath, stdout, tags_dir, scan_dir,
+                    problems_only=args.problems_only))
+
+        curr_def_id = None
+        for result in results:
+            if result.def_id != curr_def_id:
+                curr_def_id = result.def_id
+                print("Scanning '%s' tags..." %
+                      handler.id_ext_map[curr_def_id][1:])
+
+            tag_count += 1
+            metrics.add_result(result)
+            if result.has_problems:
+                problem_count += 1
+                exit_code = EXIT_PROBLEMS
+
+            with metrics.time_stage("write", result.def_id):
+                for writer in report_writers:
+                    writer.add_result(result)
+
+        finished = True
+    finally:
+        results.close()
+        metrics.finish(finished)
+        for writer in report_writers:
+            try:
+                writer.close(finished, metrics if args.metrics_path else None)
+            except Exception:
+                print(format_exc())
+
+        if scan_cache is not None:
+            # save even if cancelled so the work done so far isn't lost
+            try:
+                scan_cache.save()
+            except Exception:
+                print(format_exc())
+                print("Could not save the tag scan cache.")
+            scan_cache.close()
+
+    print("Scanned %s tags in %s seconds. %s had problems." % (
+        tag_count, int(time() - s_time), problem_count))
+    if args.rule_times and metrics.rule_times:
+        print(format_rule_times(metrics.rule_times))
+
+    if args.metrics_path:
+        print(metrics.format_summary())
+        try:
+            metrics.write_json(path_normalize(args.metrics_path))
+        except Exception:
+            print(format_exc())
+            print("Could not write scan metrics.")
+            return EXIT_FAILED
+
+    return exit_code
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    stdout = sys.stdout
+    messages = open(os.devnull, "w") if args.quiet else sys.stderr
+
+    # progress messages and the output from building the handler go
+    # to stderr, so the results can be written to stdout by themselves.
+    try:
+        with redirect_stdout(messages):
+            return run_scan(args, stdout)
+    except KeyboardInterrupt:
+        print("Tag scanning operation cancelled.", file=sys.stderr)
+        return EXIT_CANCELLED
+    except Exception:
+        print(format_exc(), file=sys.stderr)
+        return EXIT_FAILED
+    finally:
+        if messages is not sys.stderr:
+            messages.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+__all__ = (
+    "tags_dir_index", "tag_ref_reader", "tag_rules", "tag_scanner",
+    "scan_cache", "scan_report", "scan_metrics", "reverse_ref_index",
+    "tag_cache", "dependency_closure", "zip_writer", "dependency_cache",
+    "ref_validator", "closure_report", "package_manifest",
+    "bitmap_metadata", "bitmap_catalogue", "p8_palette_picker",
+    )
+
+from mozzarilla.tagset import tags_dir_index, tag_ref_reader, tag_rules,\
+     tag_scanner, scan_cache, scan_report, scan_metrics, reverse_ref_index,\
+     tag_cache, dependency_closure, zip_writer, dependency_cache,\
+     ref_validator, closure_report, package_manifest,\
+     bitmap_metadata, bitmap_catalogue, p8_palette_picker
@@ -0,0 +1,304 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+An on-disk catalogue of the metadata of the bitmap tags in a directory,
+so the Bitmap Converter only reads the bitmaps that changed since it last
+scanned them. The catalogue is a sqlite database, so it can also be
+searched without opening any windows(see mozzarilla.bitmap_query).
+'''
+
+import os
+import sqlite3
+
+from pathlib import Path
+from traceback import format_exc
+
+from mozzarilla.constants import BITMAP_CATALOGUE_PATH
+from mozzarilla.tagset.bitmap_metadata import BitmapMetadata,\
+     BitmapTagMetadata, BITMAP_TYPE_NAMES, BITMAP_FORMAT_NAMES,\
+     read_bitmap_metadata
+from mozzarilla.tagset.tags_dir_index import iter_indexed_files,\
+     abs_path_normalize
+
+# increment this whenever what gets cataloged changes,
+# so metadata read by older versions isn't reused.
+BITMAP_CATALOGUE_VERSION = 1
+
+TAG_COLUMNS = ("color_plate_width", "color_plate_height", "tiff_data_size",
+               "pixel_data_size", "sprite_count")
+BITMAP_COLUMNS = ("type", "format", "flags", "width", "height", "depth",
+                  "mipmaps", "base_address")
+
+
+class BitmapCatalogue:
+    '''
+    An on-disk catalogue of the BitmapTagMetadata of the bitmap tags in
+    a single directory. Each tag is keyed by its filepath relative to the
+    directory, and its metadata is only reused while the size and
+    modification time of its file are unchanged.
+    '''
+    filepath = None
+    root_dir = ""
+
+    _connection = None
+    # maps filepath strings to (size, mtime, BitmapTagMetadata)
+    _entries = ()
+    _changed = ()
+    _deleted = ()
+
+    def __init__(self, root_dir, filepath=BITMAP_CATALOGUE_PATH):
+        self.filepath = Path(filepath)
+        # relative and absolute paths to the same directory share entries
+        self.root_dir = abs_path_normalize(root_dir)
+
+        self._entries = {}
+        self._changed = set()
+        self._deleted = set()
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.filepath))
+        self._create_tables()
+        self.load()
+
+    def _create_tables(self):
+        cur = self._connection.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS catalogue_info "
+                    "(name TEXT PRIMARY KEY, value TEXT)")
+        cur.execute("SELECT value FROM catalogue_info WHERE name = 'version'")
+        row = cur.fetchone()
+        if row is None or row[0] != str(BITMAP_CATALOGUE_VERSION):
+            cur.execute("DROP TABLE IF EXISTS bitmap_tags")
+            cur.execute("DROP TABLE IF EXISTS bitmaps")
+            cur.execute("INSERT OR REPLACE INTO catalogue_info VALUES "
+                        "('version', ?)", (str(BITMAP_CATALOGUE_VERSION), ))
+
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS bitmap_tags ("
+            "root_dir TEXT, filepath TEXT, size INTEGER, mtime INTEGER, %s, "
+            "PRIMARY KEY (root_dir, filepath))" %
+            ", ".join("%s INTEGER" % name for name in TAG_COLUMNS))
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS bitmaps ("
+            "root_dir TEXT, filepath TEXT, bitmap_index INTEGER, %s, "
+            "PRIMARY KEY (root_dir, filepath, bitmap_index))" %
+            ", ".join("%s INTEGER" % name for name in BITMAP_COLUMNS))
+        self._connection.commit()
+
+    def load(self):
+        '''Reads the metadata of every cataloged tag in the directory.'''
+        self._entries.clear()
+        self._changed.clear()
+        self._deleted.clear()
+        cur = self._connection.execute(
+            "SELECT filepath, size, mtime, %s FROM bitmap_tags "
+            "WHERE root_dir = ?" % ", ".join(TAG_COLUMNS), (self.root_dir, ))
+        for row in cur:
+            metadata = BitmapTagMetadata()
+            for name, value in zip(TAG_COLUMNS, row[3:]):
+                setattr(metadata, name, value)
+
+            self._entries[row[0]] = (row[1], row[2], metadata)
+
+        cur = self._connection.execute(
+            "SELECT filepath, %s FROM bitmaps WHERE root_dir = ? "
+            "ORDER BY filepath, bitmap_index" % ", ".join(BITMAP_COLUMNS),
+            (self.root_dir, ))
+        for row in cur:
+            entry = self._entries.get(row[0])
+            if entry is None:
+                continue
+
+            bitmap = BitmapMetadata()
+            for name, value in zip(BITMAP_COLUMNS, row[1:]):
+                setattr(bitmap, name, value)
+
+            entry[2].bitmaps.append(bitmap)
+
+    def save(self):
+        '''Writes every tag added or removed since the last save.'''
+        with self._connection:
+            for filepath in self._deleted | self._changed:
+                key = (self.root_dir, filepath)
+                self._connection.execute(
+                    "DELETE FROM bitmap_tags WHERE root_dir = ? "
+                    "AND filepath = ?", key)
+                self._connection.execute(
+                    "DELETE FROM bitmaps WHERE root_dir = ? "
+                    "AND filepath = ?", key)
+
+            for filepath in self._changed:
+                key = (self.root_dir, filepath)
+                size, mtime, metadata = self._entries[filepath]
+                self._connection.execute(
+                    "INSERT INTO bitmap_tags VALUES (?, ?, ?, ?, %s)" %
+                    ", ".join("?" * len(TAG_COLUMNS)),
+                    key + (size, mtime) + tuple(
+                        getattr(metadata, name) for name in TAG_COLUMNS))
+                self._connection.executemany(
+                    "INSERT INTO bitmaps VALUES (?, ?, ?, %s)" %
+                    ", ".join("?" * len(BITMAP_COLUMNS)),
+                    (key + (i, ) + tuple(getattr(bitmap, name)
+                                         for name in BITMAP_COLUMNS)
+                     for i, bitmap in enumerate(metadata.bitmaps)))
+
+        self._changed.clear()
+        self._deleted.clear()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_metadata(self, filepath, size, mtime_ns):
+        '''
+        Returns the cataloged BitmapTagMetadata of the tag at the filepath
+        relative to the directory, or None if it isn't cataloged or its
+        size or modification time differ from those given.
+        '''
+        entry = self._entries.get(str(filepath))
+        if entry is None or entry[: 2] != (size, mtime_ns):
+            return None
+        return entry[2]
+
+    def add_metadata(self, filepath, size, mtime_ns, metadata):
+        key = str(filepath)
+        self._entries[key] = (size, mtime_ns, metadata)
+        self._changed.add(key)
+        self._deleted.discard(key)
+
+    def read_metadata(self, filepath, size, mtime_ns):
+        '''
+        Returns the BitmapTagMetadata of the tag at the filepath relative to
+        the directory, only reading it from the file if it isn't cataloged
+        or has changed, and cataloging it if it is read. Raises ValueError
+        if the file isn't a bitmap tag, the same as read_bitmap_metadata.
+        '''
+        metadata = self.get_metadata(filepath, size, mtime_ns)
+        if metadata is not None:
+            return metadata
+
+        try:
+            metadata = read_bitmap_metadata(
+                os.path.join(self.root_dir, str(filepath)))
+        except Exception:
+            # don't keep the metadata of what the file used to be
+            self.remove_metadata(filepath)
+            raise
+
+        self.add_metadata(filepath, size, mtime_ns, metadata)
+        return metadata
+
+    def remove_metadata(self, filepath):
+        key = str(filepath)
+        if self._entries.pop(key, None) is not None:
+            self._deleted.add(key)
+        self._changed.discard(key)
+
+    def remove_missing(self, filepaths):
+        '''
+        Removes the metadata of every tag that isn't in filepaths.
+        Used to forget tags that have been deleted since the last scan.
+        '''
+        filepaths = set(str(filepath) for filepath in filepaths)
+        for key in tuple(self._entries):
+            if key not in filepaths:
+                self.remove_metadata(key)
+
+    def refresh(self, is_cancelled=None):
+        '''
+        Reads the metadata of every bitmap tag in the directory that isn't
+        cataloged or has changed, and forgets the tags that were deleted.
+        Returns a list of the filepaths of the tags that couldn't be read.
+        The caller is responsible for saving the catalogue afterward.
+        '''
+        filepaths = []
+        unreadable = []
+        for filepath, size, mtime_ns in iter_indexed_files(
+                self.root_dir, (".bitmap", ), is_cancelled):
+            if is_cancelled is not None and is_cancelled():
+                return unreadable
+
+            filepaths.append(filepath)
+            try:
+                self.read_metadata(filepath, size, mtime_ns)
+            except Exception:
+                unreadable.append(filepath)
+
+        # nothing is listed if cancelled, so don't forget every tag
+        if is_cancelled is None or not is_cancelled():
+            self.remove_missing(filepaths)
+
+        return unreadable
+
+    def query(self, types=(), formats=(), min_pixel_data_size=None,
+              max_pixel_data_size=None):
+        '''
+        Returns a sorted list of (filepath, BitmapTagMetadata) tuples for
+        the saved tags that contain a bitmap of one of the given types and
+        formats(given as values or names, ex: "cubemap" and "dxt5"), and
+        whose pixel data size is within the given range. Empty types or
+        formats match any bitmap, and None means the size is unlimited.
+        '''
+        where = ["t.root_dir = ?"]
+        params = [self.root_dir]
+        if min_pixel_data_size is not None:
+            where.append("t.pixel_data_size >= ?")
+            params.append(min_pixel_data_size)
+        if max_pixel_data_size is not None:
+            where.append("t.pixel_data_size <= ?")
+            params.append(max_pixel_data_size)
+
+        bitmap_where = ["b.root_dir = t.root_dir", "b.filepath = t.filepath"]
+        for name, values, names in (
+                ("b.type", types, BITMAP_TYPE_NAMES),
+                ("b.format", formats, BITMAP_FORMAT_NAMES)):
+            if not values:
+                continue
+
+            values = [get_enum_value(value, names) for value in values]
+            bitmap_where.append("%s IN (%s)" % (
+                name, ", ".join("?" * len(values))))
+            params.extend(values)
+
+        if types or formats:
+            where.append("EXISTS (SELECT 1 FROM bitmaps b WHERE %s)" %
+                         " AND ".join(bitmap_where))
+
+        cur = self._connection.execute(
+            "SELECT t.filepath FROM bitmap_tags t WHERE %s "
+            "ORDER BY t.filepath" % " AND ".join(where), params)
+        return [(row[0], self._entries[row[0]][2]) for row in cur
+                if row[0] in self._entries]
+
+
+def get_enum_value(value, names):
+    '''
+    Returns the value of the name in names, a dict mapping values to names.
+    value may also be a value, or a value as a string. Raises ValueError
+    if it isn't a value or name in names.
+    '''
+    if isinstance(value, str):
+        for enum_value, name in names.items():
+            if name == value.strip().lower() or str(enum_value) == value:
+                return enum_value
+    elif value in names:
+        return value
+
+    raise ValueError("Unknown value '%s'. Must be one of: %s" % (
+        value, ", ".join(names.values())))
+
+
+def open_bitmap_catalogue(root_dir, filepath=BITMAP_CATALOGUE_PATH):
+    '''Returns a BitmapCatalogue of root_dir, or None if it can't be opened.'''
+    try:
+        return BitmapCatalogue(root_dir, filepath)
+    except Exception:
+        print(format_exc())
+        print("Could not load the bitmap catalogue.")
+        return None
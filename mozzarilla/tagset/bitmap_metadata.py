@@ -0,0 +1,166 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Reads the metadata of bitmap tags(the size of their pixel data and the
+type, format and dimensions of each bitmap) without building the tags.
+
+Building a bitmap tag copies its processed pixel data and compressed
+color plate into memory, which can be tens of megabytes per tag, when all
+the Bitmap Converter needs to list it is the few bytes describing it.
+The file is read using mmap and only the tag header, the tagdata struct,
+the sprite counts of each sequence and the bitmap blocks are read from it.
+Everything else is skipped over using the sizes stored in the tagdata.
+'''
+
+import mmap
+import os
+
+from struct import Struct as PyStruct
+
+# the base_address of the bitmap blocks in bitmaps made for xbox
+XBOX_BASE_ADDRESS = 1073751810
+
+TAG_HEADER_SIZE = 64
+# offsets in the header of the tag class and engine id
+TAG_CLASS_OFFSET = 36
+ENGINE_ID_OFFSET = 60
+
+# the bitm tagdata struct, which comes right after the tag header:
+#     color_plate_width, color_plate_height at 24
+#     compressed_color_plate_data.size at 28
+#     processed_pixel_data.size at 48
+#     sequences.size at 84
+#     bitmaps.size at 96
+TAGDATA_SIZE = 108
+tagdata_struct = PyStruct(">24xHHi16xi32xi8xi8x")
+
+# a sequence block, and the sprites.size in it
+SEQUENCE_SIZE = 64
+sequence_sprite_count_struct = PyStruct(">52xi8x")
+SPRITE_SIZE = 32
+
+# a bitmap block:
+#     width, height, depth, type, format, flags at 4
+#     mipmaps at 20
+#     base_address at 44
+BITMAP_SIZE = 48
+bitmap_struct = PyStruct(">4xHHHhhH4xH22xI")
+
+SWIZZLED_FLAG = 1 << 3
+
+# names of the values of the type and format of bitmap blocks
+BITMAP_TYPE_NAMES = {
+    0: "texture_2d", 1: "texture_3d", 2: "cubemap", 3: "white",
+    }
+BITMAP_FORMAT_NAMES = {
+    0: "a8", 1: "y8", 2: "ay8", 3: "a8y8", 6: "r5g6b5", 8: "a1r5g5b5",
+    9: "a4r4g4b4", 10: "x8r8g8b8", 11: "a8r8g8b8", 14: "dxt1", 15: "dxt3",
+    16: "dxt5", 17: "p8_bump",
+    }
+
+
+class BitmapMetadata:
+    '''The metadata of a single bitmap block in a bitmap tag.'''
+    type = 0
+    format = 0
+    flags = 0
+    width = 0
+    height = 0
+    depth = 0
+    mipmaps = 0
+    base_address = 0
+
+    @property
+    def swizzled(self):
+        return bool(self.flags & SWIZZLED_FLAG)
+
+
+class BitmapTagMetadata:
+    '''The metadata of a bitmap tag, as read by read_bitmap_metadata.'''
+    color_plate_width = 0
+    color_plate_height = 0
+    tiff_data_size = 0
+    pixel_data_size = 0
+    sprite_count = 0
+    # list of the BitmapMetadata of each bitmap in the tag
+    bitmaps = ()
+
+    def __init__(self):
+        self.bitmaps = []
+
+    @property
+    def is_xbox_bitmap(self):
+        # the same way reclaimer checks, which is by the first bitmap
+        return bool(self.bitmaps and
+                    self.bitmaps[0].base_address == XBOX_BASE_ADDRESS)
+
+
+def read_bitmap_metadata(filepath):
+    '''
+    Returns a BitmapTagMetadata of the bitmap tag at filepath.
+    Raises ValueError if the file isn't a bitmap tag or is truncated.
+    '''
+    with open(str(filepath), "rb") as f:
+        if os.fstat(f.fileno()).st_size < TAG_HEADER_SIZE + TAGDATA_SIZE:
+            raise ValueError("'%s' is too small to be a bitmap tag." %
+                             filepath)
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if (data[TAG_CLASS_OFFSET: TAG_CLASS_OFFSET + 4] != b'bitm' or
+                    data[ENGINE_ID_OFFSET: ENGINE_ID_OFFSET + 4] != b'blam'):
+                raise ValueError("'%s' is not a bitmap tag." % filepath)
+
+            return _read_bitmap_metadata(data, filepath)
+        finally:
+            data.close()
+
+
+def _read_bitmap_metadata(data, filepath):
+    metadata = BitmapTagMetadata()
+    (metadata.color_plate_width, metadata.color_plate_height,
+     tiff_data_size, pixel_data_size, sequence_count, bitmap_count,
+     ) = tagdata_struct.unpack_from(data, TAG_HEADER_SIZE)
+
+    if min(tiff_data_size, pixel_data_size, sequence_count, bitmap_count) < 0:
+        raise ValueError("'%s' has negative block sizes." % filepath)
+
+    metadata.tiff_data_size = tiff_data_size
+    metadata.pixel_data_size = pixel_data_size
+
+    # the blocks are stored after the tagdata in the order of the fields
+    # that point to them, with the sprites of each sequence stored after
+    # every sequence block. skip over everything up to the bitmaps.
+    offset = (TAG_HEADER_SIZE + TAGDATA_SIZE +
+              tiff_data_size + pixel_data_size)
+    sequences_end = offset + sequence_count * SEQUENCE_SIZE
+    if sequences_end > len(data):
+        raise ValueError("'%s' is truncated." % filepath)
+
+    sprite_count = 0
+    for offset in range(offset, sequences_end, SEQUENCE_SIZE):
+        count = sequence_sprite_count_struct.unpack_from(data, offset)[0]
+        if count < 0:
+            raise ValueError("'%s' has negative block sizes." % filepath)
+        sprite_count += count
+
+    metadata.sprite_count = sprite_count
+    bitmaps_start = sequences_end + sprite_count * SPRITE_SIZE
+    bitmaps_end = bitmaps_start + bitmap_count * BITMAP_SIZE
+    if bitmaps_end > len(data):
+        raise ValueError("'%s' is truncated." % filepath)
+
+    for offset in range(bitmaps_start, bitmaps_end, BITMAP_SIZE):
+        bitmap = BitmapMetadata()
+        (bitmap.width, bitmap.height, bitmap.depth, bitmap.type,
+         bitmap.format, bitmap.flags, bitmap.mipmaps, bitmap.base_address,
+         ) = bitmap_struct.unpack_from(data, offset)
+        metadata.bitmaps.append(bitmap)
+
+    return metadata
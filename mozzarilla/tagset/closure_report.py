@@ -0,0 +1,230 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Reports how many bytes the dependency closure of a set of tags takes up,
+broken down by tag class and by which tags pull in the most of it. Sizes
+come from the shared tags directory index, so no tags are fully loaded.
+'''
+
+import os
+
+from mozzarilla.tagset.dependency_closure import get_arcname
+from mozzarilla.tagset.reverse_ref_index import get_ref_key
+from mozzarilla.tagset.tags_dir_index import get_tag_file_sizes
+
+# most subtrees listed by format_closure_report by default
+REPORT_SUBTREE_COUNT = 50
+
+
+class ClosureReport:
+    '''
+    The sizes of the tags in a DependencyClosure.
+
+    The subtree of a tag is every tag in the closure that is only there
+    because of it, meaning every chain of references from the root tags
+    to them passes through it(the tag dominates them). Its retained size
+    is the total size of its subtree, including itself, which is what
+    removing every reference to it would save. Each tag is in the subtree
+    of the tags above it in only one chain, so subtrees never overlap and
+    shared tags are counted once, under the tag that all their users share.
+    '''
+    root_filepaths = ()
+    # maps the filepath of each tag in the closure to its file size,
+    # or to None if the file couldn't be found in the index
+    sizes = ()
+    total_size = 0
+    tag_count = 0
+    missing_ref_count = 0
+    unreadable_count = 0
+
+    # list of (ext, tag_count, total_size) tuples for each tag
+    # class in the closure, sorted by total_size, largest first.
+    class_rows = ()
+    # list of (filepath, subtree_tag_count, retained_size, size) tuples
+    # for each tag in the closure, sorted by retained_size, largest first.
+    subtree_rows = ()
+
+    def __init__(self, root_filepaths):
+        self.root_filepaths = list(root_filepaths)
+        self.sizes = {}
+        self.class_rows = []
+        self.subtree_rows = []
+
+
+def get_dominators(root_filepaths, dependencies):
+    '''
+    Returns a dict mapping each filepath reachable from the root_filepaths
+    to the filepath of its immediate dominator, or None for the root tags.
+    Every filepath comes after its dominator in the dict.
+    dependencies maps each filepath to an iterable of the filepaths it
+    references. Uses the iterative algorithm by Cooper, Harvey and Kennedy.
+    '''
+    # number the tags in depth-first postorder from a virtual tag(None)
+    # that references every root tag, so the graph has a single root.
+    # this doesn't recurse since chains of references can be long.
+    postorder = []
+    stack = [(None, iter(root_filepaths))]
+    seen = {None}
+    while stack:
+        filepath, child_iter = stack[-1]
+        for child in child_iter:
+            if child not in seen:
+                seen.add(child)
+                stack.append((child, iter(dependencies.get(child) or ())))
+                break
+        else:
+            stack.pop()
+            postorder.append(filepath)
+
+    order = postorder[::-1]
+    index = {filepath: i for i, filepath in enumerate(order)}
+    preds = [set() for _ in order]
+    for i, filepath in enumerate(order):
+        for child in (root_filepaths if filepath is None else
+                      dependencies.get(filepath) or ()):
+            preds[index[child]].add(i)
+
+    # idoms are indices into order, which is reverse postorder
+    idoms = [None] * len(order)
+    idoms[0] = 0
+    changed = True
+    while changed:
+        changed = False
+        for j in range(1, len(order)):
+            new_idom = None
+            for i in preds[j]:
+                if idoms[i] is None:
+                    continue
+                elif new_idom is None:
+                    new_idom = i
+                    continue
+
+                # walk both up the dominator tree until they meet
+                while i != new_idom:
+                    while i > new_idom:
+                        i = idoms[i]
+                    while new_idom > i:
+                        new_idom = idoms[new_idom]
+
+            if idoms[j] != new_idom:
+                idoms[j] = new_idom
+                changed = True
+
+    return {filepath: order[idoms[j]] for j, filepath in
+            enumerate(order) if filepath is not None}
+
+
+def build_closure_report(handler, closure):
+    '''
+    Returns a ClosureReport of the tags in the DependencyClosure,
+    using the sizes of their files in the shared tags directory index.
+    '''
+    report = ClosureReport(str(filepath) for filepath in
+                           closure.root_filepaths)
+    report.missing_ref_count = len(closure.missing_refs)
+    report.unreadable_count = len(closure.unreadable)
+
+    # references in a different case than the tag was first found in
+    # are matched by key, the same way the closure was resolved.
+    filepaths_by_key = {get_ref_key(filepath): filepath
+                        for filepath in closure.dependencies}
+    dependencies = {}
+    for filepath, tag_dependencies in closure.dependencies.items():
+        dependencies[filepath] = [
+            filepaths_by_key[get_ref_key(dependency_filepath)]
+            for _, __, ___, dependency_filepath in tag_dependencies or ()
+            if dependency_filepath is not None and
+            get_ref_key(dependency_filepath) in filepaths_by_key]
+
+    sizes = report.sizes = get_tag_file_sizes(
+        handler.tagsdir, closure.dependencies)
+    report.tag_count = len(sizes)
+    report.total_size = sum(size or 0 for size in sizes.values())
+
+    class_totals = {}
+    for filepath, size in sizes.items():
+        ext = os.path.splitext(filepath)[-1].lower()
+        count, total = class_totals.get(ext, (0, 0))
+        class_totals[ext] = (count + 1, total + (size or 0))
+
+    report.class_rows = sorted(
+        ((ext, count, total) for ext, (count, total) in class_totals.items()),
+        key=lambda row: (-row[2], row[0]))
+
+    roots = [filepaths_by_key[get_ref_key(filepath)]
+             for filepath in report.root_filepaths
+             if get_ref_key(filepath) in filepaths_by_key]
+    idoms = get_dominators(roots, dependencies)
+
+    # add each tag's size to every tag above it in the dominator tree.
+    # a tag's dominator is always before it in idoms, so summing them
+    # in reverse finishes each tag's total before adding it to the next.
+    retained = {filepath: [1, sizes.get(filepath) or 0]
+                for filepath in idoms}
+    for filepath in reversed(tuple(idoms)):
+        idom = idoms[filepath]
+        if idom is not None:
+            retained[idom][0] += retained[filepath][0]
+            retained[idom][1] += retained[filepath][1]
+
+    report.subtree_rows = sorted(
+        ((filepath, count, size, sizes.get(filepath))
+         for filepath, (count, size) in retained.items()),
+        key=lambda row: (-row[2], get_arcname(row[0])))
+
+    return report
+
+
+def format_size(size):
+    if size is None:
+        return "?"
+    for units in ("B", "KiB", "MiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        units = "GiB"
+
+    return ("%d %s" if units == "B" else "%.2f %s") % (size, units)
+
+
+def format_closure_report(report, subtree_count=REPORT_SUBTREE_COUNT):
+    '''
+    Returns the ClosureReport as lines of text, with a table of the
+    tag classes and one of the subtree_count largest subtrees.
+    '''
+    lines = ["Dependency closure of %s" % ", ".join(
+                 "'%s'" % filepath for filepath in report.root_filepaths),
+             "    %s tags, %s" % (report.tag_count,
+                                  format_size(report.total_size))]
+    if report.missing_ref_count:
+        lines.append("    %s references to missing tags" %
+                     report.missing_ref_count)
+    if report.unreadable_count:
+        lines.append("    %s tags could not be read" %
+                     report.unreadable_count)
+
+    lines.extend(("", "%-34s%6s%14s%8s" % (
+        "Tag class", "Tags", "Size", "Share")))
+    for ext, count, size in report.class_rows:
+        lines.append("%-34s%6s%14s%7.1f%%" % (
+            ext.lstrip("."), count, format_size(size),
+            100 * size / max(1, report.total_size)))
+
+    lines.extend(("", "Largest subtrees(tags only included because of "
+                      "the tag, including itself)",
+                  "%8s%14s%14s%8s  %s" % (
+                      "Tags", "Retained", "Own size", "Share", "Tag")))
+    for filepath, count, retained_size, size in (
+            report.subtree_rows[: subtree_count]):
+        lines.append("%8s%14s%14s%7.1f%%  %s" % (
+            count, format_size(retained_size), format_size(size),
+            100 * retained_size / max(1, report.total_size), filepath))
+
+    return lines
@@ -0,0 +1,167 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+A cache of the dependencies read from tag files, and a thread that reads
+them ahead of time so the dependency viewer never waits on tag parsing.
+'''
+
+import os
+
+from collections import deque
+from threading import Condition, Lock, Thread
+from traceback import format_exc
+
+
+class TagDependencyCache:
+    '''
+    Maps tag filepaths to the dependencies read_dependencies returns for
+    them. An entry is forgotten once its file's size or modification time
+    changes, so edited tags are read again the next time they're needed.
+    read_dependencies is called without the cache being locked, and may
+    be called from any thread.
+    '''
+    read_dependencies = None
+
+    _lock = None
+    # maps filepath strings to ((size, mtime), dependencies) tuples
+    _entries = ()
+
+    def __init__(self, read_dependencies):
+        self.read_dependencies = read_dependencies
+        self._lock = Lock()
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _get_stat(filepath):
+        try:
+            stat = os.stat(str(filepath))
+            return (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return None
+
+    def get_cached(self, filepath):
+        '''
+        Returns the cached dependencies of the tag at filepath, or None
+        if they aren't cached or the file changed since they were read.
+        '''
+        key = str(filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None and entry[0] == self._get_stat(filepath):
+            return entry[1]
+        return None
+
+    def get(self, filepath):
+        '''
+        Returns the dependencies of the tag at filepath, reading
+        them with read_dependencies if they aren't cached.
+        '''
+        dependencies = self.get_cached(filepath)
+        if dependencies is not None:
+            return dependencies
+
+        # stat before reading so changes made while reading are noticed
+        stat = self._get_stat(filepath)
+        dependencies = self.read_dependencies(filepath)
+        if dependencies is None:
+            dependencies = ()
+
+        if stat is not None:
+            with self._lock:
+                self._entries[str(filepath)] = (stat, dependencies)
+
+        return dependencies
+
+    def invalidate(self, filepath):
+        with self._lock:
+            self._entries.pop(str(filepath), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DependencyPrefetcher:
+    '''
+    Reads the dependencies of tags into a TagDependencyCache on a daemon
+    thread, one tag at a time, in the order they are requested. Urgent
+    requests(ex: for a tag the user is waiting on) are read before the
+    rest. on_read is called from the prefetch thread with the filepath
+    of each tag after its dependencies are cached(or fail to be read).
+    '''
+    cache = None
+    on_read = None
+
+    _condition = None
+    _queue = ()
+    _queued = ()
+    _stopped = False
+    _thread = None
+
+    def __init__(self, cache, on_read=None):
+        self.cache = cache
+        self.on_read = on_read
+        self._condition = Condition()
+        self._queue = deque()
+        self._queued = set()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, filepath, urgent=False):
+        key = str(filepath)
+        with self._condition:
+            if key in self._queued:
+                if not urgent:
+                    return
+                self._queue.remove(key)
+
+            if urgent:
+                self._queue.appendleft(key)
+            else:
+                self._queue.append(key)
+
+            self._queued.add(key)
+            self._condition.notify()
+
+    def clear(self):
+        '''Forgets every request that hasn't started being read.'''
+        with self._condition:
+            self._queue.clear()
+            self._queued.clear()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._queued.clear()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+
+                if self._stopped:
+                    return
+
+                filepath = self._queue.popleft()
+                self._queued.discard(filepath)
+
+            try:
+                self.cache.get(filepath)
+            except Exception:
+                print(format_exc())
+
+            if self.on_read is not None:
+                self.on_read(filepath)
@@ -0,0 +1,265 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Resolves every tag a set of tags depend on, directly or indirectly,
+reading the tags on the frontier of the dependency graph in parallel.
+
+Nothing in here may import tkinter or binilla widgets, since the
+functions in this module are run inside worker processes.
+'''
+
+import os
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import PurePath, PureWindowsPath
+
+from mozzarilla.tagset.reverse_ref_index import get_ref_key
+from mozzarilla.tagset.tags_dir_index import find_tag_fullpath
+from mozzarilla.tagset.tag_scanner import get_tag_refs, read_tag_file_refs,\
+     get_worker_handler, get_worker_handler_info
+
+# most tags sent to a worker process in each job. jobs are made
+# smaller than this when there aren't enough tags to go around.
+CLOSURE_CHUNK_SIZE = 16
+
+# the find_tag_file results cached by the current worker
+# process, and the handler they were found with.
+_worker_find_cache = None
+_worker_find_handler = None
+
+
+def get_arcname(filepath):
+    '''
+    Returns the name a tag at the tagsdir-relative filepath is
+    stored under in a zipfile, which is the same on every platform.
+    '''
+    return PurePath(filepath).as_posix()
+
+
+def find_tag_file(handler, tag_path, ext, find_cache=None):
+    '''
+    Returns the tagsdir-relative filepath of the tag the windows-style
+    tag_path with the given extension points to, using the case of the
+    directories and file as they are on disk, or None if there isn't one.
+    If provided, find_cache is a dict used to memoize the results.
+    '''
+    key = (tag_path, ext)
+    if find_cache is not None and key in find_cache:
+        return find_cache[key]
+
+    tags_dir = str(handler.tagsdir)
+    win_path = PureWindowsPath(tag_path)
+    parts = win_path.parts
+
+    exts = (ext, )
+    if handler.treat_mode_as_mod2 and ext == '.model':
+        # gbxmodels are referenced as models in these tag sets
+        exts = ('.gbxmodel', ext)
+
+    filepath = None
+    for ext in exts:
+        if not parts or win_path.anchor:
+            break
+
+        # checking if the path exists as-is is far faster than searching
+        # case-insensitively, and will be the case for most references.
+        rel_filepath = os.path.join(*parts[: -1], parts[-1] + ext)
+        if os.path.isfile(os.path.join(tags_dir, rel_filepath)):
+            filepath = rel_filepath
+            break
+
+        full_path = find_tag_fullpath(handler.tagsdir, win_path, ext, True)
+        if full_path:
+            filepath = os.path.relpath(str(full_path), tags_dir)
+            break
+
+    if find_cache is not None:
+        find_cache[key] = filepath
+
+    return filepath
+
+
+def read_tag_dependencies(handler, filepath, tag=None, find_cache=None):
+    '''
+    Returns a list of (block_name, tag_path, ext, dependency_filepath)
+    tuples for each dependency in the tag at the tagsdir-relative filepath,
+    where dependency_filepath is what find_tag_file returns for it. If tag
+    is provided the references are read from it rather than from its file.
+    Returns None if the tag can't be read.
+    '''
+    try:
+        if tag is None:
+            def_id = handler.ext_id_map.get(
+                os.path.splitext(str(filepath))[-1].lower())
+            tag_refs = read_tag_file_refs(handler, filepath, def_id)
+        else:
+            tag_refs = get_tag_refs(handler, tag)
+
+        if tag_refs is None:
+            return None
+
+        return [(name, tag_path, ext,
+                 find_tag_file(handler, tag_path, ext, find_cache))
+                for name, tag_path, ext in tag_refs]
+    except Exception:
+        return None
+
+
+def _read_dependencies_in_worker(handler_info, filepaths):
+    global _worker_find_cache, _worker_find_handler
+    handler = get_worker_handler(*handler_info)
+    if _worker_find_handler is not handler:
+        _worker_find_handler = handler
+        _worker_find_cache = {}
+
+    return [read_tag_dependencies(handler, filepath,
+                                  find_cache=_worker_find_cache)
+            for filepath in filepaths]
+
+
+class DependencyClosure:
+    '''
+    The tags that a set of root tags depend on, directly or indirectly,
+    along with the root tags themselves. Every filepath in here is
+    relative to the tags directory.
+    '''
+    root_filepaths = ()
+    # maps the filepath of every tag in the closure to a list of its
+    # dependencies as read_tag_dependencies returns them, or to None
+    # if the tag could not be read.
+    dependencies = ()
+    # list of (filepath, block_name, tag_path) tuples for each reference
+    # to a tag that doesn't exist, sorted by filepath and then tag_path.
+    missing_refs = ()
+    # whether every tag was read, rather than being cancelled partway
+    finished = False
+
+    def __init__(self, root_filepaths):
+        self.root_filepaths = list(root_filepaths)
+        self.dependencies = {}
+        self.missing_refs = []
+
+    @property
+    def unreadable(self):
+        '''Sorted list of the filepaths of the tags that couldn't be read.'''
+        return sorted((filepath for filepath, dependencies in
+                       self.dependencies.items() if dependencies is None),
+                      key=get_arcname)
+
+    def get_sorted_filepaths(self, include_unreadable=False):
+        '''
+        Returns the filepaths of the tags in the closure sorted by their
+        arcname, so they are always written to archives in the same order.
+        '''
+        return sorted((filepath for filepath, dependencies in
+                       self.dependencies.items()
+                       if include_unreadable or dependencies is not None),
+                      key=get_arcname)
+
+
+def resolve_dependency_closure(handler, root_filepaths, process_count=1,
+                               get_tag=None, is_cancelled=None,
+                               chunk_size=CLOSURE_CHUNK_SIZE,
+                               poll_interval=0.5):
+    '''
+    Returns a DependencyClosure of the tags at the tagsdir-relative
+    root_filepaths. Each tag is only read once, no matter how many
+    tags reference it or what case the references to it are in.
+
+    If process_count is 1 the tags are read in this process, otherwise
+    they are read by a pool of that many worker processes(None means one
+    per cpu), and every tag found is sent to them as soon as it's found.
+    get_tag is an optional function that is given a filepath and returns
+    the tag if it is already loaded(ex: open in an editor with unsaved
+    edits), or None. Tags it returns are read in this process.
+
+    is_cancelled is an optional function taking no arguments. Once it
+    returns True the resolver stops and returns the closure so far with
+    its finished attribute set to False.
+    '''
+    closure = DependencyClosure(root_filepaths)
+    dependencies = closure.dependencies
+    find_cache = {}
+    seen = set()
+    pending = []
+
+    def add_filepath(filepath):
+        key = get_ref_key(filepath)
+        if key not in seen:
+            seen.add(key)
+            pending.append(filepath)
+
+    def add_dependencies(filepath, tag_dependencies):
+        dependencies[filepath] = tag_dependencies
+        for name, tag_path, ext, dependency_filepath in (
+                tag_dependencies or ()):
+            if dependency_filepath is None:
+                closure.missing_refs.append((filepath, name, tag_path + ext))
+            else:
+                add_filepath(dependency_filepath)
+
+    executor = None
+    if process_count != 1:
+        process_count = max(1, process_count or os.cpu_count() or 1)
+        executor = ProcessPoolExecutor(max_workers=process_count)
+        handler_info = get_worker_handler_info(handler)
+
+    for filepath in root_filepaths:
+        add_filepath(str(filepath))
+
+    # maps each running job to the filepaths it is reading
+    jobs = {}
+    try:
+        while pending or jobs:
+            if is_cancelled is not None and is_cancelled():
+                return closure
+
+            to_read = []
+            while pending:
+                filepath = pending.pop()
+                tag = None if get_tag is None else get_tag(filepath)
+                if tag is None and executor is not None:
+                    to_read.append(filepath)
+                    continue
+
+                add_dependencies(filepath, read_tag_dependencies(
+                    handler, filepath, tag, find_cache))
+                if is_cancelled is not None and is_cancelled():
+                    return closure
+
+            if to_read:
+                # split the frontier evenly when it's too small
+                # to give every worker process a full job.
+                size = min(chunk_size,
+                           -(-len(to_read) // process_count))
+                for i in range(0, len(to_read), size):
+                    filepaths = to_read[i: i + size]
+                    jobs[executor.submit(_read_dependencies_in_worker,
+                                         handler_info, filepaths)] = filepaths
+
+            if not jobs:
+                continue
+
+            done, _ = wait(jobs, poll_interval, FIRST_COMPLETED)
+            for job in done:
+                for filepath, tag_dependencies in zip(jobs.pop(job),
+                                                      job.result()):
+                    add_dependencies(filepath, tag_dependencies)
+
+        closure.finished = True
+    finally:
+        closure.missing_refs.sort(key=lambda ref: (
+            get_arcname(ref[0]), ref[2], ref[1]))
+        if executor is not None:
+            # if cancelled, dont wait for the remaining jobs to finish.
+            for job in jobs:
+                job.cancel()
+            executor.shutdown(wait=closure.finished)
+
+    return closure
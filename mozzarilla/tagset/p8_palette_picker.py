@@ -0,0 +1,85 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Palette pickers for converting bitmaps to P8-bump that use numpy to pick
+the palette index of every pixel at once.
+
+The P8Palette best fit pickers in reclaimer already look up each pixel's
+index in a table mapping every red/green pair to its closest palette
+color, but do so one pixel at a time in python, which is most of the time
+taken to convert large normal maps. These look up the same table for all
+pixels in one numpy operation, so the indexing they return is identical.
+If numpy isn't installed, the P8Palette's own pickers are used instead.
+'''
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the index given to pixels with no alpha when preserving transparency
+TRANSPARENT_INDEX = 255
+
+# maps id(p8_palette) to a (p8_palette, palette_map) tuple, where
+# palette_map is the P8Palette's palette_map as a numpy array
+_palette_maps = {}
+
+
+def get_palette_map(p8_palette):
+    '''
+    Returns the red/green to palette index table of the P8Palette as a
+    numpy array, loading or generating the table if it isn't yet.
+    '''
+    entry = _palette_maps.get(id(p8_palette))
+    if entry is not None and entry[0] is p8_palette:
+        return entry[1]
+
+    if not p8_palette.palette_map_loaded:
+        p8_palette.load_palette_map()
+
+    palette_map = numpy.array(p8_palette.palette_map, numpy.uint8)
+    _palette_maps[id(p8_palette)] = (p8_palette, palette_map)
+    return palette_map
+
+
+def pick_p8_indices(p8_palette, unpacked_pix, keep_alpha=False):
+    '''
+    Returns the palette of the P8Palette and an array of the index of
+    the closest palette color to each pixel in the unpacked ARGB pixels,
+    the same as the P8Palette's argb_array_to_p8_array_best_fit does.
+    If keep_alpha is True, pixels with no alpha are given the
+    transparent index, like argb_array_to_p8_array_best_fit_alpha.
+    '''
+    pixels = numpy.asarray(unpacked_pix)
+    pixels = pixels[: len(pixels) - len(pixels) % 4].reshape(-1, 4)
+    rg = pixels[:, 1].astype(numpy.intp) << 8
+    rg |= pixels[:, 2]
+
+    indexing = get_palette_map(p8_palette)[rg]
+    if keep_alpha:
+        indexing[pixels[:, 0] == 0] = TRANSPARENT_INDEX
+
+    return p8_palette.p8_palette_32bit, array("B", indexing.tobytes())
+
+
+def get_p8_palette_picker(p8_palette, keep_alpha=False, fast=True):
+    '''
+    Returns a function to give arbytmap as the palette_picker when
+    converting to P8-bump with the P8Palette. If fast is True and numpy
+    is installed, the picker is pick_p8_indices, otherwise it is the
+    P8Palette's best fit picker. Both give identical results.
+    '''
+    if fast and numpy is not None:
+        return lambda unpacked_pix: pick_p8_indices(
+            p8_palette, unpacked_pix, keep_alpha)
+    elif keep_alpha:
+        return p8_palette.argb_array_to_p8_array_best_fit_alpha
+    return p8_palette.argb_array_to_p8_array_best_fit
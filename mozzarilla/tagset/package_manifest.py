@@ -0,0 +1,132 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Manifests of the tags in a package, mapping the name each tag is stored
+under to a hash of its contents, so a later package can contain only the
+tags that changed since a previous one. Files are hashed in chunks on a
+pool of threads, since hashlib releases the GIL while hashing.
+'''
+
+import hashlib
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from traceback import format_exc
+
+MANIFEST_VERSION = 1
+MANIFEST_HASH_TYPE = "sha256"
+MANIFEST_EXT = ".manifest.json"
+
+# bytes of a file read and hashed at a time
+HASH_CHUNK_SIZE = 1024**2
+# most files hashed at once
+HASH_QUEUE_SIZE = 64
+
+
+def hash_file(filepath, hash_type=MANIFEST_HASH_TYPE,
+              chunk_size=HASH_CHUNK_SIZE):
+    '''Returns the hex digest of the file, read chunk_size bytes at a time.'''
+    hasher = hashlib.new(hash_type)
+    with open(str(filepath), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def hash_files(filepaths, thread_count=None, hash_type=MANIFEST_HASH_TYPE,
+               is_cancelled=None):
+    '''
+    Hashes the files at filepaths, a dict mapping the names to store them
+    under in the manifest to their filepaths, using thread_count threads
+    (None means one per cpu). Returns a dict mapping each name to its hash,
+    and a list of (filepath, error_text) tuples for the files that couldn't
+    be read. Returns None for both if is_cancelled returns True.
+    '''
+    hashes = {}
+    errors = []
+    to_hash = iter(filepaths.items())
+    jobs = {}
+    with ThreadPoolExecutor(
+            max_workers=max(1, thread_count or os.cpu_count() or 1)) as pool:
+        try:
+            while True:
+                # only queue a few files at a time so cancelling is quick
+                for name, filepath in to_hash:
+                    jobs[pool.submit(hash_file, filepath, hash_type)] = (
+                        name, filepath)
+                    if len(jobs) >= HASH_QUEUE_SIZE:
+                        break
+
+                if not jobs:
+                    break
+                elif is_cancelled is not None and is_cancelled():
+                    return None, None
+
+                done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+                for job in done:
+                    name, filepath = jobs.pop(job)
+                    try:
+                        hashes[name] = job.result()
+                    except Exception:
+                        errors.append((filepath, format_exc()))
+        finally:
+            for job in jobs:
+                job.cancel()
+
+    return hashes, errors
+
+
+def get_manifest_path(zip_filepath):
+    '''Returns the path of the manifest written next to the zipfile.'''
+    return os.path.splitext(str(zip_filepath))[0] + MANIFEST_EXT
+
+
+def load_manifest(filepath):
+    '''
+    Returns the dict of names to hashes in the manifest at filepath.
+    Raises ValueError if it isn't a manifest this can read.
+    '''
+    with open(str(filepath), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if (not isinstance(manifest, dict) or
+            not isinstance(manifest.get("files"), dict)):
+        raise ValueError("'%s' is not a tag package manifest." % filepath)
+    elif manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("'%s' is an unsupported manifest version." %
+                         filepath)
+    elif manifest.get("hash_type") != MANIFEST_HASH_TYPE:
+        raise ValueError("'%s' uses an unsupported hash type '%s'." %
+                         (filepath, manifest.get("hash_type")))
+
+    return manifest["files"]
+
+
+def save_manifest(filepath, hashes):
+    '''Writes the dict of names to hashes to a manifest at filepath.'''
+    manifest = dict(version=MANIFEST_VERSION, hash_type=MANIFEST_HASH_TYPE,
+                    files={name: hashes[name] for name in sorted(hashes)})
+    temp_filepath = str(filepath) + ".temp"
+    with open(temp_filepath, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+
+    os.replace(temp_filepath, str(filepath))
+
+
+def get_changed_names(hashes, old_hashes):
+    '''
+    Returns a sorted list of the names in hashes that aren't in old_hashes
+    or whose hash changed, and a sorted list of those only in old_hashes.
+    '''
+    changed = sorted(name for name, file_hash in hashes.items()
+                     if old_hashes.get(name) != file_hash)
+    removed = sorted(set(old_hashes).difference(hashes))
+    return changed, removed
@@ -0,0 +1,121 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Checks whether tag references point to existing tags on a background
+thread, so windows showing hundreds of references don't stall while
+each one is looked up in the tags directory.
+'''
+
+from collections import OrderedDict
+from pathlib import PureWindowsPath
+from queue import Queue, Empty
+from threading import Condition, Thread
+from traceback import format_exc
+
+from mozzarilla.tagset.tags_dir_index import find_tag_fullpath
+
+
+def find_ref_fullpath(tags_dir, tag_path, exts):
+    '''
+    Returns the full path of the tag the windows-style tag_path points
+    to in tags_dir, with the case it has on disk, trying each of the
+    extensions in exts in order. Returns None if none of them exist.
+    '''
+    for ext in exts:
+        filepath = find_tag_fullpath(tags_dir, PureWindowsPath(tag_path),
+                                     extension=ext)
+        if filepath is not None:
+            return filepath
+    return None
+
+
+class TagRefValidator:
+    '''
+    Looks up tag references on a daemon thread. Each request is made with
+    a key identifying what the result is for(ex: the widget showing the
+    reference) and a token the caller uses to recognize stale results.
+    A request replaces any request with the same key that hasn't started
+    being checked yet, so only the latest text typed into a field is
+    checked. Every request waiting when the thread wakes is checked as
+    one batch, with each distinct reference only looked up once.
+
+    Results are (key, token, filepath) tuples, where filepath is what
+    find_ref_fullpath returned. They are collected with get_results, so
+    the gui thread can apply them without being called from this one.
+    '''
+    _condition = None
+    # maps keys to (token, tags_dir, tag_path, exts) tuples
+    _requests = ()
+    _results = None
+    _stopped = False
+    _thread = None
+
+    def __init__(self):
+        self._condition = Condition()
+        self._requests = OrderedDict()
+        self._results = Queue()
+
+    def request(self, key, token, tags_dir, tag_path, exts):
+        with self._condition:
+            if self._stopped:
+                return
+
+            self._requests.pop(key, None)
+            self._requests[key] = (token, str(tags_dir), tag_path, tuple(exts))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            self._condition.notify()
+
+    def cancel(self, key):
+        '''Forgets the request for key if it hasn't started being checked.'''
+        with self._condition:
+            self._requests.pop(key, None)
+
+    def get_results(self):
+        '''Returns a list of every result that hasn't been collected yet.'''
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Empty:
+                return results
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._requests.clear()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._requests and not self._stopped:
+                    self._condition.wait()
+
+                if self._stopped:
+                    return
+
+                requests = self._requests
+                self._requests = OrderedDict()
+
+            found = {}
+            for key, (token, tags_dir, tag_path, exts) in requests.items():
+                lookup = (tags_dir, tag_path, exts)
+                if lookup not in found:
+                    try:
+                        found[lookup] = find_ref_fullpath(
+                            tags_dir, tag_path, exts)
+                    except Exception:
+                        print("Validation of a filepath failed unexpectedly.")
+                        print(format_exc())
+                        found[lookup] = None
+
+                self._results.put((key, token, found[lookup]))
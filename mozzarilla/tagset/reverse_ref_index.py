@@ -0,0 +1,247 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+A persisted index of which tags reference which, so the tags that
+reference a tag can be looked up without reading every tag again.
+'''
+
+import os
+import sqlite3
+
+from pathlib import Path, PureWindowsPath
+from threading import RLock
+from time import time
+from traceback import format_exc
+
+from mozzarilla.constants import REVERSE_REF_INDEX_PATH
+from mozzarilla.tagset.tag_scanner import read_tag_file_refs
+from mozzarilla.tagset.tags_dir_index import get_tags_dir_index
+
+# increment this whenever what gets indexed changes,
+# so indices made by older versions are rebuilt.
+REVERSE_REF_INDEX_VERSION = 1
+
+
+def get_ref_key(tag_path):
+    '''
+    Returns the key the index uses for a tag path with its extension.
+    Tag references are case insensitive and use windows separators,
+    so tag paths are converted to match.
+    '''
+    return str(PureWindowsPath(tag_path)).lower()
+
+
+class ReverseRefIndex:
+    '''
+    An on-disk index of the tag references of every tag in a single tags
+    directory for a single handler type. Updating only reads the tags
+    whose size or modification time changed since they were indexed, and
+    forgets the tags that were deleted. Lookups are done in the database,
+    so they don't need the whole index in memory.
+    '''
+    filepath = None
+    handler = None
+    tags_dir = ""
+    handler_name = ""
+
+    _connection = None
+    _lock = None
+    # maps indexed filepath strings to their (size, mtime)
+    _stats = ()
+
+    def __init__(self, handler, filepath=REVERSE_REF_INDEX_PATH):
+        self.filepath = Path(filepath)
+        self.handler = handler
+        self.tags_dir = str(handler.tagsdir)
+        self.handler_name = type(handler).__name__
+        self._lock = RLock()
+        self._stats = {}
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        # lookups are done from the gui thread while updates are done
+        # from a worker thread, so access is serialized with the lock.
+        self._connection = sqlite3.connect(
+            str(self.filepath), check_same_thread=False)
+        self._create_tables()
+        self.load()
+
+    def _create_tables(self):
+        cur = self._connection.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS index_info "
+                    "(name TEXT PRIMARY KEY, value TEXT)")
+        cur.execute("SELECT value FROM index_info WHERE name = 'version'")
+        row = cur.fetchone()
+        if row is None or row[0] != str(REVERSE_REF_INDEX_VERSION):
+            cur.execute("DROP TABLE IF EXISTS indexed_tags")
+            cur.execute("DROP TABLE IF EXISTS tag_refs")
+            cur.execute("INSERT OR REPLACE INTO index_info VALUES "
+                        "('version', ?)", (str(REVERSE_REF_INDEX_VERSION), ))
+
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS indexed_tags ("
+            "tags_dir TEXT, handler TEXT, filepath TEXT, "
+            "size INTEGER, mtime INTEGER, "
+            "PRIMARY KEY (tags_dir, handler, filepath))")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS tag_refs ("
+            "tags_dir TEXT, handler TEXT, filepath TEXT, "
+            "block_name TEXT, ref_key TEXT)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS tag_refs_by_ref_key "
+            "ON tag_refs (tags_dir, handler, ref_key)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS tag_refs_by_filepath "
+            "ON tag_refs (tags_dir, handler, filepath)")
+        self._connection.commit()
+
+    def load(self):
+        '''Reads which tags are indexed, and the stats they were indexed at.'''
+        with self._lock:
+            self._stats.clear()
+            cur = self._connection.execute(
+                "SELECT filepath, size, mtime FROM indexed_tags "
+                "WHERE tags_dir = ? AND handler = ?",
+                (self.tags_dir, self.handler_name))
+            for filepath, size, mtime in cur:
+                self._stats[filepath] = (size, mtime)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def update(self, is_cancelled=None, print_interval=5):
+        '''
+        Indexes every tag in the tags directory that changed since it was
+        last indexed, and forgets every indexed tag that no longer exists.
+        Changes are committed as they are made, so cancelling(when
+        is_cancelled returns True) keeps whatever was indexed so far.
+        Returns whether or not the update finished.
+        '''
+        handler = self.handler
+        def_ids = set(handler.tag_ref_cache)
+        exts = [ext for ext, def_id in handler.ext_id_map.items()
+                if def_id in def_ids]
+
+        index = get_tags_dir_index(self.tags_dir)
+        if not index.refresh(self.tags_dir, is_cancelled):
+            return False
+
+        prefix_len = len(index.get_rel_dir(self.tags_dir))
+        if prefix_len:
+            prefix_len += len(os.sep)
+
+        tag_paths = []
+        for rel_filepath, _, __ in index.iter_files(exts, self.tags_dir):
+            tag_paths.append(rel_filepath[prefix_len:])
+
+        with self._lock:
+            deleted = set(self._stats).difference(tag_paths)
+            if deleted:
+                self._remove_tags(deleted)
+                self._connection.commit()
+
+        c_time = time()
+        changed_count = 0
+        for filepath in tag_paths:
+            if is_cancelled is not None and is_cancelled():
+                with self._lock:
+                    self._connection.commit()
+                return False
+
+            try:
+                stat = os.stat(os.path.join(self.tags_dir, filepath))
+                stat = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+
+            if self._stats.get(filepath) == stat:
+                continue
+
+            def_id = handler.ext_id_map.get(
+                os.path.splitext(filepath)[-1].lower())
+            tag_refs = read_tag_file_refs(handler, filepath, def_id)
+            if tag_refs is None:
+                print("    Could not read '%s'" % filepath)
+                tag_refs = ()
+
+            with self._lock:
+                self._remove_tags((filepath, ))
+                self._add_tag(filepath, stat, tag_refs)
+                changed_count += 1
+                if time() - c_time > print_interval:
+                    # commit every so often so cancelling loses little
+                    self._connection.commit()
+                    c_time = time()
+                    print("    Indexed %s tags" % changed_count)
+
+        with self._lock:
+            self._connection.commit()
+
+        return True
+
+    def _add_tag(self, filepath, stat, tag_refs):
+        key = (self.tags_dir, self.handler_name, filepath)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO indexed_tags VALUES (?, ?, ?, ?, ?)",
+            key + stat)
+        self._connection.executemany(
+            "INSERT INTO tag_refs VALUES (?, ?, ?, ?, ?)",
+            (key + (block_name, get_ref_key(tag_path + ext))
+             for block_name, tag_path, ext in tag_refs))
+        self._stats[filepath] = stat
+
+    def _remove_tags(self, filepaths):
+        keys = [(self.tags_dir, self.handler_name, filepath)
+                for filepath in filepaths]
+        self._connection.executemany(
+            "DELETE FROM indexed_tags WHERE tags_dir = ? "
+            "AND handler = ? AND filepath = ?", keys)
+        self._connection.executemany(
+            "DELETE FROM tag_refs WHERE tags_dir = ? "
+            "AND handler = ? AND filepath = ?", keys)
+        for filepath in filepaths:
+            self._stats.pop(filepath, None)
+
+    def get_referencing_tags(self, tag_path):
+        '''
+        Returns a sorted list of (filepath, block_name) tuples for each
+        reference to the tagsdir-relative tag_path(including extension)
+        by an indexed tag. filepath is the tagsdir-relative filepath of
+        the referencing tag, and block_name is the name of the reference.
+        '''
+        ref_keys = [get_ref_key(tag_path)]
+        base, ext = os.path.splitext(ref_keys[0])
+        if self.handler.treat_mode_as_mod2 and ext == ".gbxmodel":
+            # gbxmodels are referenced as models in these tag sets
+            ref_keys.append(base + ".model")
+
+        referencing_tags = set()
+        with self._lock:
+            for ref_key in ref_keys:
+                referencing_tags.update(self._connection.execute(
+                    "SELECT filepath, block_name FROM tag_refs "
+                    "WHERE tags_dir = ? AND handler = ? AND ref_key = ?",
+                    (self.tags_dir, self.handler_name, ref_key)))
+
+        return sorted(referencing_tags)
+
+
+def open_reverse_ref_index(handler, filepath=REVERSE_REF_INDEX_PATH):
+    '''
+    Returns a ReverseRefIndex for the handler's tags directory,
+    or None if it could not be opened.
+    '''
+    try:
+        return ReverseRefIndex(handler, filepath)
+    except Exception:
+        print(format_exc())
+        print("Could not open the reverse dependency index.")
+        return None
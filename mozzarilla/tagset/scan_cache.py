@@ -0,0 +1,222 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import json
+import os
+import sqlite3
+
+from pathlib import Path
+from traceback import format_exc
+
+from mozzarilla.constants import TAG_SCAN_CACHE_PATH
+from mozzarilla.tagset.tag_rules import get_rules_signature
+from mozzarilla.tagset.tag_scanner import TagScanResult, get_missing_refs
+
+# increment this whenever what gets scanned for changes,
+# so results made by older versions aren't reused.
+SCAN_CACHE_VERSION = 2
+
+
+class TagScanCache:
+    '''
+    An on-disk cache of tag scan results for a single tags directory
+    and handler type. Each result is keyed by its tagsdir-relative
+    filepath and is only reused while the size and modification time
+    of its file are unchanged.
+
+    Since whether or not a reference is broken depends on other tags,
+    every reference is cached and missing_refs is recalculated on load.
+    Results are also not reused if the tag rules registered for their
+    tag type have changed since they were cached.
+    '''
+    filepath = None
+    handler = None
+    tags_dir = ""
+    handler_name = ""
+
+    _connection = None
+    # maps filepath strings to
+    # (def_id, size, mtime, tag_refs, errors, rules_signature)
+    _entries = ()
+    # maps filepath strings to (size, mtime) of the file when last checked
+    _stats = ()
+    _changed = ()
+    _deleted = ()
+
+    def __init__(self, handler, filepath=TAG_SCAN_CACHE_PATH):
+        self.filepath = Path(filepath)
+        self.handler = handler
+        self.tags_dir = str(handler.tagsdir)
+        self.handler_name = type(handler).__name__
+
+        self._entries = {}
+        self._stats = {}
+        self._changed = set()
+        self._deleted = set()
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.filepath))
+        self._create_tables()
+        self.load()
+
+    def _create_tables(self):
+        cur = self._connection.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS cache_info "
+                    "(name TEXT PRIMARY KEY, value TEXT)")
+        cur.execute("SELECT value FROM cache_info WHERE name = 'version'")
+        row = cur.fetchone()
+        if row is None or row[0] != str(SCAN_CACHE_VERSION):
+            cur.execute("DROP TABLE IF EXISTS scan_results")
+            cur.execute("INSERT OR REPLACE INTO cache_info VALUES "
+                        "('version', ?)", (str(SCAN_CACHE_VERSION), ))
+
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS scan_results ("
+            "tags_dir TEXT, handler TEXT, filepath TEXT, def_id TEXT, "
+            "size INTEGER, mtime INTEGER, tag_refs TEXT, errors TEXT, "
+            "rules TEXT, PRIMARY KEY (tags_dir, handler, filepath))")
+        self._connection.commit()
+
+    def load(self):
+        '''Reads every cached result for this tags directory and handler.'''
+        self._entries.clear()
+        self._changed.clear()
+        self._deleted.clear()
+        cur = self._connection.execute(
+            "SELECT filepath, def_id, size, mtime, tag_refs, errors, rules "
+            "FROM scan_results WHERE tags_dir = ? AND handler = ?",
+            (self.tags_dir, self.handler_name))
+
+        for row in cur:
+            self._entries[row[0]] = row[1:]
+
+    def save(self):
+        '''Writes every result added or removed since the last save.'''
+        key = (self.tags_dir, self.handler_name)
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM scan_results WHERE tags_dir = ? "
+                "AND handler = ? AND filepath = ?",
+                (key + (filepath, ) for filepath in self._deleted))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO scan_results "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key + (filepath, ) + self._entries[filepath]
+                 for filepath in self._changed))
+
+        self._changed.clear()
+        self._deleted.clear()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_stat(self, filepath):
+        '''
+        Returns a (size, mtime) tuple for the tagsdir-relative filepath,
+        or None if the file can't be accessed.
+        '''
+        key = str(filepath)
+        if key not in self._stats:
+            try:
+                stat = os.stat(os.path.join(self.tags_dir, key))
+                self._stats[key] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                self._stats[key] = None
+
+        return self._stats[key]
+
+    def get_result(self, filepath, def_id, exists_cache=None):
+        '''
+        Returns the cached TagScanResult for the tag at the tagsdir-relative
+        filepath, or None if it isn't cached or its file has changed.
+        exists_cache is passed along to tag_ref_exists.
+        '''
+        key = str(filepath)
+        # always stat the file so add_result uses the size and mtime
+        # from before the tag was scanned, rather than after.
+        stat = self.get_stat(key)
+        entry = self._entries.get(key)
+        if (entry is None or entry[0] != def_id or stat != entry[1: 3] or
+                entry[5] != get_rules_signature(def_id)):
+            return None
+
+        result = TagScanResult(filepath, def_id)
+        result.loaded = True
+        result.cached = True
+        result.tag_refs = [tuple(ref) for ref in json.loads(entry[3])]
+        result.specific_errors = entry[4]
+        result.missing_refs = get_missing_refs(
+            self.handler, result.tag_refs, exists_cache)
+        return result
+
+    def add_result(self, result):
+        '''
+        Caches the TagScanResult. Results for tags that couldn't be
+        loaded or scanned are not cached, so they are retried next time.
+        '''
+        key = str(result.filepath)
+        stat = self.get_stat(key)
+        if not result.loaded or result.scan_error or stat is None:
+            return
+
+        self._entries[key] = (result.def_id, stat[0], stat[1],
+                              json.dumps(result.tag_refs),
+                              result.specific_errors,
+                              get_rules_signature(result.def_id))
+        self._changed.add(key)
+        self._deleted.discard(key)
+
+    def remove_missing(self, rel_dirpath, tag_paths_by_def_id):
+        '''
+        Removes the cached results for tags of the def_ids in
+        tag_paths_by_def_id that are inside the tagsdir-relative
+        rel_dirpath, but that aren't in tag_paths_by_def_id.
+        Used to forget tags that have been deleted since the last scan.
+        '''
+        def_ids = set(tag_paths_by_def_id)
+        filepaths = set(str(fp) for tag_paths in tag_paths_by_def_id.values()
+                        for fp in tag_paths)
+        rel_dirpath = str(rel_dirpath)
+        prefix = os.path.join(rel_dirpath, "")
+        if rel_dirpath in ("", "."):
+            prefix = ""
+
+        for key, entry in tuple(self._entries.items()):
+            if (entry[0] in def_ids and key.startswith(prefix) and
+                    key not in filepaths):
+                del self._entries[key]
+                self._changed.discard(key)
+                self._deleted.add(key)
+
+    def split_tag_paths(self, tag_paths_by_def_id, exists_cache=None):
+        '''
+        Splits tag_paths_by_def_id into the tags that need to be scanned
+        and the tags whose results are cached. Returns a tuple containing
+        a dict of uncached tag paths in the same form as tag_paths_by_def_id,
+        and a dict mapping each cached tag's filepath to its TagScanResult.
+        '''
+        uncached_tag_paths = {}
+        cached_results = {}
+        for def_id, tag_paths in tag_paths_by_def_id.items():
+            uncached_tag_paths[def_id] = uncached = []
+            for filepath in tag_paths:
+                try:
+                    result = self.get_result(filepath, def_id, exists_cache)
+                except Exception:
+                    print(format_exc())
+                    result = None
+
+                if result is None:
+                    uncached.append(filepath)
+                else:
+                    cached_results[filepath] = result
+
+        return uncached_tag_paths, cached_results
@@ -0,0 +1,250 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Timing, throughput and memory counters for tag scans, so changes in
+where the time goes can be compared between scans and releases.
+'''
+
+import json
+import sys
+
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+
+from mozzarilla.tagset.tag_rules import add_rule_times, format_rule_times
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the stages of a scan, in the order they happen
+SCAN_STAGES = ("locate", "parse", "refs", "rules", "write")
+STAGE_NAMES = {
+    "locate": "directory walk",
+    "parse":  "tag parsing",
+    "refs":   "reference resolution",
+    "rules":  "tag specific rules",
+    "write":  "log writing",
+    }
+
+# increment this whenever the layout of the json metrics changes
+SCAN_METRICS_VERSION = 1
+
+
+def get_peak_rss(children=False):
+    '''
+    Returns the peak resident set size of this process(or of its
+    finished child processes if children is True) in bytes, or None
+    if it can't be determined on this platform.
+    '''
+    if resource is not None:
+        peak = resource.getrusage(
+            resource.RUSAGE_CHILDREN if children else
+            resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, while macos reports bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    elif children or sys.platform != "win32":
+        return None
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        get_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_process.restype = wintypes.HANDLE
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                get_process(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except Exception:
+        pass
+
+    return None
+
+
+class ScanMetrics:
+    '''
+    Collects how long each stage of a scan took, both in total and for
+    each def_id, along with how many tags were scanned or reused from
+    the scan cache, the scan's throughput, and its peak memory usage.
+
+    The parse, refs and rules stages are taken from the stage_times of
+    each TagScanResult, so when scanning with multiple processes they
+    are the sum of the time spent by every process, and can add up to
+    more than the time the scan took.
+    '''
+    process_count = 1
+    start_time = 0.0
+    end_time = None
+    finished = False
+    peak_rss = None
+    peak_child_rss = None
+
+    # maps each stage to the total seconds spent in it
+    stage_times = ()
+    # maps each def_id to a dict with "tags", "cached", "problems"
+    # counts and the seconds spent in each stage for that def_id
+    def_id_stats = ()
+    # rule times in the form add_rule_times collects them in
+    rule_times = ()
+
+    def __init__(self, process_count=1):
+        self.process_count = process_count
+        self.stage_times = {stage: 0.0 for stage in SCAN_STAGES}
+        self.def_id_stats = {}
+        self.rule_times = {}
+        self.start_time = perf_counter()
+
+    def _get_def_id_stats(self, def_id):
+        stats = self.def_id_stats.get(def_id)
+        if stats is None:
+            stats = self.def_id_stats[def_id] = dict(
+                tags=0, cached=0, problems=0)
+            stats.update((stage, 0.0) for stage in SCAN_STAGES)
+        return stats
+
+    def add_stage_time(self, stage, seconds, def_id=None):
+        self.stage_times[stage] += seconds
+        if def_id is not None:
+            self._get_def_id_stats(def_id)[stage] += seconds
+
+    @contextmanager
+    def time_stage(self, stage, def_id=None):
+        '''Context manager that adds the time spent inside it to stage.'''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, perf_counter() - start, def_id)
+
+    def add_result(self, result):
+        '''Adds the counts and stage times of a TagScanResult.'''
+        stats = self._get_def_id_stats(result.def_id)
+        stats["tags"] += 1
+        if result.cached:
+            stats["cached"] += 1
+        if result.has_problems:
+            stats["problems"] += 1
+
+        for stage, seconds in result.stage_times.items():
+            self.add_stage_time(stage, seconds, result.def_id)
+
+        add_rule_times(self.rule_times, result.def_id, result.rule_times)
+
+    def finish(self, finished=True):
+        '''Stops the clock and records the peak memory usage.'''
+        self.end_time = perf_counter()
+        self.finished = finished
+        self.peak_rss = get_peak_rss()
+        if self.process_count != 1:
+            self.peak_child_rss = get_peak_rss(True)
+
+    @property
+    def elapsed(self):
+        end_time = self.end_time
+        if end_time is None:
+            end_time = perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def tag_count(self):
+        return sum(stats["tags"] for stats in self.def_id_stats.values())
+
+    @property
+    def cached_count(self):
+        return sum(stats["cached"] for stats in self.def_id_stats.values())
+
+    @property
+    def tags_per_second(self):
+        elapsed = self.elapsed
+        return self.tag_count / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        '''Returns the metrics as a dict that can be serialized to json.'''
+        return dict(
+            version=SCAN_METRICS_VERSION,
+            finished=self.finished,
+            process_count=self.process_count,
+            elapsed=self.elapsed,
+            tag_count=self.tag_count,
+            cached_count=self.cached_count,
+            tags_per_second=self.tags_per_second,
+            peak_rss=self.peak_rss,
+            peak_child_rss=self.peak_child_rss,
+            stage_times=dict(self.stage_times),
+            def_ids={def_id: dict(stats) for def_id, stats in
+                     sorted(self.def_id_stats.items())},
+            rules=[dict(def_id=def_id, name=name, count=count,
+                        seconds=seconds)
+                   for (def_id, name), (count, seconds) in
+                   sorted(self.rule_times.items())],
+            )
+
+    def write_json(self, filepath):
+        filepath = Path(filepath)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with filepath.open("w", encoding="utf-8", newline="\n") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def format_summary(self):
+        '''Returns a human readable summary of the metrics.'''
+        lines = [
+            "Scanned %s tags(%s unchanged since the last scan) in %.2f "
+            "seconds using %s processes. %.1f tags/sec." % (
+                self.tag_count, self.cached_count, self.elapsed,
+                self.process_count or "all", self.tags_per_second)]
+
+        for name, peak in (("this process", self.peak_rss),
+                           ("the largest worker process",
+                            self.peak_child_rss)):
+            if peak is not None:
+                lines.append("Peak memory usage of %s: %.1f MiB" % (
+                    name, peak / 1024**2))
+
+        lines.append("")
+        lines.append("%-24s%12s" % ("Time spent in", "seconds"))
+        for stage in SCAN_STAGES:
+            lines.append("    %-20s%12.3f" % (
+                STAGE_NAMES[stage], self.stage_times[stage]))
+
+        if self.def_id_stats:
+            lines.append("")
+            lines.append("%-8s%8s%8s%9s" % ("tag type", "tags", "cached",
+                                            "problems") +
+                         "".join("%10s" % stage for stage in SCAN_STAGES[1:]))
+            for def_id, stats in sorted(self.def_id_stats.items()):
+                lines.append(
+                    "%-8s%8s%8s%9s" % (def_id, stats["tags"], stats["cached"],
+                                       stats["problems"]) +
+                    "".join("%10.3f" % stats[stage]
+                            for stage in SCAN_STAGES[1:]))
+
+        if self.rule_times:
+            lines.append("")
+            lines.append(format_rule_times(self.rule_times))
+
+        return "\n".join(lines)
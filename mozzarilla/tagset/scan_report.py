@@ -0,0 +1,260 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Writers that stream tag scan results to a report as each tag is scanned,
+rather than building the whole report in memory and writing it at the end.
+Whatever was written before a scan is cancelled or crashes is kept.
+'''
+
+import json
+
+from pathlib import Path
+from tempfile import TemporaryFile
+
+
+class ScanReportWriter:
+    '''
+    Base class for the scan report writers. output is either a filepath
+    to open, or an already open text file(such as sys.stdout), which
+    will be flushed instead of closed when the writer is closed.
+
+    Call add_result with each TagScanResult, and close when done. close
+    is passed whether or not the scan finished, so the report can say
+    so. Using the writer as a context manager closes it automatically.
+    '''
+    # mode to open output filepaths with
+    file_mode = "w"
+    # whether or not to write records for tags without problems
+    problems_only = False
+
+    filepath = None
+    tags_dir = ""
+    scan_dir = ""
+    tag_count = 0
+    problem_count = 0
+    metrics = None
+
+    _file = None
+    _owns_file = False
+
+    def __init__(self, output, tags_dir="", scan_dir="", **kwargs):
+        self.tags_dir = str(tags_dir)
+        self.scan_dir = str(scan_dir)
+        self.problems_only = kwargs.pop("problems_only", self.problems_only)
+
+        if hasattr(output, "write"):
+            self._file = output
+        else:
+            self.filepath = Path(output)
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.filepath.open(
+                self.file_mode, encoding="utf-8", newline="\n")
+            self._owns_file = True
+
+        self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, except_type, except_value, traceback):
+        self.close(except_type is None)
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def add_result(self, result):
+        self.tag_count += 1
+        if result.has_problems:
+            self.problem_count += 1
+        elif self.problems_only:
+            return
+
+        self.write_result(result)
+
+    def close(self, finished=True, metrics=None):
+        '''
+        Writes the end of the report and closes the file. finished
+        is whether or not every tag being scanned was added. metrics
+        is an optional ScanMetrics to write a summary of in the report.
+        '''
+        if self._file is None:
+            return
+
+        self.metrics = metrics
+        try:
+            self.write_footer(finished)
+        finally:
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+            self._file = None
+
+    def write_header(self):
+        pass
+
+    def write_result(self, result):
+        raise NotImplementedError()
+
+    def write_footer(self, finished):
+        pass
+
+
+class TextScanReportWriter(ScanReportWriter):
+    '''
+    Writes the human readable report the Tag Scanner has always written.
+    Broken dependencies are written as they are found. Tag specific errors
+    are listed after them grouped by tag type, so as they are found they
+    are written to a ".errors" file next to the log, which is appended to
+    the log and deleted when the report is closed. If the scan crashes,
+    that file is left behind with them in it. When not writing to a
+    filepath, they are spooled to a temporary file and only written
+    when the report is closed.
+    '''
+    # logs are appended to, so previous scans aren't overwritten
+    file_mode = "a"
+    problems_only = True
+    log_name = "HEK Tag Scanner log"
+
+    # path of the file tag specific errors are written to as they're found
+    errors_filepath = None
+    # each line of it is a JSON [def_id, filepath, specific_errors] list
+    _errors_file = None
+    # the def_ids of the tags written to the errors file
+    _specific_error_def_ids = ()
+
+    def __init__(self, *args, **kwargs):
+        self._specific_error_def_ids = set()
+        ScanReportWriter.__init__(self, *args, **kwargs)
+
+    def write_header(self):
+        self._file.write("\n%s%s%s\n\n" % (
+            "-"*30, self.log_name, "-" * (50-len(self.log_name))))
+        self._file.write("tags directory = %s\nscan directory = %s\n\n" % (
+            self.tags_dir, self.scan_dir))
+        self._file.write("Broken dependencies are listed below.\n")
+        self._file.flush()
+
+    def get_errors_file(self):
+        if self._errors_file is not None:
+            return self._errors_file
+        elif self.filepath is None:
+            self._errors_file = TemporaryFile(
+                "w+", encoding="utf-8", newline="\n")
+        else:
+            self.errors_filepath = self.filepath.with_name(
+                self.filepath.name + ".errors")
+            self._errors_file = self.errors_filepath.open(
+                "w+", encoding="utf-8", newline="\n")
+        return self._errors_file
+
+    def write_result(self, result):
+        if not result.loaded or result.scan_error:
+            return
+
+        if result.specific_errors:
+            errors_file = self.get_errors_file()
+            errors_file.write(json.dumps([
+                result.def_id, str(result.filepath),
+                result.specific_errors]) + "\n")
+            errors_file.flush()
+            self._specific_error_def_ids.add(result.def_id)
+
+        if not result.missing_refs:
+            return
+
+        lines = ["\n\n%s\n" % result.filepath]
+        block_name = None
+        for name, tag_path in result.missing_refs:
+            if name != block_name:
+                lines.append('%s%s\n' % (' '*4, name))
+                block_name = name
+            lines.append('%s%s\n' % (' '*8, tag_path))
+
+        self._file.write("".join(lines))
+        self._file.flush()
+
+    def write_footer(self, finished):
+        errors_file = self._errors_file
+        written = False
+        try:
+            if not finished:
+                self._file.write(
+                    "\nScan did not finish. Only the tags scanned before "
+                    "it stopped are listed.\n")
+
+            if self._specific_error_def_ids:
+                self._file.write("\nTag specific errors are listed below.\n")
+
+            # the errors file is read through once per tag type so
+            # the errors don't all need to be held in memory at once.
+            for def_id in sorted(self._specific_error_def_ids):
+                errors_file.seek(0)
+                self._file.write("\n\n%s specific errors:\n" % def_id)
+                for line in errors_file:
+                    tag_def_id, filepath, specific_errors = json.loads(line)
+                    if tag_def_id == def_id:
+                        self._file.write("\n%s\n%s\n" % (
+                            filepath, specific_errors))
+
+            if self.metrics is not None:
+                self._file.write("\n\nScan metrics:\n%s\n" %
+                                 self.metrics.format_summary())
+
+            self._file.flush()
+            written = True
+        finally:
+            if errors_file is not None:
+                errors_file.close()
+            self._errors_file = None
+            self._specific_error_def_ids.clear()
+
+        # everything in the errors file is in the log now
+        if written and self.errors_filepath is not None:
+            self.errors_filepath.unlink()
+
+
+class JsonlScanReportWriter(ScanReportWriter):
+    '''
+    Writes each result as a JSON object on its own line. Since every
+    line is a complete record, the file is usable even if the scan
+    never finished.
+    '''
+    def write_result(self, result):
+        self._file.write(json.dumps(result.to_dict()) + "\n")
+        if result.has_problems:
+            self._file.flush()
+
+
+class JsonScanReportWriter(ScanReportWriter):
+    '''
+    Writes every result to a "tags" array in a single JSON document,
+    along with the directories scanned and how many tags had problems.
+    The document is completed even if the scan is cancelled.
+    '''
+    _record_count = 0
+
+    def write_header(self):
+        self._file.write('{"tags_dir": %s, "scan_dir": %s, "tags": [' % (
+            json.dumps(self.tags_dir), json.dumps(self.scan_dir)))
+
+    def write_result(self, result):
+        self._file.write("\n  " if self._record_count == 0 else ",\n  ")
+        self._file.write(json.dumps(result.to_dict()))
+        self._record_count += 1
+
+    def write_footer(self, finished):
+        self._file.write(
+            '\n  ], "finished": %s, "tag_count": %s, "problem_count": %s' %
+            (json.dumps(bool(finished)), self.tag_count, self.problem_count))
+        if self.metrics is not None:
+            self._file.write(', "metrics": %s' %
+                             json.dumps(self.metrics.to_dict()))
+        self._file.write('}\n')
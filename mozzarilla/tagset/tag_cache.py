@@ -0,0 +1,159 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+A memory bounded cache for tags that batch tools load only to read them,
+so processing a whole tags directory doesn't keep every tag in memory.
+'''
+
+import os
+
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+from supyr_struct.util import path_normalize
+
+# how many bytes of memory a parsed tag is assumed to take up for each
+# byte of its file. tags made mostly of blocks take around ten times their
+# file size, while tags made mostly of raw data take around the same size,
+# so this errs on the side of keeping fewer tags than the budget allows.
+TAG_MEMORY_FACTOR = 10
+DEFAULT_MEMORY_BUDGET = 256 * 1024**2
+
+
+def estimate_tag_memory(file_size):
+    return file_size * TAG_MEMORY_FACTOR
+
+
+class BatchTagCache:
+    '''
+    Loads tags for batch tools without adding them to the handler, and
+    keeps the most recently used ones while their estimated size fits
+    within memory_budget bytes. A memory_budget of 0 keeps no tags, so
+    each tag is released as soon as the tool is done with it.
+
+    Tags already loaded in the handler are returned as they are in memory
+    and are never cached here, so tags open in an editor are never evicted.
+    is_tag_open may be a function that takes a tag and returns whether it's
+    open in an editor, in which case cached tags that get opened are kept
+    until they are closed, even if the cache is over budget.
+    '''
+    handler = None
+    memory_budget = DEFAULT_MEMORY_BUDGET
+    memory_used = 0
+    is_tag_open = None
+
+    hits = 0
+    misses = 0
+
+    _lock = None
+    # maps normalized filepaths to [tag, estimated_size, (size, mtime)]
+    _tags = ()
+
+    def __init__(self, handler, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 is_tag_open=None):
+        self.handler = handler
+        self.memory_budget = max(0, memory_budget)
+        self.is_tag_open = is_tag_open
+        self._lock = Lock()
+        self._tags = OrderedDict()
+
+    def __len__(self):
+        return len(self._tags)
+
+    def get_tag(self, filepath, def_id=None):
+        '''
+        Returns the tag at the tagsdir-relative(or absolute) filepath,
+        or None if it can't be loaded. Tags loaded in the handler are
+        returned first, then tags in this cache, and then the tag is
+        loaded from its file and cached if it fits in the budget.
+        '''
+        handler = self.handler
+        if def_id is None:
+            def_id = handler.get_def_id(filepath)
+
+        try:
+            return handler.get_tag(filepath, def_id)
+        except (KeyError, LookupError):
+            pass
+
+        full_path = Path(path_normalize(handler.tagsdir.joinpath(filepath)))
+        try:
+            stat = os.stat(str(full_path))
+            stat = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return None
+
+        key = str(full_path)
+        with self._lock:
+            entry = self._tags.get(key)
+            if entry is not None and entry[2] == stat:
+                self._tags.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            elif entry is not None:
+                # the file changed since it was cached
+                self._remove(key)
+
+            self.misses += 1
+
+        try:
+            tag = handler.build_tag(filepath=full_path, def_id=def_id)
+        except Exception:
+            return None
+
+        if tag is None:
+            return None
+
+        size = estimate_tag_memory(stat[0])
+        if size > self.memory_budget:
+            # too large to ever fit, so let it be released after use
+            return tag
+
+        with self._lock:
+            self._remove(key)
+            self._tags[key] = [tag, size, stat]
+            self.memory_used += size
+            self._evict(self.memory_budget)
+
+        return tag
+
+    def set_memory_budget(self, memory_budget):
+        with self._lock:
+            self.memory_budget = max(0, memory_budget)
+            self._evict(self.memory_budget)
+
+    def evict(self, memory_target=0):
+        '''
+        Releases the least recently used tags until the estimated memory
+        used by the cache is no more than memory_target bytes.
+        '''
+        with self._lock:
+            self._evict(memory_target)
+
+    def clear(self):
+        self.evict(0)
+
+    def _remove(self, key):
+        entry = self._tags.pop(key, None)
+        if entry is not None:
+            self.memory_used -= entry[1]
+
+    def _evict(self, memory_target):
+        if self.memory_used <= memory_target:
+            return
+
+        is_tag_open = self.is_tag_open
+        for key in list(self._tags):
+            if self.memory_used <= memory_target:
+                break
+            elif is_tag_open is not None and is_tag_open(self._tags[key][0]):
+                continue
+
+            self._remove(key)
@@ -0,0 +1,539 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Reads the tag references out of tag files without building the tags.
+
+Building a tag parses every field and copies every rawdata block into
+memory, which is most of the work when all that's needed is the few
+dependency blocks in it. TagRefReader instead walks the tag definition's
+descriptor to find where each block is in the file, and only reads the
+reflexive counts and rawdata sizes needed to do so, along with the tag
+references themselves. Reflexives that can't contain any references or
+nested blocks are skipped over without reading their contents at all.
+
+Files are read using mmap, so the parts of the file that are skipped
+are never read from disk. If a descriptor uses anything this can't read
+without building the tag, UnsupportedTagDefError is raised and the tag
+should be built normally instead.
+'''
+
+import mmap
+import os
+
+from reclaimer.common_descs import tag_ref_str_size
+from reclaimer.field_types import TagRef
+
+# the name enum_name returns for a value that isn't a valid option
+INVALID_ENUM_NAME = "<INVALID>"
+
+# maps id(handler) to a (handler, {def_id: TagRefReader}) tuple
+_handler_readers = {}
+# maps id(handler) to a (handler, {def_id: name plan}) tuple
+_handler_name_plans = {}
+
+
+class UnsupportedTagDefError(Exception):
+    pass
+
+
+class BlockPlan:
+    '''
+    What TagRefReader needs to know to walk over a struct descriptor.
+    children is a list of (offset, desc, index) tuples for each field
+    that contains nested blocks. steptree_size is a (offset, unpacker, byte_size)
+    tuple for the field in the struct that holds the STEPTREE's size,
+    or an int if the size is fixed.
+    '''
+    size = 0
+    children = ()
+    steptree = None
+    steptree_key = None
+    steptree_size = None
+    is_tag_ref_str = False
+
+    # (offset, unpacker, byte_size) for the tag_class field of tag refs
+    tag_class = None
+    tag_class_desc = None
+
+
+class TagRefReader:
+    '''
+    Reads the tag references from tag files of a single tag definition.
+    Each reference is returned as a (block_name, tag_path, ext) tuple,
+    in the same order handler.get_nodes_by_paths would return them.
+    '''
+    tag_def = None
+    def_id = ""
+
+    # maps id(desc) to the BlockPlan for it
+    _plans = ()
+    # maps id(desc) to whether or not it or its children have a STEPTREE
+    _has_steptrees = ()
+    # maps id(desc) to whether or not it or its children have a tag ref
+    _has_tag_refs = ()
+
+    def __init__(self, tag_def):
+        self.tag_def = tag_def
+        self.def_id = tag_def.def_id
+        self._plans = {}
+        self._has_steptrees = {}
+        self._has_tag_refs = {}
+
+    def read_tag_refs(self, filepath, with_dependency_names=False):
+        '''
+        Returns a list of (block_name, tag_path, ext) tuples for each
+        dependency in the tag file that has a non-empty filepath.
+        If with_dependency_names is True, each tuple also has the
+        name of the field the reference is in as its last item, in
+        the form the dependency viewer displays it(ex: "shaders[2].shader").
+        '''
+        with open(str(filepath), "rb") as f:
+            if os.fstat(f.fileno()).st_size < 64:
+                raise ValueError("'%s' is too small to be a tag." % filepath)
+
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if data[36: 40].decode("latin-1") != self.def_id:
+                    raise ValueError("'%s' is not a '%s' tag." %
+                                     (filepath, self.def_id))
+
+                return self._read_tag_refs(data, with_dependency_names)
+            finally:
+                data.close()
+
+    def _read_tag_refs(self, data, with_dependency_names):
+        refs = []
+        desc = self.tag_def.descriptor
+        chain = ((desc.get('NAME'), False, None), )
+        self._parse_block(data, desc, 0, None, (), chain, refs)
+
+        # the tag refs are found in file order, so sort them by their
+        # position in the tag to put them in the order they'd be found
+        # in if the tag were built and searched through.
+        refs.sort(key=lambda ref: ref[0])
+        if with_dependency_names:
+            return [(name, tag_path, ext, get_dependency_name(chain))
+                    for _, name, tag_path, ext, chain in refs]
+
+        return [(name, tag_path, ext) for _, name, tag_path, ext, __ in refs]
+
+    def has_steptrees(self, desc):
+        key = id(desc)
+        result = self._has_steptrees.get(key)
+        if result is None:
+            result = 'STEPTREE' in desc or any(
+                self.has_steptrees(sub_desc)
+                for sub_desc in _iter_sub_descs(desc))
+            self._has_steptrees[key] = result
+        return result
+
+    def has_tag_refs(self, desc):
+        key = id(desc)
+        result = self._has_tag_refs.get(key)
+        if result is None:
+            result = desc['TYPE'] is TagRef or any(
+                self.has_tag_refs(sub_desc)
+                for sub_desc in _iter_sub_descs(desc))
+            self._has_tag_refs[key] = result
+        return result
+
+    def get_plan(self, desc):
+        plan = self._plans.get(id(desc))
+        if plan is None:
+            plan = self._plans[id(desc)] = self._make_plan(desc)
+        return plan
+
+    def _make_plan(self, desc):
+        plan = BlockPlan()
+        plan.size = desc.get('SIZE')
+        if not isinstance(plan.size, int):
+            raise UnsupportedTagDefError(
+                "Struct '%s' is not a fixed size." % desc.get('NAME'))
+
+        attr_offs = desc.get('ATTR_OFFS', ())
+        plan.children = [
+            (attr_offs[i], desc[i], i)
+            for i in range(desc.get('ENTRIES', 0))
+            if _is_block(desc[i]) and self.has_steptrees(desc[i])]
+
+        if desc['TYPE'] is TagRef:
+            plan.tag_class = _get_field_reader(desc, "tag_class")
+            plan.tag_class_desc = desc[desc['NAME_MAP']["tag_class"]]
+
+        s_desc = desc.get('STEPTREE')
+        if s_desc is None:
+            return plan
+
+        plan.steptree = s_desc
+        # the steptree is always iterated after the struct's fields
+        plan.steptree_key = desc.get('ENTRIES', 0)
+        size = s_desc.get('SIZE')
+        if size is tag_ref_str_size:
+            plan.steptree_size = _get_field_reader(desc, "path_length")
+            plan.is_tag_ref_str = True
+        elif isinstance(size, int):
+            plan.steptree_size = size
+        elif (isinstance(size, str) and size.startswith(".") and
+              not size.startswith("..")):
+            plan.steptree_size = _get_field_reader(desc, size[1:])
+        else:
+            raise UnsupportedTagDefError(
+                "Cannot determine the size of '%s'." % s_desc.get('NAME'))
+
+        if plan.is_tag_ref_str and not s_desc['TYPE'].is_str:
+            raise UnsupportedTagDefError(
+                "'%s' is not a string." % s_desc.get('NAME'))
+        return plan
+
+    def _parse_block(self, data, desc, offset, parents, key, chain, refs):
+        f_type = desc['TYPE']
+        if 'CASE' in desc or 'CASES' in desc:
+            # unions and switches are treated as an opaque blob of bytes
+            size = desc.get('SIZE')
+            if not isinstance(size, int):
+                raise UnsupportedTagDefError(
+                    "'%s' is not a fixed size." % desc.get('NAME'))
+            return offset + size
+        elif f_type.is_struct:
+            return self._parse_struct(
+                data, desc, offset, parents, key, chain, refs)
+        elif f_type.is_array:
+            size = desc.get('SIZE')
+            if not isinstance(size, int):
+                raise UnsupportedTagDefError(
+                    "'%s' is not a fixed size." % desc.get('NAME'))
+            return self._parse_array(
+                data, desc, size, offset, parents, key, chain, refs)
+        elif f_type.is_container:
+            is_root = parents is None
+            if is_root:
+                parents = []
+
+            for i in range(desc.get('ENTRIES', 0)):
+                sub_desc = desc[i]
+                offset = self._parse_block(
+                    data, sub_desc, offset, parents,
+                    *self._get_sub_path(sub_desc, key, chain, i), refs=refs)
+
+            if is_root:
+                offset = self._parse_steptrees(data, parents, offset, refs)
+            return offset
+
+        size = desc.get('SIZE', f_type.size)
+        if not isinstance(size, int) or f_type.is_var_size:
+            raise UnsupportedTagDefError(
+                "'%s' is not a fixed size." % desc.get('NAME'))
+        return offset + size
+
+    def _parse_struct(self, data, desc, offset, parents, key, chain, refs):
+        plan = self.get_plan(desc)
+        is_root = parents is None
+        if is_root:
+            parents = []
+
+        if plan.steptree is not None:
+            parents.append((desc, plan, offset, key, chain))
+
+        for off, sub_desc, sub_key in plan.children:
+            self._parse_block(
+                data, sub_desc, offset + off, parents,
+                *self._get_sub_path(sub_desc, key, chain, sub_key), refs=refs)
+
+        offset += plan.size
+        if offset > len(data):
+            raise ValueError("'%s' is out of bounds of the file." %
+                             desc.get('NAME'))
+
+        if is_root:
+            offset = self._parse_steptrees(data, parents, offset, refs)
+        return offset
+
+    def _parse_array(self, data, desc, count, offset, parents,
+                     key, chain, refs):
+        sub_desc = desc['SUB_STRUCT']
+        sub_size = sub_desc.get('SIZE')
+        if not isinstance(sub_size, int):
+            raise UnsupportedTagDefError(
+                "'%s' is not a fixed size." % sub_desc.get('NAME'))
+        elif offset + count*sub_size > len(data):
+            raise ValueError("'%s' is out of bounds of the file." %
+                             desc.get('NAME'))
+
+        if not self.has_steptrees(sub_desc):
+            # nothing in the array needs reading, so skip over it
+            return offset + count*sub_size
+
+        is_root = parents is None
+        if is_root:
+            parents = []
+
+        sub_key = sub_chain = None
+        name = sub_desc.get('NAME')
+        for i in range(count):
+            if key is not None:
+                sub_key = key + (i, )
+            if chain is not None:
+                sub_chain = chain + ((name, False, i), )
+
+            offset = self._parse_block(data, sub_desc, offset, parents,
+                                       sub_key, sub_chain, refs)
+
+        if is_root:
+            offset = self._parse_steptrees(data, parents, offset, refs)
+        return offset
+
+    def _parse_steptrees(self, data, parents, offset, refs):
+        for p_desc, plan, p_offset, key, chain in parents:
+            s_desc = plan.steptree
+            size = plan.steptree_size
+            if not isinstance(size, int):
+                off, unpacker, byte_size = size
+                off += p_offset
+                size = unpacker(data[off: off + byte_size])[0]
+
+            if plan.is_tag_ref_str:
+                size += bool(size)
+
+            if size < 0:
+                raise ValueError("'%s' has a negative size." %
+                                 s_desc.get('NAME'))
+
+            if not s_desc['TYPE'].is_array:
+                if offset + size > len(data):
+                    raise ValueError("'%s' is out of bounds of the file." %
+                                     s_desc.get('NAME'))
+                elif plan.is_tag_ref_str and size:
+                    self._add_tag_ref(data, p_desc, plan, p_offset,
+                                      data[offset: offset + size],
+                                      key, chain, refs)
+                offset += size
+                continue
+
+            sub_key = sub_chain = None
+            if key is not None:
+                sub_key = key + (plan.steptree_key, )
+            if chain is not None:
+                sub_chain = chain + ((s_desc.get('NAME'), True, None), )
+
+            # arrays in a steptree are the root of their own steptrees
+            offset = self._parse_array(data, s_desc, size, offset, None,
+                                       sub_key, sub_chain, refs)
+        return offset
+
+    def _add_tag_ref(self, data, desc, plan, offset, path_bytes,
+                     key, chain, refs):
+        tag_path = plan.steptree['TYPE'].decoder(path_bytes,
+                                                 desc=plan.steptree)
+        if not tag_path:
+            return
+
+        off, unpacker, byte_size = plan.tag_class
+        off += offset
+        tag_class = unpacker(data[off: off + byte_size])[0]
+
+        class_desc = plan.tag_class_desc
+        index = class_desc['VALUE_MAP'].get(tag_class)
+        ext = '.' + (class_desc[index]['NAME'] if index is not None
+                     else INVALID_ENUM_NAME)
+        refs.append((key, desc.get('NAME'), tag_path, ext, chain))
+
+    def _get_sub_path(self, desc, key, chain, sub_key):
+        if key is None or not self.has_tag_refs(desc):
+            # there's nothing to sort or name in here, so
+            # dont bother keeping track of where we are.
+            return None, None
+        return key + (sub_key, ), chain + ((desc.get('NAME'), False, None), )
+
+
+def _is_block(desc):
+    return desc['TYPE'].is_block
+
+
+def _iter_sub_descs(desc):
+    if 'CASE' in desc or 'CASES' in desc:
+        return
+
+    for key in desc:
+        if isinstance(key, int) or key in ('SUB_STRUCT', 'STEPTREE'):
+            sub_desc = desc[key]
+            if isinstance(sub_desc, dict) and 'TYPE' in sub_desc:
+                yield sub_desc
+
+
+def _get_field_reader(desc, field_name):
+    try:
+        index = desc['NAME_MAP'][field_name]
+        f_type = desc[index]['TYPE']
+        return (desc['ATTR_OFFS'][index], f_type.struct_unpacker,
+                f_type.size)
+    except (KeyError, IndexError, AttributeError):
+        raise UnsupportedTagDefError(
+            "Cannot read the '%s' field of '%s'." %
+            (field_name, desc.get('NAME')))
+
+
+def get_dependency_name(chain):
+    '''
+    Returns the name the dependency viewer displays for the field the
+    tag reference at the end of chain is in. chain is a tuple of
+    (name, is_array, index) tuples for each block from the root of
+    the tag to the tag reference, where index is the block's index
+    in its parent if its parent is an array.
+    '''
+    dependency_name = chain[-1][0]
+    last_is_array = chain[-1][1]
+    last_index = chain[-1][2]
+    for name, is_array, index in reversed(chain[:-1]):
+        if is_array:
+            dependency_name = '[%s].%s' % (last_index, dependency_name)
+        elif name not in ('tagdata', 'data'):
+            if not last_is_array:
+                name += '.'
+            dependency_name = name + dependency_name
+
+        last_is_array = is_array
+        last_index = index
+
+    # slice off the name of the root and the period
+    return dependency_name.split('.', 1)[-1]
+
+
+def get_tag_ref_reader(handler, def_id):
+    '''
+    Returns the shared TagRefReader for the handler's definition of
+    def_id, or None if the handler doesn't have a definition for it.
+    '''
+    handler_readers = _handler_readers.get(id(handler))
+    if handler_readers is None or handler_readers[0] is not handler:
+        handler_readers = _handler_readers[id(handler)] = (handler, {})
+
+    readers = handler_readers[1]
+    reader = readers.get(def_id)
+    if reader is None:
+        tag_def = handler.defs.get(def_id)
+        if tag_def is None:
+            return None
+        reader = readers[def_id] = TagRefReader(tag_def)
+
+    return reader
+
+
+def _make_name_plan(paths, desc, key):
+    sub_plans = []
+    if 'SUB_STRUCT' in paths:
+        sub_plans.append(_make_name_plan(
+            paths['SUB_STRUCT'], desc['SUB_STRUCT'], 'SUB_STRUCT'))
+    else:
+        for sub_key in paths:
+            sub_plans.append(_make_name_plan(
+                paths[sub_key], desc[sub_key], sub_key))
+
+    return (key, desc.get('NAME'), desc['TYPE'].is_array,
+            paths.is_ref, tuple(sub_plans))
+
+
+def get_name_plan(handler, def_id):
+    '''
+    Returns the handler's tag_ref_cache paths for def_id with the name of
+    each field along them looked up ahead of time, or None if tags of that
+    type have no references. Each step is a (key, name, is_array, is_ref,
+    sub_plans) tuple, where sub_plans is a tuple of the steps below it.
+    '''
+    handler_plans = _handler_name_plans.get(id(handler))
+    if handler_plans is None or handler_plans[0] is not handler:
+        handler_plans = _handler_name_plans[id(handler)] = (handler, {})
+
+    plans = handler_plans[1]
+    if def_id not in plans:
+        paths = handler.tag_ref_cache.get(def_id)
+        tag_def = handler.defs.get(def_id)
+        plans[def_id] = None
+        if paths and tag_def is not None:
+            plans[def_id] = _make_name_plan(paths, tag_def.descriptor, 0)
+
+    return plans[def_id]
+
+
+def _get_named_tag_refs(plan, node, chain, refs):
+    key, name, is_array, is_ref, sub_plans = plan
+    if is_ref and hasattr(node, 'desc'):
+        refs.append((node, get_dependency_name(chain)))
+
+    for sub_plan in sub_plans:
+        if sub_plan[0] == 'SUB_STRUCT':
+            for i in range(len(node)):
+                _get_named_tag_refs(sub_plan, node[i], chain + (
+                    (sub_plan[1], False, i), ), refs)
+        else:
+            _get_named_tag_refs(sub_plan, node[sub_plan[0]], chain + (
+                (sub_plan[1], sub_plan[2], None), ), refs)
+
+    return refs
+
+
+def get_named_tag_refs(handler, tag):
+    '''
+    Returns a list of (tag_ref_block, dependency_name) tuples for each tag
+    reference block in the loaded tag, in the same order and with the same
+    names as read_tag_refs gives them for the tag's file. The names come
+    from the name plan of the tag's type, so the blocks' parents aren't
+    searched through to work out where each reference is.
+    '''
+    plan = get_name_plan(handler, tag.def_id)
+    if plan is None:
+        return []
+
+    return _get_named_tag_refs(
+        plan, tag.data, ((plan[1], plan[2], None), ), [])
+
+
+def check_tag_header(handler, filepath, def_id):
+    '''
+    Raises ValueError if the file at filepath is too small to be a tag,
+    or if its header isn't for a def_id tag of the handler's engine.
+    '''
+    with open(str(filepath), "rb") as f:
+        header = f.read(64)
+
+    if len(header) < 64:
+        raise ValueError("'%s' is too small to be a tag." % filepath)
+    elif (header[36: 40].decode("latin-1") != def_id or
+          header[60: 64].decode("latin-1") != handler.tag_header_engine_id):
+        raise ValueError("'%s' is not a '%s' tag." % (filepath, def_id))
+
+
+def read_tag_refs(handler, filepath, def_id=None, **kwargs):
+    '''
+    Returns a list of (block_name, tag_path, ext) tuples for each
+    dependency in the tag file at filepath that has a non-empty filepath.
+    Returns None if the tag can't be read without building it. Raises
+    an exception if the tag is malformed. filepath may be relative to
+    the handler's tags directory. kwargs are passed to read_tag_refs.
+    '''
+    filepath = handler.tagsdir.joinpath(filepath)
+    if def_id is None:
+        def_id = handler.get_def_id(filepath)
+
+    if def_id not in handler.tag_ref_cache:
+        if def_id not in handler.defs:
+            return None
+
+        # tags of this type don't have any dependencies, but make sure
+        # the file is one so broken tags aren't passed off as readable.
+        check_tag_header(handler, filepath, def_id)
+        return []
+
+    reader = get_tag_ref_reader(handler, def_id)
+    if reader is None:
+        return None
+
+    try:
+        return reader.read_tag_refs(filepath, **kwargs)
+    except UnsupportedTagDefError:
+        return None
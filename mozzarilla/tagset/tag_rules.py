@@ -0,0 +1,343 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+A registry of tag specific validation rules, keyed by def_id.
+
+A rule is a function that takes a tag and returns a string describing
+the errors it found in it, or an empty string if it found none. Rules
+are registered with the tag_rule decorator(or register_tag_rule), so
+new checks can be added from other modules without editing this one.
+Modules containing rules can be imported with import_rule_modules, which
+also makes sure worker processes of a parallel scan import them too.
+
+The helpers at the bottom of this module let rules check every value of
+a field in an array of blocks at once. They use numpy if it's installed,
+and fall back to plain python lists if it isn't.
+'''
+
+import struct
+
+from importlib import import_module
+from time import perf_counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# maps def_ids to a list of the TagRules registered for them
+_rules_by_def_id = {}
+# the names of the modules imported by import_rule_modules, in order
+_rule_modules = []
+
+
+class TagRule:
+    '''
+    A single named check for tags of one def_id. run_count and total_time
+    are how many times the rule has been run in this process, and how
+    many seconds those runs took in total.
+    '''
+    def_id = ""
+    name = ""
+    func = None
+    run_count = 0
+    total_time = 0.0
+
+    def __init__(self, def_id, name, func):
+        self.def_id = def_id
+        self.name = name
+        self.func = func
+
+    def run(self, tag):
+        '''Returns a tuple of the errors the rule found, and its runtime.'''
+        start = perf_counter()
+        try:
+            errors = self.func(tag)
+        finally:
+            elapsed = perf_counter() - start
+            self.run_count += 1
+            self.total_time += elapsed
+
+        return errors or "", elapsed
+
+
+def register_tag_rule(def_id, name, func):
+    '''
+    Registers func as a rule for tags of the given def_id, replacing
+    any rule of the same name already registered for that def_id.
+    Rules are run in the order they were first registered.
+    '''
+    rules = _rules_by_def_id.setdefault(def_id, [])
+    rule = TagRule(def_id, name, func)
+    for i in range(len(rules)):
+        if rules[i].name == name:
+            rules[i] = rule
+            break
+    else:
+        rules.append(rule)
+
+    return rule
+
+
+def unregister_tag_rule(def_id, name):
+    rules = _rules_by_def_id.get(def_id, ())
+    for i in range(len(rules)):
+        if rules[i].name == name:
+            del rules[i]
+            break
+
+    if not rules:
+        _rules_by_def_id.pop(def_id, None)
+
+
+def tag_rule(def_id, name=None):
+    '''
+    Decorator that registers the decorated function as a rule for tags
+    of the given def_id. The rule is named after the function if no name
+    is given. The function is returned unchanged.
+    '''
+    def decorator(func):
+        register_tag_rule(def_id, name or func.__name__, func)
+        return func
+    return decorator
+
+
+def get_tag_rules(def_id):
+    return tuple(_rules_by_def_id.get(def_id, ()))
+
+
+def has_tag_rules(def_id):
+    return bool(_rules_by_def_id.get(def_id))
+
+
+def get_rules_signature(def_id):
+    '''
+    Returns a string identifying the rules registered for the def_id,
+    so cached results can tell if they were made by different rules.
+    '''
+    return ",".join("%s.%s" % (rule.func.__module__, rule.name)
+                    for rule in _rules_by_def_id.get(def_id, ()))
+
+
+def import_rule_modules(module_names):
+    '''
+    Imports each of the named modules so the rules in them are registered.
+    The names are remembered so worker processes can import them as well.
+    '''
+    for module_name in module_names:
+        import_module(module_name)
+        if module_name not in _rule_modules:
+            _rule_modules.append(module_name)
+
+
+def get_rule_modules():
+    return tuple(_rule_modules)
+
+
+def run_tag_rules(tag, rule_times=None):
+    '''
+    Runs every rule registered for the tag's def_id, and returns their
+    errors joined together. If provided, rule_times is a dict that the
+    seconds each rule took will be added to, keyed by the rule's name.
+    '''
+    errors = ""
+    for rule in get_tag_rules(tag.def_id):
+        rule_errors, elapsed = rule.run(tag)
+        errors += rule_errors
+        if rule_times is not None:
+            rule_times[rule.name] = rule_times.get(rule.name, 0.0) + elapsed
+
+    return errors
+
+
+def add_rule_times(total_rule_times, def_id, rule_times):
+    '''
+    Adds the rule_times of a scanned tag to total_rule_times, which maps
+    (def_id, rule_name) tuples to [run_count, total_seconds] lists.
+    '''
+    for name, elapsed in rule_times.items():
+        totals = total_rule_times.setdefault((def_id, name), [0, 0.0])
+        totals[0] += 1
+        totals[1] += elapsed
+
+
+def format_rule_times(total_rule_times):
+    '''
+    Returns a string listing the totals from add_rule_times, from
+    the slowest rule to the fastest, or an empty string if empty.
+    '''
+    if not total_rule_times:
+        return ""
+
+    lines = ["Tag specific rule times:"]
+    for (def_id, name), (count, elapsed) in sorted(
+            total_rule_times.items(), key=lambda item: -item[1][1]):
+        lines.append("    %-4s %-40s %8.3f seconds over %s tags" % (
+            def_id, name, elapsed, count))
+
+    return "\n".join(lines)
+
+
+def get_field_array(array_block, field_name, sub_desc=None):
+    '''
+    Returns the value of the named field of each struct in an array.
+
+    array_block may be an array of blocks, or the bytes of a reflexive
+    that was parsed as raw data(such as those made with raw_reflexive),
+    in which case sub_desc must be the descriptor of its structs.
+    With numpy, a numpy array is returned, and for raw data it is a view
+    of the data rather than a copy. Without numpy, a list is returned.
+    '''
+    if sub_desc is None:
+        sub_desc = array_block.desc['SUB_STRUCT']
+
+    index = sub_desc['NAME_MAP'][field_name]
+    f_type = sub_desc[index]['TYPE']
+    if not isinstance(array_block, (bytes, bytearray, memoryview)):
+        if numpy is None:
+            return [block[index] for block in array_block]
+
+        return numpy.fromiter(
+            (block[index] for block in array_block),
+            numpy.dtype(f_type.enc).newbyteorder('='), len(array_block))
+
+    struct_size = sub_desc['SIZE']
+    offset = sub_desc['ATTR_OFFS'][index]
+    count = len(array_block) // struct_size
+    if numpy is None:
+        unpack_from = struct.Struct(f_type.enc).unpack_from
+        return [unpack_from(array_block, offset + i*struct_size)[0]
+                for i in range(count)]
+
+    return numpy.ndarray((count, ), numpy.dtype(f_type.enc), array_block,
+                         offset, (struct_size, ))
+
+
+def concat_field_arrays(arrays):
+    '''Concatenates arrays returned by get_field_array into one.'''
+    if numpy is None:
+        return [value for array in arrays for value in array]
+    elif not arrays:
+        return numpy.zeros(0, int)
+    return numpy.concatenate(arrays)
+
+
+def find_out_of_range(values, min_value, max_value):
+    '''
+    Returns a list of the indices of the values that are less than
+    min_value, or greater than or equal to max_value, in ascending order.
+    '''
+    if numpy is None:
+        return [i for i in range(len(values))
+                if values[i] < min_value or values[i] >= max_value]
+
+    return numpy.flatnonzero(
+        (values < min_value) | (values >= max_value)).tolist()
+
+
+def split_indices(indices, lengths):
+    '''
+    Splits sorted indices into a concatenation of arrays of the given
+    lengths into a list of the indices into each of those arrays.
+    '''
+    split = [[] for _ in lengths]
+    i = start = 0
+    for length, array_indices in zip(lengths, split):
+        end = start + length
+        while i < len(indices) and indices[i] < end:
+            array_indices.append(indices[i] - start)
+            i += 1
+        start = end
+
+    return split
+
+
+@tag_rule("snd!", "ogg pcm buffer size")
+def check_sound_ogg_buffer_sizes(tag):
+    for pr in tag.data.tagdata.pitch_ranges.STEPTREE:
+        for perm in pr.permutations.STEPTREE:
+            if perm.compression.enum_name != "ogg":
+                continue
+            elif perm.ogg_sample_count == 0 and perm.samples.data:
+                return ("    Bad PCM buffer size. " +
+                        "Fix by recompiling this sound.")
+
+    return ""
+
+
+@tag_rule("coll", "collision material numbers")
+def check_collision_material_numbers(tag):
+    tagdata = tag.data.tagdata
+    nodes = tagdata.nodes.STEPTREE
+    mat_ct = len(tagdata.materials.STEPTREE)
+
+    # check the surfaces of every bsp in one go
+    bsp_ids = []
+    materials = []
+    for i in range(len(nodes)):
+        bsps = nodes[i].bsps.STEPTREE
+        for j in range(len(bsps)):
+            bsp_ids.append((i, j))
+            materials.append(get_field_array(
+                bsps[j].surfaces.STEPTREE, "material"))
+
+    all_materials = concat_field_arrays(materials)
+    bad_indices = find_out_of_range(all_materials, 0, mat_ct)
+    if not bad_indices:
+        return ""
+
+    bad_materials = [int(all_materials[k]) for k in bad_indices]
+    highest_mat_num = max(0, max(bad_materials))
+    lowest_mat_num = min(0, min(bad_materials))
+
+    bad_nodes = {}
+    for (i, j), bad_surfaces in zip(bsp_ids, split_indices(
+            bad_indices, [len(mats) for mats in materials])):
+        if bad_surfaces:
+            bad_nodes.setdefault(i, {})[j] = bad_surfaces
+
+    err = "    Bad collision material numbers.\n"
+    if lowest_mat_num > -1:
+        # none of the material numbers are below zero, so
+        # it's possible to fix this by adding more materials.
+        err += (("    Change the material numbers of these " +
+                 "surfaces to be <= %s or add %s materials.\n")
+                % (mat_ct - 1, (highest_mat_num + 1) - mat_ct))
+    else:
+        err += (("    Change the material numbers of these " +
+                 "surfaces to be >= 0 and <= %s\n") % (mat_ct - 1))
+
+    for i in sorted(bad_nodes.keys()):
+        bad_bsps = bad_nodes[i]
+        err += "    %s(node #%s)\n" % (nodes[i].name, i)
+        for j in sorted(bad_bsps.keys()):
+            bad_surfaces = bad_bsps[j]
+            err += "        bsp #%s\n" % j
+            err += "            surfaces = %s\n" % bad_surfaces
+        err += "\n"
+
+    return err[:-1]
+
+
+@tag_rule("effe", "empty damage effect references")
+def check_effect_damage_effect_refs(tag):
+    err = ""
+    events = tag.data.tagdata.events.STEPTREE
+    for i in range(len(events)):
+        # tool exceptions if any parts reference a damage effect
+        # tag type, but have an empty filepath for the reference
+        parts = events[i].parts.STEPTREE
+        for j in range(len(parts)):
+            part = parts[j]
+            if (part.type.tag_class.enum_name == "damage_effect" and
+                not part.type.filepath):
+                err += ("     Missing filepath in damage_effect "
+                        "reference in part %s of event %s\n." % (j, i))
+
+    return err
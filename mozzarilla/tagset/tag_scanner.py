@@ -0,0 +1,446 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+GUI-free tag scanning functions used by the Tag Scanner.
+
+Nothing in here may import tkinter or binilla widgets, since the
+functions in this module are run inside worker processes.
+'''
+
+import os
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from pathlib import PureWindowsPath
+from time import perf_counter
+from traceback import format_exc
+
+from mozzarilla.tagset.tag_ref_reader import read_tag_refs
+from mozzarilla.tagset.tags_dir_index import find_tag_fullpath
+from mozzarilla.tagset.tag_rules import run_tag_rules, has_tag_rules,\
+     get_rule_modules, import_rule_modules
+
+# number of tags sent to a worker process in each job.
+SCAN_CHUNK_SIZE = 32
+
+# the handler used by the current worker process, and
+# the tag_ref_exists results it has cached so far.
+_worker_handler = None
+_worker_exists_cache = None
+
+
+class TagScanResult:
+    '''The findings from scanning a single tag.'''
+    filepath = None
+    def_id = ""
+    loaded = False
+    # list of (block_name, tag_path, ext) tuples for each reference
+    tag_refs = ()
+    # list of (block_name, tag_path) tuples for each broken reference
+    missing_refs = ()
+    specific_errors = ""
+    scan_error = ""
+    # whether the result was reused from a TagScanCache
+    cached = False
+    # maps the name of each tag rule run on the tag to its runtime
+    rule_times = ()
+    # maps the name of each stage of scanning the tag to its runtime
+    stage_times = ()
+
+    def __init__(self, filepath, def_id):
+        self.filepath = filepath
+        self.def_id = def_id
+        self.tag_refs = []
+        self.missing_refs = []
+        self.rule_times = {}
+        self.stage_times = {}
+
+    @property
+    def has_problems(self):
+        return bool(not self.loaded or self.scan_error or
+                    self.missing_refs or self.specific_errors)
+
+    def to_dict(self):
+        '''Returns this result as a dict that can be serialized to json.'''
+        return dict(
+            filepath=str(self.filepath), def_id=self.def_id,
+            loaded=self.loaded, has_problems=self.has_problems,
+            missing_refs=[dict(name=name, filepath=str(tag_path))
+                          for name, tag_path in self.missing_refs],
+            specific_errors=self.specific_errors,
+            scan_error=self.scan_error,
+            rule_times=self.rule_times,
+            stage_times=self.stage_times,
+            )
+
+
+def load_tag(handler, filepath):
+    '''
+    Returns the tag at the tagsdir-relative filepath, or None if it
+    could not be loaded. Tags are built without being indexed in
+    the handler so they are freed once they are done being scanned.
+    '''
+    try:
+        return handler.build_tag(filepath=handler.tagsdir.joinpath(filepath))
+    except Exception:
+        return None
+
+
+def get_tag_refs(handler, tag):
+    '''
+    Returns a list of (block_name, tag_path, ext) tuples for
+    each dependency in the tag that has a non-empty filepath.
+    '''
+    tag_ref_paths = handler.tag_ref_cache.get(tag.def_id)
+    if tag_ref_paths is None:
+        # no dependencies for this tag type
+        return []
+
+    tag_refs = []
+    for block in handler.get_nodes_by_paths(tag_ref_paths, tag.data):
+        if not block.filepath:
+            continue
+
+        try:
+            ext = '.' + block.tag_class.enum_name
+        except Exception:
+            ext = ''
+        tag_refs.append((block.NAME, block.filepath, ext))
+
+    return tag_refs
+
+
+def tag_ref_exists(handler, tag_path, ext, exists_cache=None):
+    '''
+    Returns whether or not the windows-style tag_path with the given
+    extension points to a tag in the handler's tags directory.
+    If provided, exists_cache is a dict used to memoize the results.
+    '''
+    key = (tag_path, ext)
+    if exists_cache is not None and key in exists_cache:
+        return exists_cache[key]
+
+    tags_dir = handler.tagsdir
+    tag_path = PureWindowsPath(tag_path)
+    parts = tag_path.parts
+
+    exts = (ext, )
+    if handler.treat_mode_as_mod2 and ext == '.model':
+        exts = (ext, '.gbxmodel')
+
+    exists = False
+    for ext in exts:
+        # checking if the path exists as-is is far faster than searching
+        # case-insensitively, and will be the case for most references.
+        if parts and not tag_path.anchor and os.path.isfile(os.path.join(
+                str(tags_dir), *parts[: -1], parts[-1] + ext)):
+            exists = True
+            break
+
+        try:
+            if find_tag_fullpath(tags_dir, tag_path, ext, True):
+                exists = True
+                break
+        except OSError:
+            pass
+
+    if exists_cache is not None:
+        exists_cache[key] = exists
+
+    return exists
+
+
+def get_missing_refs(handler, tag_refs, exists_cache=None):
+    '''
+    Returns a list of (block_name, tag_path) tuples for each of the
+    tag_refs(as returned by get_tag_refs) which point to non-existent tags.
+    '''
+    return [(name, tag_path + ext) for name, tag_path, ext in tag_refs
+            if not tag_ref_exists(handler, tag_path, ext, exists_cache)]
+
+
+def get_tag_specific_errors(tag, rule_times=None):
+    '''
+    Returns a string describing errors in the tag which are specific
+    to its tag type, and which would cause tool or the game to fail.
+    Returns an empty string if no errors were found. The checks are the
+    rules registered in tag_rules, and rule_times is passed along to
+    run_tag_rules to collect how long each of them took.
+    '''
+    return run_tag_rules(tag, rule_times)
+
+
+def read_tag_refs_only(handler, filepath, def_id):
+    '''
+    Returns the tag_refs of the tag at the tagsdir-relative filepath
+    read using a TagRefReader, or None if the tag needs to be loaded
+    to be scanned or can't be read without loading it.
+    '''
+    if has_tag_rules(def_id):
+        # the rules for this tag type need the whole tag
+        return None
+
+    try:
+        return read_tag_refs(handler, filepath, def_id)
+    except Exception:
+        # let load_tag decide whether or not the tag is broken
+        return None
+
+
+def read_tag_file_refs(handler, filepath, def_id):
+    '''
+    Returns the tag_refs of the tag at the tagsdir-relative filepath
+    in the same form as get_tag_refs. Only the references are read if
+    possible, otherwise the tag is loaded. Returns None if it can't be.
+    '''
+    try:
+        tag_refs = read_tag_refs(handler, filepath, def_id)
+        if tag_refs is not None:
+            return tag_refs
+    except Exception:
+        pass
+
+    tag = load_tag(handler, filepath)
+    if tag is None:
+        return None
+    return get_tag_refs(handler, tag)
+
+
+def scan_tag(handler, filepath, def_id, tag=None, exists_cache=None):
+    '''
+    Scans the tag at the tagsdir-relative filepath for broken
+    dependencies and tag specific errors, and returns a TagScanResult.
+    If tag is None, only the tag references are read from the file if
+    possible, otherwise the tag will be loaded using load_tag.
+    exists_cache is passed along to tag_ref_exists.
+
+    How long reading the tag, resolving its references, and running its
+    rules took are recorded in the result's stage_times.
+    '''
+    result = TagScanResult(filepath, def_id)
+    stage_times = result.stage_times
+    start = perf_counter()
+    tag_refs = None
+    if tag is None:
+        tag_refs = read_tag_refs_only(handler, filepath, def_id)
+        if tag_refs is None:
+            tag = load_tag(handler, filepath)
+
+    stage_times["parse"] = perf_counter() - start
+    if tag is None and tag_refs is None:
+        return result
+
+    result.loaded = True
+    try:
+        if tag is not None:
+            start = perf_counter()
+            result.specific_errors = get_tag_specific_errors(
+                tag, result.rule_times)
+            stage_times["rules"] = perf_counter() - start
+
+        start = perf_counter()
+        if tag_refs is None:
+            tag_refs = get_tag_refs(handler, tag)
+
+        result.tag_refs = tag_refs
+        result.missing_refs = get_missing_refs(
+            handler, result.tag_refs, exists_cache)
+        stage_times["refs"] = perf_counter() - start
+    except Exception:
+        result.scan_error = format_exc()
+
+    return result
+
+
+def get_worker_handler_info(handler):
+    '''
+    Returns the arguments get_worker_handler needs to build a
+    handler in a worker process that matches the given handler.
+    '''
+    return (type(handler), handler.tagsdir,
+            dict(debug=0, case_sensitive=handler.case_sensitive),
+            get_rule_modules())
+
+
+def get_worker_handler(handler_class, tags_dir, handler_kwargs,
+                       rule_modules=()):
+    # building a handler is slow, so each worker process only builds
+    # one and reuses it for every job it is given afterward.
+    global _worker_handler, _worker_exists_cache
+    import_rule_modules(rule_modules)
+    if (type(_worker_handler) is not handler_class or
+            _worker_handler.tagsdir != tags_dir):
+        _worker_handler = handler_class(**handler_kwargs)
+        _worker_handler.tagsdir = tags_dir
+        _worker_exists_cache = {}
+
+    return _worker_handler
+
+
+def _scan_tags_in_worker(handler_info, def_id, tag_paths):
+    handler = get_worker_handler(*handler_info)
+    return [scan_tag(handler, filepath, def_id,
+                     exists_cache=_worker_exists_cache)
+            for filepath in tag_paths]
+
+
+def iter_parallel_scan(handler, tag_paths_by_def_id, process_count=None,
+                       chunk_size=SCAN_CHUNK_SIZE, is_cancelled=None,
+                       poll_interval=0.5):
+    '''
+    Scans the tags in tag_paths_by_def_id across a pool of worker
+    processes and yields a TagScanResult for each of them.
+
+    tag_paths_by_def_id is a dict mapping each def_id to a list of
+    tagsdir-relative filepaths of that type. Each worker builds its own
+    handler of the same class as the provided one, and only the scan
+    results are sent back. Results are yielded in sorted def_id order,
+    then sorted filepath order, regardless of what order they finish in.
+
+    is_cancelled is an optional function taking no arguments. It is polled
+    every poll_interval seconds, and once it returns True all pending jobs
+    are cancelled and no more results are yielded.
+    '''
+    if process_count is None:
+        process_count = os.cpu_count() or 1
+
+    handler_info = get_worker_handler_info(handler)
+    executor = ProcessPoolExecutor(max_workers=max(1, process_count))
+
+    # submit every job up front so the workers always have something to do
+    jobs = []
+    for def_id in sorted(tag_paths_by_def_id):
+        tag_paths = sorted(tag_paths_by_def_id[def_id])
+        for i in range(0, len(tag_paths), chunk_size):
+            jobs.append(executor.submit(
+                _scan_tags_in_worker, handler_info,
+                def_id, tag_paths[i: i + chunk_size]))
+
+    finished = False
+    try:
+        for job in jobs:
+            while True:
+                if is_cancelled is not None and is_cancelled():
+                    return
+
+                try:
+                    results = job.result(poll_interval)
+                    break
+                except TimeoutError:
+                    pass
+
+            yield from results
+
+        finished = True
+    finally:
+        # if the scan was cancelled or the caller stopped iterating
+        # early, dont make them wait for the remaining jobs to finish.
+        if not finished:
+            for job in jobs:
+                job.cancel()
+
+        executor.shutdown(wait=finished)
+
+
+def iter_merged_results(tag_paths_by_def_id, cached_results, new_results):
+    '''
+    Yields a TagScanResult for every tag in tag_paths_by_def_id in sorted
+    def_id order, then sorted filepath order. Results are taken from the
+    cached_results dict(keyed by filepath) if they are in it, otherwise
+    they are taken from the new_results iterable, which must yield them in
+    the same order. Stops early if new_results runs out(ex: if cancelled).
+    '''
+    new_results = iter(new_results)
+    for def_id in sorted(tag_paths_by_def_id):
+        for filepath in sorted(tag_paths_by_def_id[def_id]):
+            result = cached_results.get(filepath)
+            if result is None:
+                result = next(new_results, None)
+                if result is None:
+                    return
+
+            yield result
+
+
+def iter_serial_scan(handler, tag_paths_by_def_id, exists_cache=None,
+                     is_cancelled=None, get_tag=None):
+    '''
+    Scans the tags in tag_paths_by_def_id one at a time in this process
+    and yields a TagScanResult for each of them, in the same order as
+    iter_parallel_scan. get_tag is an optional function that is given a
+    tagsdir-relative filepath and returns the tag if it is already loaded
+    (ex: open in an editor with unsaved edits), or None. Tags it doesn't
+    return are scanned from their files by scan_tag.
+    '''
+    for def_id in sorted(tag_paths_by_def_id):
+        for filepath in sorted(tag_paths_by_def_id[def_id]):
+            if is_cancelled is not None and is_cancelled():
+                return
+
+            tag = None
+            if get_tag is not None:
+                tag = get_tag(filepath)
+
+            yield scan_tag(handler, filepath, def_id, tag, exists_cache)
+
+
+def iter_scan_results(handler, tag_paths_by_def_id, process_count=1,
+                      scan_cache=None, is_cancelled=None, get_tag=None):
+    '''
+    Yields a TagScanResult for every tag in tag_paths_by_def_id in sorted
+    def_id order, then sorted filepath order.
+
+    If process_count is 1 the tags are scanned in this process, otherwise
+    they are scanned by iter_parallel_scan using that many processes(None
+    means one per cpu). If scan_cache is provided, tags whose results are
+    cached are not rescanned, and the results of the rest are added to it.
+    The caller is responsible for saving the scan_cache afterward.
+
+    Tags that get_tag(see iter_serial_scan) returns are always scanned in
+    this process as they are in memory, and their results aren't cached,
+    since they may not match their files.
+    '''
+    exists_cache = {}
+    cached_results = {}
+    loaded_results = {}
+    tag_paths_to_scan = tag_paths_by_def_id
+    if get_tag is not None:
+        # only a few tags are ever loaded, so scan them all up front
+        tag_paths_to_scan = {}
+        for def_id, tag_paths in tag_paths_by_def_id.items():
+            tag_paths_to_scan[def_id] = unloaded = []
+            for filepath in tag_paths:
+                tag = get_tag(filepath)
+                if tag is None:
+                    unloaded.append(filepath)
+                else:
+                    loaded_results[filepath] = scan_tag(
+                        handler, filepath, def_id, tag, exists_cache)
+
+    if scan_cache is not None:
+        tag_paths_to_scan, cached_results = scan_cache.split_tag_paths(
+            tag_paths_to_scan, exists_cache)
+        print("%s tags are unchanged since they were last scanned." %
+              len(cached_results))
+
+    if process_count == 1:
+        new_results = iter_serial_scan(
+            handler, tag_paths_to_scan, exists_cache, is_cancelled)
+    else:
+        new_results = iter_parallel_scan(
+            handler, tag_paths_to_scan, process_count,
+            is_cancelled=is_cancelled)
+
+    known_results = dict(cached_results)
+    known_results.update(loaded_results)
+    for result in iter_merged_results(
+            tag_paths_by_def_id, known_results, new_results):
+        if scan_cache is not None and result.filepath not in known_results:
+            scan_cache.add_result(result)
+
+        yield result
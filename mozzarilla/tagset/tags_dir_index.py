@@ -0,0 +1,485 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+A shared index of the files in a directory tree, so the tools that need to
+find every tag of some type in a tags directory don't each walk the whole
+tree every time they're run, and so tag references can be matched to files
+case-insensitively without listing every directory along the way each time.
+'''
+
+import os
+
+from bisect import bisect_left
+from pathlib import Path, PureWindowsPath
+from threading import RLock
+from time import time
+
+from supyr_struct.util import path_normalize, is_in_dir, is_path_empty
+
+# if a directory was modified less than this many nanoseconds before it
+# was listed, it could've been modified again within the resolution of its
+# modification time, so it's listed again on the next refresh to be safe.
+DIR_MTIME_RESOLUTION_NS = 2000000000
+
+# maps the root directory of each shared index to the index
+_shared_indices = {}
+_shared_indices_lock = RLock()
+
+
+def abs_path_normalize(path):
+    '''
+    Returns the path normalized and made absolute, so relative and
+    absolute paths to the same place compare equal.
+    '''
+    return path_normalize(os.path.abspath(str(path)))
+
+
+class DirListing:
+    '''
+    The contents of a single directory, as of when it was last listed.
+    files_by_ext maps each lowercase extension(including the period) to
+    a list of (filename, size, mtime_ns) tuples sorted by filename.
+    linked_dirs are symlinks to directories, which aren't indexed into
+    so links can't make the index loop, but can be found by find_names.
+    '''
+    __slots__ = ("mtime_ns", "listed_time_ns", "subdirs", "linked_dirs",
+                 "files_by_ext", "_folded_names")
+
+    def __init__(self, mtime_ns, listed_time_ns):
+        self.mtime_ns = mtime_ns
+        self.listed_time_ns = listed_time_ns
+        self.subdirs = ()
+        self.linked_dirs = ()
+        self.files_by_ext = {}
+        self._folded_names = None
+
+    def is_stale(self, mtime_ns):
+        return (mtime_ns != self.mtime_ns or
+                self.listed_time_ns - mtime_ns < DIR_MTIME_RESOLUTION_NS)
+
+    def find_names(self, name, is_dir):
+        '''
+        Returns a list of the names of the directories(if is_dir is True)
+        or files in this directory that case-insensitively match name.
+        An exact match is always first, and the rest are sorted.
+        '''
+        folded_names = self._folded_names
+        if folded_names is None:
+            # build on first use, since most listings are never searched
+            folded_names = {}
+            for dir_name in self.subdirs + self.linked_dirs:
+                folded_names.setdefault(
+                    (dir_name.lower(), True), []).append(dir_name)
+            for files in self.files_by_ext.values():
+                for filename, _, __ in files:
+                    folded_names.setdefault(
+                        (filename.lower(), False), []).append(filename)
+            self._folded_names = folded_names
+
+        names = folded_names.get((name.lower(), is_dir), ())
+        if name in names:
+            return [name] + [other for other in names if other != name]
+        return sorted(names)
+
+
+class TagsDirIndex:
+    '''
+    An index of every file in the directory tree under root_dir, with
+    each file's size and modification time, bucketed by extension.
+
+    Refreshing only lists the directories whose modification time changed
+    since they were last listed, so refreshing an unchanged tree costs one
+    stat per directory rather than one per file. Since modifying a file in
+    place doesn't change its directory's modification time, the size and
+    modification time of a file are as of when its directory was listed.
+    '''
+    root_dir = ""
+
+    # maps directory paths relative to root_dir("" for root_dir
+    # itself) to the DirListing of that directory.
+    _listings = ()
+    # maps (start_dir, lowercase path, is_dir) tuples to the last
+    # start_dir relative path that find_path found for them.
+    _found_paths = ()
+    _lock = None
+
+    def __init__(self, root_dir):
+        self.root_dir = abs_path_normalize(root_dir)
+        self._listings = {}
+        self._found_paths = {}
+        self._lock = RLock()
+
+    def get_rel_dir(self, dirpath="", root_relative=False):
+        '''
+        Returns dirpath relative to root_dir in the form the index uses.
+        A relative dirpath is relative to the current directory, like any
+        other path, unless root_relative is True, in which case it is
+        relative to root_dir. An empty dirpath is root_dir.
+        Raises ValueError if dirpath isn't inside root_dir.
+        '''
+        dirpath = str(dirpath)
+        if not dirpath:
+            return ""
+        elif not root_relative:
+            dirpath = os.path.relpath(abs_path_normalize(dirpath),
+                                      self.root_dir)
+
+        dirpath = os.path.normpath(dirpath)
+        if dirpath == os.curdir:
+            return ""
+        elif dirpath == os.pardir or dirpath.startswith(os.pardir + os.sep):
+            raise ValueError("'%s' is not inside '%s'" % (
+                dirpath, self.root_dir))
+        return dirpath
+
+    def refresh(self, dirpath="", is_cancelled=None, progress_callback=None):
+        '''
+        Updates the index for every directory under dirpath. Returns False
+        if is_cancelled returned True before it finished, and True otherwise.
+        progress_callback is called with the root_dir relative path of each
+        directory as it is listed.
+        '''
+        rel_dir = self.get_rel_dir(dirpath)
+        with self._lock:
+            dirs_to_check = [rel_dir]
+            while dirs_to_check:
+                if is_cancelled is not None and is_cancelled():
+                    return False
+
+                rel_dir = dirs_to_check.pop()
+                listing, listed = self._update_listing(rel_dir)
+                if listing is None:
+                    continue
+                elif listed and progress_callback is not None:
+                    progress_callback(rel_dir)
+
+                # reversed so they're popped off in sorted order
+                dirs_to_check.extend(os.path.join(rel_dir, subdir)
+                                     for subdir in reversed(listing.subdirs))
+
+        return True
+
+    def _update_listing(self, rel_dir):
+        '''
+        Lists the directory if it changed since it was last listed. Returns
+        its DirListing(or None if it doesn't exist), and whether it was listed.
+        '''
+        listing = self._listings.get(rel_dir)
+        try:
+            mtime_ns = os.stat(
+                os.path.join(self.root_dir, rel_dir)).st_mtime_ns
+        except OSError:
+            self._remove_tree(rel_dir)
+            return None, False
+
+        if listing is not None and not listing.is_stale(mtime_ns):
+            return listing, False
+
+        new_listing = self._list_dir(rel_dir, mtime_ns)
+        if listing is not None:
+            for subdir in set(listing.subdirs).difference(
+                    new_listing.subdirs):
+                self._remove_tree(os.path.join(rel_dir, subdir))
+
+        self._listings[rel_dir] = new_listing
+        return new_listing, True
+
+    def _list_dir(self, rel_dir, mtime_ns):
+        listing = DirListing(mtime_ns, int(time()*1000000000))
+        subdirs = []
+        linked_dirs = []
+        files_by_ext = listing.files_by_ext
+        try:
+            with os.scandir(os.path.join(self.root_dir, rel_dir)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            ext = os.path.splitext(entry.name)[-1].lower()
+                            files_by_ext.setdefault(ext, []).append(
+                                (entry.name, stat.st_size, stat.st_mtime_ns))
+                        elif entry.is_dir():
+                            linked_dirs.append(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+        subdirs.sort()
+        listing.subdirs = tuple(subdirs)
+        listing.linked_dirs = tuple(sorted(linked_dirs))
+        for files in files_by_ext.values():
+            files.sort()
+
+        return listing
+
+    def _remove_tree(self, rel_dir):
+        self._listings.pop(rel_dir, None)
+        prefix = os.path.join(rel_dir, "")
+        if not rel_dir:
+            self._listings.clear()
+            return
+
+        for key in tuple(self._listings):
+            if key.startswith(prefix):
+                del self._listings[key]
+
+    def find_path(self, parts, is_dir=False, start_dir=""):
+        '''
+        Returns the path relative to start_dir of the file(or directory if
+        is_dir is True) whose path relative to start_dir case-insensitively
+        matches the sequence of path parts, or None if there isn't one.
+        start_dir is relative to root_dir. Only directories that changed
+        since they were last listed are listed again, and paths that were
+        found before only cost a single stat to check they still exist.
+        '''
+        if not parts:
+            return None
+
+        key = (start_dir, os.sep.join(parts).lower(), is_dir)
+        found_path = self._found_paths.get(key)
+        if found_path is not None:
+            full_path = os.path.join(self.root_dir, start_dir, found_path)
+            if (os.path.isdir(full_path) if is_dir else
+                    os.path.isfile(full_path)):
+                return found_path
+
+        with self._lock:
+            found_path = self._find_path(parts, 0, is_dir, start_dir)
+            if found_path is not None:
+                found_path = os.path.relpath(found_path, start_dir or ".")
+                self._found_paths[key] = found_path
+
+        return found_path
+
+    def _find_path(self, parts, i, is_dir, rel_dir):
+        listing = self._update_listing(rel_dir)[0]
+        if listing is None:
+            return None
+
+        last = i + 1 == len(parts)
+        # directories whose names differ only by case can exist on case
+        # sensitive filesystems, so each one is searched until it's found
+        for name in listing.find_names(parts[i], is_dir or not last):
+            found_path = os.path.join(rel_dir, name)
+            if not last:
+                found_path = self._find_path(
+                    parts, i + 1, is_dir, found_path)
+
+            if found_path is not None:
+                return found_path
+
+        return None
+
+    def get_file_info(self, rel_filepath):
+        '''
+        Returns a (size, mtime_ns) tuple for the file at the root_dir
+        relative rel_filepath(whose case must match the case on disk),
+        or None if it doesn't exist. Its directory is listed first
+        if it changed since it was last listed.
+        '''
+        rel_dir, filename = os.path.split(os.path.normpath(rel_filepath))
+        with self._lock:
+            listing = self._update_listing(rel_dir)[0]
+
+        if listing is None:
+            return None
+
+        files = listing.files_by_ext.get(
+            os.path.splitext(filename)[-1].lower(), ())
+        i = bisect_left(files, (filename, ))
+        if i < len(files) and files[i][0] == filename:
+            return files[i][1: 3]
+        return None
+
+    def iter_files(self, exts=None, dirpath=""):
+        '''
+        Yields a (rel_filepath, size, mtime_ns) tuple for each indexed file
+        under dirpath whose extension is in exts, or every file if exts is
+        None. rel_filepath is a string relative to root_dir. Directories
+        are iterated in sorted order, with each one's files sorted by
+        extension and then name. Only what has already been indexed is
+        iterated, so call refresh first.
+        '''
+        if exts is not None:
+            exts = sorted(set(ext.lower() for ext in exts))
+
+        with self._lock:
+            # copy the listings to iterate so refreshing
+            # from another thread can't change them.
+            dirs_to_iter = [self.get_rel_dir(dirpath)]
+            listings = []
+            while dirs_to_iter:
+                rel_dir = dirs_to_iter.pop()
+                listing = self._listings.get(rel_dir)
+                if listing is None:
+                    continue
+
+                listings.append((rel_dir, listing))
+                dirs_to_iter.extend(os.path.join(rel_dir, subdir)
+                                    for subdir in reversed(listing.subdirs))
+
+        for rel_dir, listing in listings:
+            files_by_ext = listing.files_by_ext
+            for ext in (sorted(files_by_ext) if exts is None else exts):
+                for filename, size, mtime_ns in files_by_ext.get(ext, ()):
+                    yield os.path.join(rel_dir, filename), size, mtime_ns
+
+    def get_tag_paths(self, ext_id_map, def_ids, dirpath="", tags_dir=""):
+        '''
+        Returns a dict mapping each of the def_ids to a list of the tags_dir
+        relative Paths of each indexed file under dirpath with an extension
+        that ext_id_map maps to that def_id. dirpath must be inside tags_dir,
+        which must be inside root_dir and defaults to root_dir.
+        '''
+        tag_paths_by_def_id = {def_id: [] for def_id in def_ids}
+        exts = [ext for ext, def_id in ext_id_map.items()
+                if def_id in tag_paths_by_def_id]
+
+        prefix_len = len(self.get_rel_dir(tags_dir))
+        if prefix_len:
+            prefix_len += len(os.sep)
+
+        for rel_filepath, _, __ in self.iter_files(exts, dirpath):
+            ext = os.path.splitext(rel_filepath)[-1].lower()
+            tag_paths_by_def_id[ext_id_map[ext]].append(
+                Path(rel_filepath[prefix_len:]))
+
+        return tag_paths_by_def_id
+
+
+def get_tags_dir_index(dirpath):
+    '''
+    Returns the shared TagsDirIndex whose root_dir is dirpath or contains
+    it, creating one rooted at dirpath if none exist. The index may not
+    be up to date, so refresh the part of it being used before using it.
+    '''
+    dirpath = abs_path_normalize(dirpath)
+    with _shared_indices_lock:
+        index = _shared_indices.get(dirpath)
+        if index is not None:
+            return index
+
+        for root_dir, index in _shared_indices.items():
+            if is_in_dir(dirpath, root_dir):
+                return index
+
+        index = _shared_indices[dirpath] = TagsDirIndex(dirpath)
+        return index
+
+
+def find_tag_fullpath(tagdir, tagpath, extension="", force_windows=False,
+                      folder=False):
+    '''
+    Does the same as supyr_struct.util.tagpath_to_fullpath, but searches
+    the shared TagsDirIndex of tagdir, so each directory along the way is
+    only listed again once it changes rather than on every call.
+    Returns the path with the case it has on disk as a string if the tag
+    (or folder if folder is True) exists, and None otherwise.
+    '''
+    if is_path_empty(tagdir) or is_path_empty(tagpath):
+        return None
+
+    if force_windows or isinstance(tagpath, PureWindowsPath):
+        tagpath = PureWindowsPath(tagpath)
+    else:
+        tagpath = Path(tagpath)
+
+    parts = list(tagpath.parts)
+    if tagpath.anchor or not parts:
+        return None
+    elif not folder:
+        parts[-1] += extension
+
+    index = get_tags_dir_index(tagdir)
+    try:
+        start_dir = index.get_rel_dir(tagdir)
+    except ValueError:
+        return None
+
+    found_path = index.find_path(parts, folder, start_dir)
+    if found_path is None:
+        return None
+    return os.path.join(str(tagdir), found_path)
+
+
+def get_tag_file_sizes(tagdir, rel_filepaths):
+    '''
+    Returns a dict mapping each of the tagdir-relative rel_filepaths to
+    the size of its file in the shared TagsDirIndex of tagdir, or to
+    None if it doesn't exist. The case of each filepath must match the
+    case on disk, as it does for paths found by find_tag_fullpath.
+    '''
+    index = get_tags_dir_index(tagdir)
+    start_dir = index.get_rel_dir(tagdir)
+
+    sizes = {}
+    for rel_filepath in rel_filepaths:
+        info = index.get_file_info(os.path.join(start_dir, str(rel_filepath)))
+        sizes[rel_filepath] = None if info is None else info[0]
+
+    return sizes
+
+
+def locate_tags(handler, dirpath, def_ids, is_cancelled=None,
+                print_interval=5, progress_callback=None):
+    '''
+    Finds every tag of the given def_ids in dirpath(which must be inside
+    the handler's tags directory) using the shared TagsDirIndex. Returns
+    a dict mapping each of the def_ids to a sorted list of the tagsdir-
+    relative filepaths of every tag of that type. Returns None if cancelled.
+
+    Every print_interval seconds the directory currently being indexed
+    is printed, and then progress_callback is called if it is provided.
+    '''
+    index = get_tags_dir_index(handler.tagsdir)
+    c_time = time()
+
+    def print_progress(rel_dir):
+        nonlocal c_time
+        if time() - c_time > print_interval:
+            c_time = time()
+            print(' '*4, rel_dir, sep="")
+            if progress_callback is not None:
+                progress_callback()
+
+    if not index.refresh(dirpath, is_cancelled, print_progress):
+        return None
+
+    tag_paths_by_def_id = index.get_tag_paths(
+        handler.ext_id_map, def_ids, dirpath, handler.tagsdir)
+    for tag_paths in tag_paths_by_def_id.values():
+        tag_paths.sort()
+
+    return tag_paths_by_def_id
+
+
+def iter_indexed_files(dirpath, exts=None, is_cancelled=None,
+                       progress_callback=None):
+    '''
+    Refreshes the shared index containing dirpath, and yields a
+    (rel_filepath, size, mtime_ns) tuple for each file under dirpath
+    whose extension is in exts. rel_filepath is a string relative to
+    dirpath. Yields nothing if is_cancelled returns True while refreshing.
+    '''
+    if is_path_empty(dirpath):
+        return
+
+    index = get_tags_dir_index(dirpath)
+    if not index.refresh(dirpath, is_cancelled, progress_callback):
+        return
+
+    prefix_len = len(index.get_rel_dir(dirpath))
+    if prefix_len:
+        prefix_len += len(os.sep)
+
+    for rel_filepath, size, mtime_ns in index.iter_files(exts, dirpath):
+        yield rel_filepath[prefix_len:], size, mtime_ns
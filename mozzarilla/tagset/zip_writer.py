@@ -0,0 +1,313 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+A zipfile writer that compresses files in worker threads and writes them
+in the order they were added, so packaging tags isn't limited to the
+speed of a single compression stream. zlib and lzma release the GIL
+while compressing, so threads are enough to use every cpu core.
+
+zipfile can't write data that was compressed elsewhere, so the headers
+are written here. The archives it makes are readable by zipfile, and
+zip64 records are written when sizes or offsets need them.
+'''
+
+import lzma
+import os
+import struct
+import sys
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from pathlib import PurePath
+from time import localtime
+from traceback import format_exc
+from zipfile import ZIP_STORED, ZIP_DEFLATED, ZIP_LZMA
+
+ZIP_COMPRESSION_NAMES = ("stored", "deflate", "lzma")
+ZIP_COMPRESSION_METHODS = dict(
+    stored=ZIP_STORED, deflate=ZIP_DEFLATED, lzma=ZIP_LZMA)
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# most bytes of files that may be waiting to be compressed or written at
+# once. adding more files waits for the oldest ones to be written first.
+MAX_PENDING_BYTES = 256 * 1024**2
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+# the dictionary size used by each lzma preset level
+LZMA_DICT_SIZES = (1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22,
+                   1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26)
+
+# the version of the zip spec needed to extract each compression method
+EXTRACT_VERSIONS = {ZIP_STORED: 20, ZIP_DEFLATED: 20, ZIP_LZMA: 63}
+ZIP64_VERSION = 45
+# the version of the zip spec the archives are made with
+CREATE_VERSION = 63
+CREATE_SYSTEM = 0 if sys.platform == "win32" else 3
+
+FLAG_LZMA_EOS = 0x02
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD_64 = struct.Struct("<4sQ2H2L4Q")
+END_LOCATOR_64 = struct.Struct("<4sLQL")
+
+
+def compress_data(data, compress_type, compresslevel=DEFAULT_COMPRESSION_LEVEL):
+    '''Returns data compressed the way the zip compress_type stores it.'''
+    if compress_type == ZIP_STORED:
+        return data
+    elif compress_type == ZIP_DEFLATED:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+    elif compress_type != ZIP_LZMA:
+        raise ValueError("Unknown zip compression type %s" % compress_type)
+
+    dict_size = LZMA_DICT_SIZES[compresslevel]
+    # lc=3, lp=0 and pb=2 packed into one byte, followed by the dict size
+    props = struct.pack("<BL", (2*5 + 0)*9 + 3, dict_size)
+    data = lzma.compress(data, lzma.FORMAT_RAW, filters=[dict(
+        id=lzma.FILTER_LZMA1, preset=compresslevel,
+        dict_size=dict_size, lc=3, lp=0, pb=2)])
+    # lzma entries start with the version of the lzma sdk used(9.4 is what
+    # zipfile writes) and the properties of the lzma stream that follows.
+    return struct.pack("<BBH", 9, 4, len(props)) + props + data
+
+
+def get_dos_date_time(timestamp):
+    year, month, day, hour, minute, second = localtime(timestamp)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (((year - 1980) << 9) | (month << 5) | day,
+            (hour << 11) | (minute << 5) | (second // 2))
+
+
+class ZipEntry:
+    '''A file that has been read and compressed, ready to be written.'''
+    arcname = ""
+    data = b''
+    crc = 0
+    file_size = 0
+    compress_type = ZIP_STORED
+    date_time = (0, 0)
+    external_attr = 0
+
+    def __init__(self, filepath, arcname, compress_type, compresslevel):
+        with open(str(filepath), "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+
+        self.arcname = arcname
+        self.crc = zlib.crc32(data)
+        self.file_size = len(data)
+        self.compress_type = compress_type
+        self.date_time = get_dos_date_time(stat.st_mtime)
+        self.external_attr = (stat.st_mode & 0xFFFF) << 16
+        self.data = compress_data(data, compress_type, compresslevel)
+
+
+class ParallelZipWriter:
+    '''
+    Writes files to a new zipfile at filepath. Files are read and
+    compressed by thread_count threads(None means one per cpu) while
+    earlier ones are written, and are written in the order they're
+    added. compression is one of ZIP_COMPRESSION_NAMES, and compresslevel
+    is from 0 to 9 for deflate and lzma, and is ignored for stored.
+
+    Files that can't be read or compressed are skipped, and are listed
+    in errors as (filepath, error_text) tuples once they would have been
+    written. Use it as a context manager, or call close when done.
+    '''
+    filepath = None
+    compress_type = ZIP_DEFLATED
+    compresslevel = DEFAULT_COMPRESSION_LEVEL
+    max_pending_bytes = MAX_PENDING_BYTES
+
+    # arcnames of the files written so far, in the order written
+    written = ()
+    errors = ()
+
+    _file = None
+    _executor = None
+    # (filepath, size, job) tuples for each file added but not written
+    _pending = ()
+    _pending_bytes = 0
+    _central_dir = ()
+    _central_dir_count = 0
+
+    def __init__(self, filepath, compression="deflate",
+                 compresslevel=DEFAULT_COMPRESSION_LEVEL, thread_count=None,
+                 max_pending_bytes=MAX_PENDING_BYTES):
+        if compression not in ZIP_COMPRESSION_METHODS:
+            raise ValueError("Unknown zip compression '%s'. Must be one "
+                             "of %s" % (compression, ZIP_COMPRESSION_NAMES))
+
+        self.filepath = filepath
+        self.compress_type = ZIP_COMPRESSION_METHODS[compression]
+        self.compresslevel = max(0, min(9, compresslevel))
+        self.max_pending_bytes = max_pending_bytes
+        self.written = []
+        self.errors = []
+        self._pending = deque()
+        self._central_dir = []
+
+        self._file = open(str(filepath), "wb")
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, thread_count or os.cpu_count() or 1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+        self.close()
+
+    def write(self, filepath, arcname=None):
+        '''
+        Adds the file at filepath to the zipfile, stored as arcname.
+        It's compressed in a worker thread, and written once it and
+        every file added before it have been compressed.
+        '''
+        if arcname is None:
+            arcname = PurePath(filepath).as_posix().lstrip("/")
+
+        try:
+            size = os.path.getsize(str(filepath))
+        except OSError:
+            self.errors.append((filepath, format_exc()))
+            return
+
+        # wait for earlier files to be written before reading
+        # more if too much is already waiting to be written.
+        while (self._pending and
+               self._pending_bytes + size > self.max_pending_bytes):
+            self._write_next()
+
+        self._pending.append((filepath, size, self._executor.submit(
+            ZipEntry, filepath, arcname,
+            self.compress_type, self.compresslevel)))
+        self._pending_bytes += size
+
+        while self._pending and self._pending[0][2].done():
+            self._write_next()
+
+    def flush(self):
+        '''Waits for every file added so far to be written.'''
+        while self._pending:
+            self._write_next()
+
+    def cancel(self):
+        '''Skips every added file that hasn't started being compressed.'''
+        for _, __, job in self._pending:
+            job.cancel()
+
+    def close(self):
+        if self._file is None:
+            return
+
+        try:
+            self.flush()
+            self._write_end_records()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._file.close()
+            self._file = None
+
+    def _write_next(self):
+        filepath, size, job = self._pending.popleft()
+        self._pending_bytes -= size
+        try:
+            entry = job.result()
+        except CancelledError:
+            return
+        except Exception:
+            self.errors.append((filepath, format_exc()))
+            return
+
+        self._write_entry(entry)
+
+    def _write_entry(self, entry):
+        f = self._file
+        offset = f.tell()
+        compress_size = len(entry.data)
+        try:
+            arcname = entry.arcname.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            arcname = entry.arcname.encode("utf-8")
+            flags = FLAG_UTF8
+
+        if entry.compress_type == ZIP_LZMA:
+            flags |= FLAG_LZMA_EOS
+
+        extract_version = EXTRACT_VERSIONS[entry.compress_type]
+        local_extra = b''
+        local_sizes = (compress_size, entry.file_size)
+        if max(local_sizes) > ZIP64_LIMIT:
+            local_extra = struct.pack("<2H2Q", 1, 16, entry.file_size,
+                                      compress_size)
+            local_sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+            extract_version = max(extract_version, ZIP64_VERSION)
+
+        date, time = entry.date_time
+        f.write(LOCAL_HEADER.pack(
+            b"PK\003\004", extract_version, 0, flags, entry.compress_type,
+            time, date, entry.crc, local_sizes[0], local_sizes[1],
+            len(arcname), len(local_extra)))
+        f.write(arcname)
+        f.write(local_extra)
+        f.write(entry.data)
+
+        # the central directory only has zip64 values for the fields
+        # that are too large, in the order of the fields below.
+        zip64_values = [value for value in
+                        (entry.file_size, compress_size, offset)
+                        if value > ZIP64_LIMIT]
+        central_extra = b''
+        if zip64_values:
+            central_extra = struct.pack(
+                "<2H%dQ" % len(zip64_values), 1, 8*len(zip64_values),
+                *zip64_values)
+            extract_version = max(extract_version, ZIP64_VERSION)
+
+        self._central_dir.append(CENTRAL_HEADER.pack(
+            b"PK\001\002", CREATE_VERSION, CREATE_SYSTEM, extract_version, 0,
+            flags, entry.compress_type, time, date, entry.crc,
+            min(compress_size, ZIP64_LIMIT),
+            min(entry.file_size, ZIP64_LIMIT),
+            len(arcname), len(central_extra), 0, 0, 0,
+            entry.external_attr, min(offset, ZIP64_LIMIT)
+            ) + arcname + central_extra)
+        self.written.append(entry.arcname)
+
+    def _write_end_records(self):
+        f = self._file
+        count = len(self._central_dir)
+        start = f.tell()
+        for record in self._central_dir:
+            f.write(record)
+        size = f.tell() - start
+
+        if (count > ZIP_FILECOUNT_LIMIT or
+                start > ZIP64_LIMIT or size > ZIP64_LIMIT):
+            end_64_offset = f.tell()
+            f.write(END_RECORD_64.pack(
+                b"PK\006\006", END_RECORD_64.size - 12, ZIP64_VERSION,
+                ZIP64_VERSION, 0, 0, count, count, size, start))
+            f.write(END_LOCATOR_64.pack(b"PK\006\007", 0, end_64_offset, 1))
+
+        f.write(END_RECORD.pack(
+            b"PK\005\006", 0, 0, min(count, ZIP_FILECOUNT_LIMIT),
+            min(count, ZIP_FILECOUNT_LIMIT), min(size, ZIP64_LIMIT),
+            min(start, ZIP64_LIMIT), 0))
@@ -11,11 +11,18 @@
 import tkinter as tk
 
 from pathlib import Path, PureWindowsPath
+from queue import Queue, Empty
 from sys import platform
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
 
+from mozzarilla.tagset.dependency_cache import TagDependencyCache,\
+     DependencyPrefetcher
+from mozzarilla.tagset.dependency_closure import find_tag_file
+from mozzarilla.tagset.reverse_ref_index import get_ref_key
+from mozzarilla.tagset.tag_ref_reader import read_tag_refs, get_named_tag_refs
+
 # inject this default color
 BinillaWidget.active_tags_directory_color = '#%02x%02x%02x' % (40, 170, 80)
 
@@ -288,17 +295,55 @@ class DependencyFrame(HierarchyFrame):
     root_tag_text = None
     _initialized = False
     handler = None
+    # if set, the tree shows the tags that reference each tag
+    # according to this ReverseRefIndex, rather than its dependencies
+    reverse_ref_index = None
+
+    # the dependencies of tags are read from their files by the prefetcher
+    # as their items are added, so the items know if they can be expanded
+    # and expanding them is instant. the tree is never made to wait on it.
+    dependency_cache = None
+    prefetcher = None
+    # milliseconds between checks for tags the prefetcher has read
+    prefetch_poll_interval = 50
+
+    # maps the tag paths being read by the prefetcher to
+    # the set of iids of the items waiting on them
+    _waiting_items = ()
+    _read_tag_paths = None
+    _poll_job = None
+    _cache_handler = None
+    # maps tag paths to a (dependencies, children) tuple, where children is
+    # what resolve_dependencies returned for the tag's dependencies.
+    _resolved_children = ()
 
     def __init__(self, master, *args, **kwargs):
         HierarchyFrame.__init__(self, master, *args, **kwargs)
         self.handler = self.app_root.handler
+        self._waiting_items = {}
+        self._resolved_children = {}
+        self._read_tag_paths = Queue()
+        self.dependency_cache = TagDependencyCache(self.read_dependencies)
+        self.prefetcher = DependencyPrefetcher(
+            self.dependency_cache, self._read_tag_paths.put)
         self._initialized = True
 
+    def destroy(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self._poll_job is not None:
+            self.after_cancel(self._poll_job)
+            self._poll_job = None
+        HierarchyFrame.destroy(self)
+
     def apply_style(self, seen=None):
         HierarchyFrame.apply_style(self, seen)
         self.tags_tree.tag_configure(
             'badref', foreground=self.invalid_path_color,
             background=self.default_bg_color)
+        self.tags_tree.tag_configure(
+            'cycle', foreground=self.text_disabled_color,
+            background=self.default_bg_color)
 
     def get_item_tags_dir(*args, **kwargs): pass
 
@@ -314,11 +359,23 @@ def reload(self):
         if not dir_tree['columns']:
             dir_tree["columns"]=("dependency", )
             dir_tree.heading("#0", text='Filepath')
+
+        if self.reverse_ref_index is None:
             dir_tree.heading("dependency", text='Dependency path')
+        else:
+            dir_tree.heading("dependency", text='Referenced by field')
 
         if not self._initialized:
             return
 
+        # requests for the items being removed are no longer needed
+        self.prefetcher.clear()
+        self._waiting_items.clear()
+        self._resolved_children.clear()
+        if self._cache_handler is not self.handler:
+            self.dependency_cache.clear()
+            self._cache_handler = self.handler
+
         for item in dir_tree.get_children():
             try: dir_tree.delete(item)
             except Exception: pass
@@ -334,28 +391,126 @@ def reload(self):
         self.destroy_subitems(iid)
 
     def get_dependencies(self, tag_path):
+        '''
+        Returns a list of (filepath, ext, dependency_name) tuples for each
+        dependency in the tag that has a non-empty filepath. This reads
+        the tag if needed, so use get_known_dependencies to avoid waiting.
+        '''
+        if self.reverse_ref_index is not None:
+            return self.get_referencing_tags(tag_path)
+
+        tag = self.get_loaded_tag(tag_path)
+        if tag is not None:
+            return self.get_tag_dependencies(tag)
+        return self.dependency_cache.get(tag_path)
+
+    def get_known_dependencies(self, tag_path, urgent=False):
+        '''
+        Returns the dependencies of the tag the same way get_dependencies
+        does if they can be found without reading the tag. Otherwise the
+        prefetcher is asked to read them and None is returned.
+        '''
+        if self.reverse_ref_index is not None:
+            return self.get_referencing_tags(tag_path)
+
+        tag = self.get_loaded_tag(tag_path)
+        if tag is not None:
+            return self.get_tag_dependencies(tag)
+
+        dependencies = self.dependency_cache.get_cached(tag_path)
+        if dependencies is None:
+            self.prefetcher.request(tag_path, urgent)
+        return dependencies
+
+    def get_loaded_tag(self, tag_path):
+        try:
+            return self.handler.get_tag(tag_path)
+        except (KeyError, LookupError):
+            return None
+
+    def read_dependencies(self, tag_path):
+        '''
+        Returns the dependencies of the tag file at tag_path the same way
+        get_dependencies does. Only its tag references are read if possible.
+        This is called by the prefetcher, so it must not touch any widgets.
+        '''
+        try:
+            tag_refs = read_tag_refs(
+                self.handler, tag_path, with_dependency_names=True)
+        except Exception:
+            tag_refs = None
+
+        if tag_refs is not None:
+            return [tag_ref[1:] for tag_ref in tag_refs]
+
         tag = self.master.get_tag(tag_path)
         if tag is None:
             print(("Unable to load '%s'.\n" % tag_path) +
                   "    You may need to change the tag set to load this tag.")
             return ()
 
-        handler = self.handler
-        d_id = tag.def_id
-        dependency_cache = handler.tag_ref_cache.get(d_id)
-
-        if not dependency_cache:
-            return ()
+        return self.get_tag_dependencies(tag)
 
+    def get_tag_dependencies(self, tag):
         dependencies = []
-
-        for block in handler.get_nodes_by_paths(dependency_cache, tag.data):
+        for block, dependency_name in get_named_tag_refs(self.handler, tag):
             # if the node's filepath is empty, just skip it
             if not block.filepath:
                 continue
-            dependencies.append(block)
+
+            try:
+                ext = '.' + block.tag_class.enum_name
+            except Exception:
+                ext = ''
+            dependencies.append((block.filepath, ext, dependency_name))
         return dependencies
 
+    def get_referencing_tags(self, tag_path):
+        '''
+        Returns a list of (filepath, ext, field_name) tuples for each
+        reference to the tag in the tags that reverse_ref_index knows of.
+        '''
+        try:
+            rel_tag_path = Path(tag_path).relative_to(self.handler.tagsdir)
+        except ValueError:
+            return ()
+
+        referencing_tags = []
+        for filepath, block_name in (
+                self.reverse_ref_index.get_referencing_tags(rel_tag_path)):
+            filepath, ext = os.path.splitext(filepath)
+            referencing_tags.append((filepath, ext, block_name))
+        return referencing_tags
+
+    def resolve_dependencies(self, tag_path, dependencies):
+        '''
+        Returns a list of (text, dependency_name, full_path) tuples for
+        the items to show under the tag at tag_path for its dependencies,
+        using the case of the files on disk. The list is remembered until
+        the tag's dependencies change, so tags that are in the tree many
+        times(ex: shared shaders and effects) are only resolved once.
+        '''
+        key = str(tag_path)
+        resolved = self._resolved_children.get(key)
+        if resolved is not None and resolved[0] == dependencies:
+            return resolved[1]
+
+        handler = self.handler
+        children = []
+        for filepath, ext, dependency_name in dependencies:
+            rel_filepath = find_tag_file(handler, filepath, ext)
+            if rel_filepath is None:
+                # show the reference as it's written, so it's marked missing
+                if handler.treat_mode_as_mod2 and ext == '.model':
+                    ext = '.gbxmodel'
+                rel_filepath = str(Path(PureWindowsPath(filepath))) + ext
+
+            children.append((rel_filepath, dependency_name,
+                             str(Path(handler.tagsdir, rel_filepath))))
+
+        self._resolved_children[key] = (dependencies, children)
+        return children
+
     def destroy_subitems(self, iid):
         '''
         Destroys all the given items subitems and creates an empty
@@ -370,9 +525,50 @@ def destroy_subitems(self, iid):
         tag_path = Path(dir_tree.item(iid)['values'][-1])
         if not tag_path.is_file():
             dir_tree.item(iid, tags=('badref', 'item'))
-        elif self.get_dependencies(tag_path):
+            return
+
+        dependencies = self.get_known_dependencies(tag_path)
+        if dependencies is None:
+            # assume it can be expanded until the prefetcher says otherwise
+            dir_tree.insert(iid, 'end')
+            self.wait_for_dependencies(iid, tag_path)
+        elif dependencies:
             dir_tree.insert(iid, 'end')
 
+    def wait_for_dependencies(self, iid, tag_path):
+        self._waiting_items.setdefault(str(tag_path), set()).add(iid)
+        if self._poll_job is None:
+            self._poll_job = self.after(
+                self.prefetch_poll_interval, self.update_waiting_items)
+
+    def update_waiting_items(self):
+        '''
+        Updates the items waiting on tags the prefetcher has finished
+        reading, and keeps checking while any items are still waiting.
+        '''
+        self._poll_job = None
+        dir_tree = self.tags_tree
+        while True:
+            try:
+                tag_path = self._read_tag_paths.get_nowait()
+            except Empty:
+                break
+
+            for iid in self._waiting_items.pop(tag_path, ()):
+                if not dir_tree.exists(iid):
+                    continue
+                elif dir_tree.item(iid, 'open'):
+                    # the item was expanded while waiting to be read
+                    for child in dir_tree.get_children(iid):
+                        dir_tree.delete(child)
+                    self.generate_subitems(iid)
+                else:
+                    self.destroy_subitems(iid)
+
+        if self._waiting_items:
+            self._poll_job = self.after(
+                self.prefetch_poll_interval, self.update_waiting_items)
+
     def close_selected(self, e=None):
         dir_tree = self.tags_tree
         iid = dir_tree.focus()
@@ -380,46 +576,39 @@ def close_selected(self, e=None):
             self.destroy_subitems(iid)
 
     def generate_subitems(self, parent_iid):
-        tags_dir = self.handler.tagsdir
         dir_tree = self.tags_tree
         parent_tag_path = Path(dir_tree.item(parent_iid)['values'][-1])
 
         if not parent_tag_path.is_file():
             return
 
-        for tag_ref_block in self.get_dependencies(parent_tag_path):
-            filepath = Path(PureWindowsPath(tag_ref_block.filepath))
-            try:
-                ext = '.' + tag_ref_block.tag_class.enum_name
-                if (self.handler.treat_mode_as_mod2 and ext == '.model' and
-                not Path(tags_dir, str(filepath) + ".model").is_file()):
-                    ext = '.gbxmodel'
-            except Exception:
-                ext = ''
-            tag_path = str(filepath) + ext
-
-            dependency_name = tag_ref_block.NAME
-            last_block = tag_ref_block
-            parent = last_block.parent
-            while parent is not None and hasattr(parent, 'NAME'):
-                name = parent.NAME
-                f_type = parent.TYPE
-                if f_type.is_array:
-                    index = parent.index(last_block)
-                    dependency_name = '[%s].%s' % (index, dependency_name)
-                elif name not in ('tagdata', 'data'):
-                    if not last_block.TYPE.is_array:
-                        name += '.'
-                    dependency_name = name + dependency_name
-                last_block = parent
-                parent = last_block.parent
-
-            # slice off the extension and the period
-            dependency_name = dependency_name.split('.', 1)[-1]
+        dependencies = self.get_known_dependencies(
+            parent_tag_path, urgent=True)
+        if dependencies is None:
+            dir_tree.insert(parent_iid, 'end', text="Loading...",
+                            values=('', ''))
+            self.wait_for_dependencies(parent_iid, parent_tag_path)
+            return
+
+        # the tags this one is under, so references back to them are
+        # shown as a cycle rather than letting them be expanded forever.
+        ancestors = set()
+        iid = parent_iid
+        while iid:
+            ancestors.add(get_ref_key(dir_tree.item(iid)['values'][-1]))
+            iid = dir_tree.parent(iid)
+
+        for text, dependency_name, full_path in self.resolve_dependencies(
+                parent_tag_path, dependencies):
+            if get_ref_key(full_path) in ancestors:
+                dir_tree.insert(
+                    parent_iid, 'end', text=text + " (reference cycle)",
+                    tags=('cycle', 'item'), values=(dependency_name, full_path))
+                continue
 
             iid = dir_tree.insert(
-                parent_iid, 'end', text=tag_path, tags=('item',),
-                values=(dependency_name, Path(tags_dir, tag_path)))
+                parent_iid, 'end', text=text, tags=('item',),
+                values=(dependency_name, full_path))
 
             self.destroy_subitems(iid)
 
@@ -19,7 +19,8 @@
 from binilla.windows.filedialog import askopenfilename
 from binilla.widgets.field_widgets.container_frame import ContainerFrame
 from mozzarilla.widgets.field_widgets.halo_1_bitmap_display import HaloBitmapDisplayButton
-from supyr_struct.util import tagpath_to_fullpath
+from mozzarilla.tagset.tags_dir_index import find_tag_fullpath
+from mozzarilla.tagset.ref_validator import find_ref_fullpath
 
 
 class DependencyFrame(ContainerFrame):
@@ -28,6 +29,9 @@ class DependencyFrame(ContainerFrame):
     preview_btn = None
     validate_write_trace = None
     validate_entry_str = None
+    # incremented each time the filepath is validated, so results of
+    # checks that finish after the filepath changes again are ignored.
+    validate_token = 0
 
     def browse_tag(self):
         '''Opens a filepicker window to aid the user in referencing their
@@ -44,7 +48,7 @@ def browse_tag(self):
             init_dir = tags_dir
 
             try:
-                init_dir = Path(tagpath_to_fullpath(
+                init_dir = Path(find_tag_fullpath(
                         tags_dir, self.node.filepath,
                         extension=self.tag_window.tag.ext, force_windows=True)
                     ).parent
@@ -97,7 +101,7 @@ def browse_tag(self):
                 self.node.tag_class.set_to('NONE')
                 for filetype in filetypes:
                     ext = filetype[1][1:]
-                    if tagpath_to_fullpath(
+                    if find_tag_fullpath(
                             tags_dir, tag_path, extension=ext) is not None:
                         self.node.tag_class.set_to(ext[1:])
                         break
@@ -140,12 +144,12 @@ def open_tag(self):
 
             ext = '.' + self.node.tag_class.enum_name
             # Get full path with proper capitalization if it points to a file.
-            filepath = tagpath_to_fullpath(
+            filepath = find_tag_fullpath(
                 tags_dir, PureWindowsPath(self.node.filepath), extension=ext)
 
             if filepath is None and (
             new_handler.treat_mode_as_mod2 and ext == '.model'):
-                filepath = tagpath_to_fullpath(
+                filepath = find_tag_fullpath(
                     tags_dir,
                     PureWindowsPath(self.node.filepath),
                     extension='.gbxmodel')
@@ -177,12 +181,12 @@ def get_dependency_tag(self):
 
             ext = '.' + self.node.tag_class.enum_name
             # Get full path with proper capitalization if it points to a file.
-            filepath = tagpath_to_fullpath(
+            filepath = find_tag_fullpath(
                 tags_dir, PureWindowsPath(self.node.filepath), extension=ext)
 
             if filepath is None and (
             handler.treat_mode_as_mod2 and ext == '.model'):
-                filepath = tagpath_to_fullpath(
+                filepath = find_tag_fullpath(
                     tags_dir,
                     PureWindowsPath(self.node.filepath),
                     extension='.gbxmodel')
@@ -221,13 +225,13 @@ def bitmap_preview(self, e=None):
 
     def validate_filepath(self, *args):
         '''Checks if the referenced tag exists, sets text color to red if
-        it's invalid. Sets color to default if valid.'''
+        it's invalid. Sets color to default if valid. The check is done on
+        a background thread by the tag window, and is delayed while the
+        filepath is being typed(when called by the write trace).'''
         if self.node is None:
             return
 
-        desc = self.desc
-        wid = self.f_widget_ids_map.get(desc['NAME_MAP']['filepath'])
-        widget = self.f_widgets.get(wid)
+        widget = self.get_filepath_widget()
         if widget is None:
             return
 
@@ -236,32 +240,62 @@ def validate_filepath(self, *args):
         except AttributeError:
             return
 
+        # results of any check that's still running are out of date now
+        self.validate_token += 1
+        token = self.validate_token
         try:
             # Get filepath directly from the typing box
-            filepath = widget.data_entry.get()
-            if filepath == '':
+            tag_path = widget.data_entry.get()
+            if tag_path == '':
                 return
 
             ext = '.' + self.node.tag_class.enum_name
+            exts = (ext, )
+            if self.tag_window.handler.treat_mode_as_mod2 and ext == '.model':
+                exts += ('.gbxmodel', )
+
+            queue_ref_validation = getattr(
+                self.tag_window, "queue_ref_validation", None)
+            if queue_ref_validation is None:
+                self.apply_ref_validation(
+                    token, find_ref_fullpath(tags_dir, tag_path, exts))
+                return
 
-            # Get full path with proper capitalization if it points to a file.
-            filepath = tagpath_to_fullpath(
-                tags_dir, PureWindowsPath(filepath), extension=ext)
-
-            if filepath is None and (
-            self.tag_window.handler.treat_mode_as_mod2 and ext == '.model'):
-                filepath = tagpath_to_fullpath(
-                    tags_dir, PureWindowsPath(filepath), extension='.gbxmodel')
+            delay = 0
+            if args:
+                delay = self.tag_window.ref_validate_delay
 
+            queue_ref_validation(self, token, tags_dir, tag_path, exts, delay)
         except Exception:
-            filepath = None
             print("Validation of a filepath failed unexpectedly.")
             print(format_exc())
+            self.apply_ref_validation(token, None)
 
-        if filepath is not None:
-            widget.data_entry.config(fg=self.text_normal_color)
-        else:
-            widget.data_entry.config(fg=self.invalid_path_color)
+    def apply_ref_validation(self, token, filepath):
+        '''Colors the filepath by whether it was found to exist. Does
+        nothing if token isn't from the most recent validate_filepath.'''
+        if token != self.validate_token or self.node is None:
+            return
+
+        widget = self.get_filepath_widget()
+        if widget is None:
+            return
+
+        try:
+            if filepath is not None:
+                widget.data_entry.config(fg=self.text_normal_color)
+            else:
+                widget.data_entry.config(fg=self.invalid_path_color)
+        except tk.TclError:
+            # the widget was destroyed while the filepath was checked
+            pass
+
+    def get_filepath_widget(self):
+        try:
+            wid = self.f_widget_ids_map.get(self.desc['NAME_MAP']['filepath'])
+        except (KeyError, TypeError):
+            return None
+        return self.f_widgets.get(wid)
 
     def pose_fields(self):
         ContainerFrame.pose_fields(self)
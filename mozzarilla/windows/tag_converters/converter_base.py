@@ -19,6 +19,7 @@
 from binilla.windows.filedialog import askopenfilename, askdirectory
 from supyr_struct.util import path_replace, path_split
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.tags_dir_index import iter_indexed_files
 
 curr_dir = Path.cwd()
 
@@ -194,18 +195,16 @@ def do_convert_tag(self, tag_path=None, *args, **kwargs):
     def do_convert_dir(self, *args, **kwargs):
         print("Converting  %s  to  %s" % (self.src_ext, self.dst_ext))
         start = time()
-        valid_ext = "." + self.src_ext
-        for root, dirs, files in os.walk(self.tags_dir.get()):
-            for filename in files:
-                if self.stop_conversion:
-                    break
-
-                filepath = Path(root, filename)
-                if filepath.suffix.lower() == valid_ext:
-                    self.do_convert_tag(str(filepath))
-
+        tags_dir = self.tags_dir.get()
+        for rel_filepath, _, __ in iter_indexed_files(
+                tags_dir, ("." + self.src_ext, ),
+                lambda: self.stop_conversion):
             if self.stop_conversion:
-                print("    Conversion cancelled by user.")
                 break
 
+            self.do_convert_tag(os.path.join(tags_dir, rel_filepath))
+
+        if self.stop_conversion:
+            print("    Conversion cancelled by user.")
+
         print('    Finished. Took %s seconds.\n' % round(time() - start, 1))
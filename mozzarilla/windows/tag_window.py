@@ -7,7 +7,10 @@
 # See LICENSE for more information.
 #
 
+from traceback import format_exc
+
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.ref_validator import TagRefValidator
 from binilla.windows.tag_window import TagWindow, ConfigWindow
 from supyr_struct.util import is_path_empty
 
@@ -15,9 +18,26 @@
 
 
 class HaloTagWindow(TagWindow):
+    # checks the tag references shown in this window on a background thread
+    ref_validator = None
+    # milliseconds to wait after the last edit to a reference
+    # before checking if the tag it references exists.
+    ref_validate_delay = 300
+    ref_validate_poll_interval = 50
+
+    _ref_validate_job = None
+    _ref_results_job = None
+    # maps widgets to the (token, tags_dir, tag_path, exts)
+    # of the references they are waiting to have checked.
+    _queued_ref_validations = ()
+    # maps widgets to the token of the check they're waiting on the result of
+    _waiting_ref_validations = ()
+
     def __init__(self, master, tag=None, *args, **kwargs):
         app_root   = kwargs.get('app_root', master)
         is_new_tag = kwargs.get('is_new_tag', self.is_new_tag)
+        self._queued_ref_validations = {}
+        self._waiting_ref_validations = {}
         TagWindow.__init__(self, master, *args, tag=tag, **kwargs)
 
     def post_toplevel_init(self):
@@ -26,6 +46,81 @@ def post_toplevel_init(self):
 
         TagWindow.post_toplevel_init(self)
 
+    def destroy(self):
+        declined = TagWindow.destroy(self)
+        if not declined:
+            self.stop_ref_validation()
+        return declined
+
+    def queue_ref_validation(self, widget, token, tags_dir, tag_path, exts,
+                             delay=0):
+        '''
+        Queues checking if the tag the windows-style tag_path references
+        exists in tags_dir with any of the extensions in exts. Every
+        reference queued before the delay(in milliseconds) runs out is
+        checked together on a background thread, and each widget has
+        apply_ref_validation(token, filepath) called with the result.
+        Queueing another check for the same widget replaces the last one
+        and restarts the delay, so typing is only checked once it stops.
+        '''
+        self._queued_ref_validations[widget] = (token, tags_dir, tag_path, exts)
+        if self._ref_validate_job is not None:
+            self.after_cancel(self._ref_validate_job)
+
+        self._ref_validate_job = self.after(
+            max(0, delay), self._send_ref_validations)
+
+    def stop_ref_validation(self):
+        for job in (self._ref_validate_job, self._ref_results_job):
+            if job is not None:
+                try:
+                    self.after_cancel(job)
+                except Exception:
+                    pass
+
+        self._ref_validate_job = self._ref_results_job = None
+        self._queued_ref_validations.clear()
+        self._waiting_ref_validations.clear()
+        if self.ref_validator is not None:
+            self.ref_validator.stop()
+            self.ref_validator = None
+
+    def _send_ref_validations(self):
+        self._ref_validate_job = None
+        if self.ref_validator is None:
+            self.ref_validator = TagRefValidator()
+
+        queued = self._queued_ref_validations
+        self._queued_ref_validations = {}
+        for widget, (token, tags_dir, tag_path, exts) in queued.items():
+            self._waiting_ref_validations[widget] = token
+            self.ref_validator.request(widget, token, tags_dir, tag_path, exts)
+
+        if self._ref_results_job is None and self._waiting_ref_validations:
+            self._ref_results_job = self.after(
+                self.ref_validate_poll_interval, self._apply_ref_results)
+
+    def _apply_ref_results(self):
+        self._ref_results_job = None
+        if self.ref_validator is None:
+            return
+
+        waiting = self._waiting_ref_validations
+        for widget, token, filepath in self.ref_validator.get_results():
+            # ignore results for references that have been changed since
+            if waiting.get(widget) != token:
+                continue
+
+            del waiting[widget]
+            try:
+                widget.apply_ref_validation(token, filepath)
+            except Exception:
+                print(format_exc())
+
+        if waiting:
+            self._ref_results_job = self.after(
+                self.ref_validate_poll_interval, self._apply_ref_results)
+
     def save(self, **kwargs):
         '''Flushes any lingering changes in the widgets to the tag.'''
         flags = self.app_root.config_file.data.mozzarilla.flags
@@ -24,6 +24,7 @@
      compress_animation, decompress_animation
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.tags_dir_index import iter_indexed_files
 from supyr_struct.util import is_path_empty
 
 if __name__ == "__main__":
@@ -272,14 +273,12 @@ def _do_all_compression(self, compress):
                 print("    Model_animations %sion cancelled." % compress)
                 return
 
-        for root, _, files in os.walk(antr_dir):
-            for fname in files:
-                try:
-                    if Path(fname).suffix.lower() != ".model_animations":
-                        continue
-                    self._do_compression(compress, Path(root, fname))
-                except Exception:
-                    pass#print(format_exc())
+        for rel_filepath, _, __ in iter_indexed_files(
+                antr_dir, (".model_animations", )):
+            try:
+                self._do_compression(compress, Path(antr_dir, rel_filepath))
+            except Exception:
+                pass#print(format_exc())
 
     def _do_compression(self, compress, antr_path=None):
         state = "compress" if compress else "decompress"
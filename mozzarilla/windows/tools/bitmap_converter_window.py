@@ -10,12 +10,19 @@
 import ctypes
 import gc
 import os
+import shutil
 import sys
 import tkinter as tk
 import weakref
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import redirect_stdout
 from copy import deepcopy
+from io import StringIO
+from itertools import compress
+from math import log
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from threading import Thread
 from time import time
 from traceback import format_exc
@@ -25,15 +32,20 @@
 from reclaimer.bitmaps.p8_palette import HALO_P8_PALETTE, STUBBS_P8_PALETTE
 from reclaimer.hek.defs.bitm import bitm_def
 from reclaimer.constants import TYPE_NAME_MAP, FORMAT_NAME_MAP,\
-     I_FORMAT_NAME_MAP
+     I_FORMAT_NAME_MAP, BITMAP_PADDING, CUBEMAP_PADDING
 
 from binilla.util import do_subprocess, ProcController
+from binilla.widgets import get_mouse_delta
 from binilla.widgets.binilla_widget import BinillaWidget
 from binilla.widgets.scroll_menu import ScrollMenu
 from binilla.windows.filedialog import askdirectory, asksaveasfilename
 from mozzarilla.widgets.field_widgets import HaloBitmapDisplayFrame,\
      HaloBitmapDisplayBase
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.bitmap_catalogue import open_bitmap_catalogue
+from mozzarilla.tagset.bitmap_metadata import read_bitmap_metadata
+from mozzarilla.tagset.p8_palette_picker import get_p8_palette_picker
+from mozzarilla.tagset.tags_dir_index import iter_indexed_files
 
 window_base_class = tk.Toplevel
 if __name__ == "__main__":
@@ -62,6 +74,10 @@
 PARAM_FORMAT_TO_FORMAT = (-1, ) + VALID_FORMAT_ENUMS
 FORMAT_OPTIONS = ("Unchanged", ) + tuple(BITMAP_FORMATS[i] for i in VALID_FORMAT_ENUMS)
 
+# bitmaps whose pixels take up more than this many bytes when unpacked
+# are converted one mipmap, cube face or 3d texture at a time.
+SURFACE_CONVERSION_MIN_SIZE = 4 * 1024**2
+
 HALO_1_TYPE_COUNT   = 4
 HALO_1_FORMAT_COUNT = 18
 
@@ -112,8 +128,17 @@ class BitmapInfo:
     depth = 0
     mipmaps = 0
 
-    def __init__(self, bitmap_block=None):
-        if not bitmap_block:
+    def __init__(self, bitmap_block=None, bitmap_metadata=None):
+        if bitmap_metadata:
+            self.type = bitmap_metadata.type
+            self.format = bitmap_metadata.format
+            self.swizzled = bitmap_metadata.swizzled
+            self.width = bitmap_metadata.width
+            self.height = bitmap_metadata.height
+            self.depth = bitmap_metadata.depth
+            self.mipmaps = bitmap_metadata.mipmaps
+            return
+        elif not bitmap_block:
             return
         self.type = bitmap_block.type.data
         self.format = bitmap_block.format.data
@@ -130,9 +155,17 @@ class BitmapTagInfo:
     tiff_data_size = 0
     bitmap_infos = ()
 
-    def __init__(self, bitm_tag=None):
+    def __init__(self, bitm_tag=None, tag_metadata=None):
         self.bitmap_infos = []
-        if not bitm_tag:
+        if tag_metadata:
+            self.tiff_data_size = tag_metadata.tiff_data_size
+            self.pixel_data_size = tag_metadata.pixel_data_size
+            for bitmap in tag_metadata.bitmaps:
+                self.bitmap_infos.append(BitmapInfo(bitmap_metadata=bitmap))
+
+            self.platform = tag_metadata.is_xbox_bitmap
+            return
+        elif not bitm_tag:
             return
 
         bitm_data = bitm_tag.data.tagdata
@@ -154,6 +187,21 @@ def swizzled(self):
         return 0 if not self.bitmap_infos else self.bitmap_infos[0].swizzled
 
 
+def read_bitmap_tag_info(filepath, bitm_def=bitm_def):
+    '''
+    Returns a BitmapTagInfo of the bitmap tag at filepath, reading only
+    its metadata from the file. If that can't be done the tag is built
+    instead, which raises an exception if the tag is malformed.
+    '''
+    try:
+        return BitmapTagInfo(tag_metadata=read_bitmap_metadata(filepath))
+    except Exception:
+        pass
+
+    bitm_tag = bitm_def.build(filepath=filepath)
+    return BitmapTagInfo(bitm_tag) if bitm_tag else None
+
+
 def get_will_be_converted(flags, tag_info):
     if flags.platform != tag_info.platform:
         return True
@@ -177,6 +225,127 @@ def get_will_be_converted(flags, tag_info):
     return False
 
 
+def get_will_fail_to_palettize(conv_flags, bitmap_info):
+    '''
+    Returns whether converting the bitmap to P8-bump would fail. There's
+    only a palette picker for 4 channel formats, so convert_bitmap_tag
+    fails on anything else and leaves the whole tag unchanged.
+    '''
+    fmt_t = PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]
+    if fmt_t < 0 or BITMAP_FORMATS[fmt_t] != ab.FORMAT_P8_BUMP:
+        return False
+    elif BITMAP_TYPES[bitmap_info.type] in (ab.TYPE_CUBEMAP, ab.TYPE_3D):
+        # these stay in their current format rather than failing
+        return False
+    return ab.CHANNEL_COUNTS[BITMAP_FORMATS[bitmap_info.format]] != 4
+
+
+def get_type_format_key(typ, fmt):
+    '''
+    Returns a number from 0 to 255 unique to the bitmap type and format,
+    used to filter the bitmaps in the Bitmap Converter by both at once.
+    '''
+    return typ * HALO_1_FORMAT_COUNT + fmt
+
+
+def get_target_format(conv_flags, bitmap_info):
+    '''
+    Returns the arbytmap format the bitmap would be converted to,
+    following the same rules as convert_bitmap_tag.
+    '''
+    typ = BITMAP_TYPES[bitmap_info.type]
+    fmt_s = BITMAP_FORMATS[bitmap_info.format]
+    fmt_t = PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]
+    fmt_t = fmt_s if fmt_t < 0 else BITMAP_FORMATS[fmt_t]
+
+    if fmt_t == ab.FORMAT_P8_BUMP and typ in (ab.TYPE_CUBEMAP, ab.TYPE_3D):
+        return fmt_s
+    elif get_will_fail_to_palettize(conv_flags, bitmap_info):
+        return fmt_s
+    elif fmt_t in ab.DDS_FORMATS and typ == ab.TYPE_3D:
+        return fmt_s
+    return fmt_t
+
+
+def get_pixel_data_size(fmt, typ, width, height, depth, mipmaps, platform):
+    '''
+    Returns the number of bytes of pixel data a bitmap of the given arbytmap
+    format and type, dimensions and number of mipmaps takes up in a tag,
+    including the padding added to xbox and P8-bump bitmaps.
+    '''
+    face_size = 0
+    for mip in range(mipmaps + 1):
+        w, h, d = ab.get_mipmap_dimensions(width, height, depth, mip)
+        if fmt == ab.FORMAT_P8_BUMP:
+            face_size += w*h*d
+        else:
+            face_size += ab.bitmap_io.get_pixel_bytes_size(fmt, w, h, d)
+
+    padded = platform or fmt == ab.FORMAT_P8_BUMP
+    size = face_size
+    if typ == ab.TYPE_CUBEMAP:
+        size = (face_size + (-face_size % CUBEMAP_PADDING if padded else 0))*6
+
+    return size + (-size % BITMAP_PADDING if padded else 0)
+
+
+def get_texel_count(bitmap_info):
+    '''Returns the number of pixels in the bitmap and its mipmaps.'''
+    faces = 6 if BITMAP_TYPES[bitmap_info.type] == ab.TYPE_CUBEMAP else 1
+    return faces * sum(
+        w*h*d for w, h, d in (
+            ab.get_mipmap_dimensions(bitmap_info.width, bitmap_info.height,
+                                     bitmap_info.depth, mip)
+            for mip in range(bitmap_info.mipmaps + 1)))
+
+
+def get_converted_bitmap_size(conv_flags, bitmap_info):
+    '''
+    Returns the number of bytes of pixel data the bitmap would take up
+    after being converted as conv_flags says to, without converting it.
+    Downresing and mipmap generation are done the same way arbytmap does.
+    '''
+    typ = BITMAP_TYPES[bitmap_info.type]
+    fmt_s = BITMAP_FORMATS[bitmap_info.format]
+    fmt_t = get_target_format(conv_flags, bitmap_info)
+    w, h, d = bitmap_info.width, bitmap_info.height, bitmap_info.depth
+    mipmaps = bitmap_info.mipmaps
+
+    # arbytmap downreses by dropping the largest mipmaps first,
+    # and then by downsampling what's left if that wasn't enough.
+    for _ in range(conv_flags.downres):
+        w, h, d = ab.clip_dimensions(w//2, h//2, d//2)
+        mipmaps = max(0, mipmaps - 1)
+
+    # mipmaps aren't generated for bitmaps that stay palettized
+    if conv_flags.mip_gen and not (fmt_s == fmt_t == ab.FORMAT_P8_BUMP):
+        mipmaps = max(mipmaps, int(log(max(w, h, d), 2)))
+
+    return get_pixel_data_size(fmt_t, typ, w, h, d, mipmaps,
+                               conv_flags.platform)
+
+
+def get_converted_tag_size(conv_flags, tag_info):
+    '''
+    Returns the number of bytes of pixel data the bitmap tag would have
+    after being converted as conv_flags says to, without converting it.
+    '''
+    if not get_will_be_converted(conv_flags, tag_info):
+        return tag_info.pixel_data_size
+
+    for info in tag_info.bitmap_infos:
+        if get_will_fail_to_palettize(conv_flags, info):
+            return tag_info.pixel_data_size
+
+        # convert_bitmap_tag doesn't convert non-power-of-2 bitmaps
+        if any(dim & (dim - 1) for dim in (info.width, info.height,
+                                           info.depth)):
+            return tag_info.pixel_data_size
+
+    return sum(get_converted_bitmap_size(conv_flags, info)
+               for info in tag_info.bitmap_infos)
+
+
 def get_channel_mappings(conv_flags, bitmap_info):
     mono_swap = conv_flags.mono_swap
     fmt_s = FORMAT_NAME_MAP[bitmap_info.format]
@@ -252,7 +421,46 @@ def get_channel_mappings(conv_flags, bitmap_info):
     return chan_map, chan_merge_map
 
 
-def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
+def convert_texture_by_surface(arb, tex_root, tex_info, conv_settings):
+    '''
+    Converts each mipmap, cube face and 3d texture in tex_root, the pixel
+    data block of a bitmap, by itself, replacing each one in tex_root as
+    soon as it's converted. This way only one of them is unpacked at a time
+    rather than the whole bitmap, and the unconverted pixel data is freed as
+    it goes. Can't be used to downres or generate mipmaps, as those need
+    every mipmap at once. Returns True if every one was converted.
+    '''
+    width, height, depth = (tex_info["width"], tex_info["height"],
+                            tex_info["depth"])
+    sub_bitmap_count = tex_info["sub_bitmap_count"]
+    palettes = tex_info.get("palette")
+    texture_type = tex_info["texture_type"]
+    if texture_type == ab.TYPE_CUBEMAP:
+        # each face is converted as a 2d texture
+        texture_type = ab.TYPE_2D
+
+    for i in range(len(tex_root)):
+        w, h, d = ab.get_mipmap_dimensions(width, height, depth,
+                                           i // sub_bitmap_count)
+        surface_info = dict(
+            tex_info, width=w, height=h, depth=d, mipmap_count=0,
+            sub_bitmap_count=1, texture_type=texture_type)
+        if palettes is not None:
+            surface_info["palette"] = palettes[i: i + 1]
+
+        arb.load_new_texture(texture_block=[tex_root[i]],
+                             texture_info=surface_info)
+        arb.load_new_conversion_settings(**conv_settings)
+        if not arb.convert_texture():
+            return False
+
+        tex_root[i] = arb.texture_block[0]
+
+    return True
+
+
+def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False,
+                       fast_p8=True):
     for i in range(tag.bitmap_count()):
         if not tag.is_power_of_2_bitmap(i):
             return False
@@ -275,14 +483,23 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
     tag.parse_bitmap_blocks()
     pixel_data = tag.data.tagdata.processed_pixel_data.data
 
+    # downresing and generating mipmaps need every mipmap of a bitmap at
+    # once, as does extracting it, but otherwise each mipmap, cube face
+    # and 3d texture of large bitmaps is converted by itself to use less
+    # memory. small ones aren't worth the overhead of converting that way.
+    can_convert_by_surface = not(conv_flags.downres or conv_flags.mip_gen or
+                                 (extract_ext and conv_flags.extract_path))
+
     for i in range(tag.bitmap_count()):
         typ   = BITMAP_TYPES[tag.bitmap_type(i)]
         fmt_s = BITMAP_FORMATS[tag.bitmap_format(i)]
         fmt_t = fmt_s if conv_flags.new_format <= 0 else new_format
 
-        #get the texture block to be loaded
-        tex_block = list(pixel_data[i])
+        tex_root = pixel_data[i]
         tex_info = tag.tex_infos[i]
+        convert_by_surface = can_convert_by_surface and (
+            4 * tex_info["width"] * tex_info["height"] * tex_info["depth"] *
+            tex_info["sub_bitmap_count"] > SURFACE_CONVERSION_MIN_SIZE)
 
         if fmt_t == ab.FORMAT_P8_BUMP and typ in (ab.TYPE_CUBEMAP, ab.TYPE_3D):
             print("Cannot convert cubemaps or 3d textures to P8.")
@@ -303,7 +520,7 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
 
         if "palette" in tex_info:
             tex_info["palette"] = [
-                p8_palette.p8_palette_32bit_packed] * len(tex_block)
+                p8_palette.p8_palette_32bit_packed] * len(tex_root)
 
         # we want to preserve the color key transparency of
         # the original image if converting to the same format
@@ -313,12 +530,10 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
                 ck_trans = True
 
         if ab.CHANNEL_COUNTS[fmt_s] == 4:
-            if not ck_trans or fmt_s in (ab.FORMAT_X8R8G8B8, ab.FORMAT_R5G6B5):
-                palette_picker = p8_palette.argb_array_to_p8_array_best_fit
-            else:
-                palette_picker = p8_palette.argb_array_to_p8_array_best_fit_alpha
-
-        arb.load_new_texture(texture_block=tex_block, texture_info=tex_info)
+            keep_alpha = ck_trans and fmt_s not in (ab.FORMAT_X8R8G8B8,
+                                                    ab.FORMAT_R5G6B5)
+            palette_picker = get_p8_palette_picker(
+                p8_palette, keep_alpha, fast_p8)
 
         # build the initial conversion settings list from the above settings
         conv_settings = dict(
@@ -328,6 +543,21 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
             color_key_transparency=ck_trans, mipmap_gen=conv_flags.mip_gen,
             channel_mapping=chan_map, channel_merge_mapping=chan_merge_map)
 
+        if convert_by_surface:
+            if not do_conversion:
+                continue
+            elif not convert_texture_by_surface(arb, tex_root, tex_info,
+                                                conv_settings):
+                print("Error occurred while converting:\n\t%s\n" % tag.filepath)
+                return False
+
+            tex_info["format"] = arb.format
+            tag.swizzled(i, arb.swizzled)
+            tag.bitmap_format(i, I_FORMAT_NAME_MAP[arb.format])
+            continue
+
+        arb.load_new_texture(texture_block=list(tex_root),
+                             texture_info=tex_info)
         arb.load_new_conversion_settings(**conv_settings)
 
         if extract_ext and conv_flags.extract_path:
@@ -341,7 +571,6 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
             tag.tex_infos[i] = arb.texture_info  # tex_info may have changed
 
             if success:
-                tex_root = pixel_data[i]
                 tex_root.parse(initdata=arb.texture_block,
                                clear=False, init_attrs=False)
                 tag.swizzled(i, arb.swizzled)
@@ -361,6 +590,53 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
     return True
 
 
+def convert_bitmap_file(filepath, conv_flags, bitmap_info, use_stubbs_p8=False,
+                        backup=True, bitm_def=bitm_def, fast_p8=True):
+    '''
+    Prunes, converts and extracts the bitmap tag at filepath as conv_flags
+    says to. Returns True if the tag was processed, or False if there was
+    nothing to do to it.
+    '''
+    pruning = conv_flags.prune_tiff
+    extracting = conv_flags.extract_to != 0
+    converting = get_will_be_converted(conv_flags, bitmap_info)
+    if not(pruning or converting or extracting):
+        return False
+
+    tag = bitm_def.build(filepath=filepath)
+    if pruning:
+        tag.data.tagdata.compressed_color_plate_data.data = bytearray()
+
+    if converting or extracting:
+        convert_bitmap_tag(tag, conv_flags, bitmap_info,
+                           use_stubbs_p8=use_stubbs_p8, fast_p8=fast_p8)
+
+    if converting or pruning:
+        tag.serialize(temp=False, calc_pointers=False, backup=backup)
+
+    return True
+
+
+def _convert_bitmap_in_worker(tags_dir, fp, conv_flags, bitmap_info,
+                              use_stubbs_p8, backup, fast_p8):
+    # what worker processes print doesn't reach the window's console,
+    # so it's sent back with the result to be printed there instead.
+    output = StringIO()
+    processed = False
+    with redirect_stdout(output):
+        try:
+            processed = convert_bitmap_file(
+                os.path.join(tags_dir, fp), conv_flags, bitmap_info,
+                use_stubbs_p8, backup, fast_p8=fast_p8)
+        except Exception:
+            print(format_exc())
+            print("Could not convert: %s" % fp)
+
+        gc.collect()
+
+    return processed, output.getvalue()
+
+
 class BitmapConverterWindow(window_base_class, BinillaWidget):
     app_root = None
     tag_list_frame = None
@@ -368,6 +644,7 @@ class BitmapConverterWindow(window_base_class, BinillaWidget):
     last_load_dir = ''
 
     use_stubbs_p8 = None
+    fast_p8 = None
     read_only = None
     backup_tags = None
     open_log = None
@@ -383,6 +660,15 @@ class BitmapConverterWindow(window_base_class, BinillaWidget):
     _settings_enabled = True
 
     print_interval = 5
+    # number of bitmaps converted to estimate how long converting
+    # all of them would take when making a log in read-only mode
+    estimate_sample_count = 3
+    # bitmaps with more pixels than this aren't sampled unless there are
+    # none smaller, so estimating doesn't spend minutes converting one.
+    estimate_sample_max_texels = 1024**2
+    # number of processes to convert bitmaps with when converting using
+    # multiple processes. None means one per cpu.
+    process_count = None
 
     # these cache references to the settings widgets for iteratively
     # enabling/disabling settings before and after converting.
@@ -420,6 +706,8 @@ def __init__(self, app_root, *args, **kwargs):
         self.backup_tags = tk.BooleanVar(self, True)
         self.open_log = tk.BooleanVar(self, True)
         self.use_stubbs_p8 = tk.BooleanVar(self)
+        self.fast_p8 = tk.BooleanVar(self, True)
+        self.convert_multiprocessed = tk.BooleanVar(self, False)
 
         self.scan_dir_path = tk.StringVar(self)
         self.data_dir_path = tk.StringVar(self)
@@ -516,6 +804,12 @@ def __init__(self, app_root, *args, **kwargs):
         self.use_stubbs_p8_cbutton = tk.Checkbutton(
             self.global_params_frame, text="Use Stubbs p8 palette �",
             variable=self.use_stubbs_p8)
+        self.convert_multiprocessed_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Multiple processes �",
+            variable=self.convert_multiprocessed)
+        self.fast_p8_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Fast p8 palette matching �",
+            variable=self.fast_p8)
 
 
         self.read_only_cbutton.tooltip_string = (
@@ -529,6 +823,14 @@ def __init__(self, app_root, *args, **kwargs):
         self.use_stubbs_p8_cbutton.tooltip_string = (
             "Use Stubbs the Zombie's p8-bump palette\n"
             "instead of Halo's for P8-bump textures.")
+        self.fast_p8_cbutton.tooltip_string = (
+            "Picks the p8-bump palette color of every pixel at once\n"
+            "when converting to P8-bump, which is much faster on large\n"
+            "bitmaps. The result is identical either way. Needs numpy.")
+        self.convert_multiprocessed_cbutton.tooltip_string = (
+            "Splits the bitmaps to convert between one process per cpu\n"
+            "core. Starting the processes takes a few seconds, so this\n"
+            "is only faster when converting a large number of bitmaps.")
 
 
         self.platform_menu = ScrollMenu(
@@ -667,6 +969,8 @@ def __init__(self, app_root, *args, **kwargs):
         self.backup_tags_cbutton.grid(row=0, column=1, sticky='w')
         self.open_log_cbutton.grid(row=0, column=2, sticky='w')
         self.use_stubbs_p8_cbutton.grid(row=0, column=3, sticky='w')
+        self.convert_multiprocessed_cbutton.grid(row=0, column=4, sticky='w')
+        self.fast_p8_cbutton.grid(row=0, column=5, sticky='w')
 
         i = 0
         widgets = (self.platform_menu, self.format_menu, self.extract_to_menu,
@@ -751,7 +1055,9 @@ def __init__(self, app_root, *args, **kwargs):
         self.buttons = (self.scan_dir_browse_button, self.scan_button,
                         self.log_file_browse_button, self.convert_button)
         self.checkbuttons = (self.read_only_cbutton, self.backup_tags_cbutton,
-                             self.open_log_cbutton, self.use_stubbs_p8_cbutton)
+                             self.open_log_cbutton, self.use_stubbs_p8_cbutton,
+                             self.convert_multiprocessed_cbutton,
+                             self.fast_p8_cbutton)
         self.spinboxes = (self.downres_box, self.alpha_bias_box)
         self.menus = (self.platform_menu, self.format_menu,
                       self.extract_to_menu, self.prune_tiff_menu,
@@ -811,11 +1117,8 @@ def set_conversion_flag(self, widget, flag_name):
             return
 
         conv_flags = self.conversion_flags
-        path_listbox = self.tag_list_frame.path_listbox
-        update_color = self.tag_list_frame.update_path_listbox_entry_color
-        for i in path_listbox.curselection():
-            fp = path_listbox.get(i)
-
+        update_color = self.tag_list_frame.update_path_color
+        for fp in sorted(self.tag_list_frame.selected_paths):
             bitm_tag_info = self.bitmap_tag_infos.get(fp)
             if flag_name == "new_format" and bitm_tag_info:
                 fmt = PARAM_FORMAT_TO_FORMAT[new_value]
@@ -829,7 +1132,7 @@ def set_conversion_flag(self, widget, flag_name):
             if conv_flags.get(fp):
                 setattr(conv_flags[fp], flag_name, new_value)
 
-            update_color(i)
+            update_color(fp)
 
     def initialize_conversion_flags(self):
         data_dir = self.data_dir_path.get()
@@ -874,51 +1177,61 @@ def _scan(self):
             c_time = s_time
             p_int = self.print_interval
 
-            seen_files = set()  # keep track of all absolute filepaths seen
             scan_dir = self.loaded_tags_dir
-            for root, _, files in os.walk(scan_dir):
-                rel_root = Path(os.path.relpath(root, scan_dir))
-                root = Path(root)
-
-                for filename in files:
-                    if Path(filename).suffix.lower() != ".bitmap":
-                        continue
-
-                    # We use an absolute path here because we later store the
-                    # bitmap tag info as hash keys. This is just so that we
-                    # don't do any double conversions.
+            # bitmaps that haven't changed since the last scan are
+            # read from the catalogue instead of from their files.
+            catalogue = open_bitmap_catalogue(scan_dir)
+            rel_filepaths = []
+            for rel_filepath, size, mtime_ns in iter_indexed_files(
+                    scan_dir, (".bitmap", ), lambda: self._cancel_processing):
+                if time() - c_time > p_int:
+                    c_time = time()
+                    print('    ' + rel_filepath)
+                    if self.app_root:
+                        self.app_root.update_idletasks()
+
+                if self._cancel_processing:
+                    break
+
+                rel_filepaths.append(rel_filepath)
+                filepath = Path(scan_dir, rel_filepath)
+                tag_info = None
+                if catalogue is not None:
                     try:
-                        filepath = root.joinpath(filename).resolve()
-                        if filepath in seen_files:
-                            continue
-
-                        seen_files.add(filepath)
-                    except FileNotFoundError:
-                        continue
+                        tag_info = BitmapTagInfo(
+                            tag_metadata=catalogue.read_metadata(
+                                rel_filepath, size, mtime_ns))
+                    except Exception:
+                        pass
 
-                    rel_filepath = str(rel_root.joinpath(filename))
-                    if time() - c_time > p_int:
-                        c_time = time()
-                        print('    ' + rel_filepath)
-                        if self.app_root:
-                            self.app_root.update_idletasks()
+                try:
+                    if tag_info is None:
+                        tag_info = read_bitmap_tag_info(
+                            filepath, self.bitm_def)
+                except Exception:
+                    print(format_exc())
 
-                    if self._cancel_processing:
-                        print('Bitmap scanning cancelled.\n')
-                        self.after(0, self.enable_settings)
-                        return
+                if not tag_info:
+                    print("Could not load: %s" % filepath)
+                    continue
 
-                    try:
-                        bitm_tag = self.bitm_def.build(filepath=filepath)
-                    except Exception:
-                        print(format_exc())
-                        bitm_tag = None
+                self.bitmap_tag_infos[rel_filepath] = tag_info
 
-                    if not bitm_tag:
-                        print("Could not load: %s" % filepath)
-                        continue
+            if catalogue is not None:
+                # save even if cancelled so the work done so far isn't lost
+                try:
+                    if not self._cancel_processing:
+                        catalogue.remove_missing(rel_filepaths)
+                    catalogue.save()
+                except Exception:
+                    print(format_exc())
+                    print("Could not save the bitmap catalogue.")
+                catalogue.close()
 
-                    self.bitmap_tag_infos[rel_filepath] = BitmapTagInfo(bitm_tag)
+            if self._cancel_processing:
+                print('Bitmap scanning cancelled.\n')
+                self.after(0, self.enable_settings)
+                return
 
             print("    Finished in %s seconds." % int(time() - s_time))
         except Exception:
@@ -959,41 +1272,15 @@ def _convert(self):
 
         else:
             print("Converting bitmaps...")
-            tags_dir = self.loaded_tags_dir
-
-            for fp in sorted(self.bitmap_tag_infos):
-                try:
-                    if self._cancel_processing:
-                        print("Conversion cancelled by user.")
-                        break
-
-                    bitmap_info = self.bitmap_tag_infos[fp]
-                    conv_flags = self.conversion_flags[fp]
-                    pruning = conv_flags.prune_tiff
-                    extracting = conv_flags.extract_to != 0
-                    converting = get_will_be_converted(conv_flags, bitmap_info)
-                    if pruning or converting or extracting:
-                        tag = self.bitm_def.build(filepath=os.path.join(tags_dir, fp))
-                        if pruning:
-                            tag.data.tagdata.compressed_color_plate_data.data = bytearray()
-
-                        if converting or extracting:
-                            convert_bitmap_tag(tag, conv_flags, bitmap_info,
-                                               use_stubbs_p8=self.use_stubbs_p8.get())
-
-                        if converting or pruning:
-                            tag.serialize(temp=False, calc_pointers=False,
-                                          backup=self.backup_tags.get())
-
-                        self.bitmap_tag_infos.pop(fp, None)
-                        self.conversion_flags.pop(fp, None)
-                        self.bitmap_display_windows.pop(fp, None)
-
-                        del tag
-                        gc.collect()
-                except Exception:
-                    print(format_exc())
-                    print("Could not convert: %s" % fp)
+            # read these here, since tkinter variables
+            # shouldn't be read from the worker processes
+            use_stubbs_p8 = self.use_stubbs_p8.get()
+            backup = self.backup_tags.get()
+            fast_p8 = self.fast_p8.get()
+            if self.convert_multiprocessed.get():
+                self.convert_in_processes(use_stubbs_p8, backup, fast_p8)
+            else:
+                self.convert_in_thread(use_stubbs_p8, backup, fast_p8)
 
         print("    Finished in %s seconds." % int(time() - s_time))
 
@@ -1001,6 +1288,86 @@ def _convert(self):
         self.after(0, self.enable_settings)
         self.after(0, self.tag_list_frame.display_sorted_tags)
 
+    def convert_in_thread(self, use_stubbs_p8, backup, fast_p8=True):
+        tags_dir = self.loaded_tags_dir
+        for fp in sorted(self.bitmap_tag_infos):
+            try:
+                if self._cancel_processing:
+                    print("Conversion cancelled by user.")
+                    break
+
+                if convert_bitmap_file(
+                        os.path.join(tags_dir, fp), self.conversion_flags[fp],
+                        self.bitmap_tag_infos[fp], use_stubbs_p8, backup,
+                        self.bitm_def, fast_p8):
+                    self.finish_processing(fp)
+                    gc.collect()
+            except Exception:
+                print(format_exc())
+                print("Could not convert: %s" % fp)
+
+    def convert_in_processes(self, use_stubbs_p8, backup, fast_p8=True):
+        '''
+        Converts the bitmaps using a pool of worker processes, giving each
+        one a tag to convert at a time. Tags are listed as converted as soon
+        as their process finishes them. If cancelled, tags being converted
+        are finished so none are left half written, but no more are started.
+        '''
+        process_count = max(1, self.process_count or os.cpu_count() or 1)
+        print("Converting using %s processes..." % process_count)
+        tags_dir = self.loaded_tags_dir
+
+        # only send the tags that have something to be done to them
+        fps = iter([fp for fp in sorted(self.bitmap_tag_infos)
+                    if self.get_will_be_processed(fp)])
+        jobs = {}
+        cancelled = False
+        with ProcessPoolExecutor(max_workers=process_count) as executor:
+            while True:
+                if self._cancel_processing and not cancelled:
+                    print("Conversion cancelled by user.")
+                    cancelled = True
+                    for job in tuple(jobs):
+                        if job.cancel():
+                            del jobs[job]
+
+                # only queue a couple tags per process so cancelling is quick
+                for fp in (() if cancelled else fps):
+                    jobs[executor.submit(
+                        _convert_bitmap_in_worker, tags_dir, fp,
+                        self.conversion_flags[fp], self.bitmap_tag_infos[fp],
+                        use_stubbs_p8, backup, fast_p8)] = fp
+                    if len(jobs) >= 2*process_count:
+                        break
+
+                if not jobs:
+                    break
+
+                done, _ = wait(jobs, 0.5, FIRST_COMPLETED)
+                for job in done:
+                    fp = jobs.pop(job)
+                    try:
+                        processed, output = job.result()
+                    except Exception:
+                        print(format_exc())
+                        print("Could not convert: %s" % fp)
+                        continue
+
+                    if output:
+                        print(output, end="")
+                    if processed:
+                        self.finish_processing(fp)
+
+    def finish_processing(self, fp):
+        '''
+        Forgets the tag at fp now that it's been processed, and
+        updates it in the tag list to show it won't be processed.
+        '''
+        self.bitmap_tag_infos.pop(fp, None)
+        self.conversion_flags.pop(fp, None)
+        self.bitmap_display_windows.pop(fp, None)
+        self.after(0, self.tag_list_frame.update_path_color, fp)
+
     def cancel_pressed(self):
         if self._processing:
             self._cancel_processing = True
@@ -1257,6 +1624,110 @@ def get_will_be_processed(self, tag_path):
         return get_will_be_converted(self.conversion_flags[tag_path],
                                      self.bitmap_tag_infos[tag_path])
 
+    def estimate_conversion(self):
+        '''
+        Returns lines of text for the log estimating how many bytes of pixel
+        data the bitmaps would have after converting them with their current
+        settings, totaled by type and the format they'd be converted to, and
+        roughly how long converting them would take. Sizes are calculated
+        without converting anything. The time is extrapolated from how long
+        it takes to convert copies of a few of the bitmaps.
+        '''
+        # maps (type, format) to [tag_count, current_size, estimated_size]
+        totals = {}
+        texel_counts = {}
+        for fp, info in self.bitmap_tag_infos.items():
+            if not info.bitmap_infos:
+                continue
+
+            flags = self.conversion_flags[fp]
+            fails = any(get_will_fail_to_palettize(flags, bitmap_info)
+                        for bitmap_info in info.bitmap_infos)
+            fmt = info.bitmap_infos[0].format
+            if not fails:
+                fmt = I_FORMAT_NAME_MAP[get_target_format(
+                    flags, info.bitmap_infos[0])]
+
+            key = (BITMAP_TYPES[info.type], BITMAP_FORMATS[fmt])
+            total = totals.setdefault(key, [0, 0, 0])
+            total[0] += 1
+            total[1] += info.pixel_data_size
+            total[2] += get_converted_tag_size(flags, info)
+            if get_will_be_converted(flags, info) and not fails:
+                texel_counts[fp] = sum(get_texel_count(bitmap_info)
+                                       for bitmap_info in info.bitmap_infos)
+
+        lines = ["Estimated pixel data size after converting:",
+                 "\t%-8s%-12s%8s%16s%16s" % (
+                     "Type", "New format", "Tags", "Current", "Converted")]
+        for (typ, fmt), (count, size, new_size) in sorted(totals.items()):
+            lines.append("\t%-8s%-12s%8s%14sKB%14sKB" % (
+                typ, fmt, count, size // 1024, new_size // 1024))
+
+        lines.append("\t%-20s%8s%14sKB%14sKB" % (
+            "Total", sum(total[0] for total in totals.values()),
+            sum(total[1] for total in totals.values()) // 1024,
+            sum(total[2] for total in totals.values()) // 1024))
+
+        seconds_per_texel = self.sample_conversion_time(texel_counts)
+        if texel_counts and seconds_per_texel is not None:
+            seconds = int(sum(texel_counts.values()) * seconds_per_texel + 0.5)
+            lines.append(
+                "\n%s bitmaps would be converted, taking roughly %s seconds" %
+                (len(texel_counts), "less than 1" if seconds < 1 else seconds))
+        elif texel_counts:
+            lines.append("\n%s bitmaps would be converted" % len(texel_counts))
+        else:
+            lines.append("\nNo bitmaps would be converted")
+
+        return lines
+
+    def sample_conversion_time(self, texel_counts):
+        '''
+        Converts copies of up to estimate_sample_count of the bitmaps in
+        texel_counts(a dict mapping filepaths to their number of pixels),
+        picked evenly from smallest to largest of those with no more than
+        estimate_sample_max_texels pixels, and returns the average number
+        of seconds it took to convert each pixel. The originals are left
+        untouched. Returns None if none could be converted.
+        '''
+        fps = sorted(texel_counts, key=texel_counts.get)
+        fps = [fp for fp in fps if texel_counts[fp] <=
+               self.estimate_sample_max_texels] or fps[: 1]
+        sample_count = min(len(fps), self.estimate_sample_count)
+        if sample_count <= 0:
+            return None
+
+        print("Sampling conversion time...")
+        fps = [fps[(len(fps) - 1) * i // max(1, sample_count - 1)]
+               for i in range(sample_count)]
+        total_time = total_texels = 0
+        with TemporaryDirectory() as temp_dir:
+            for i, fp in enumerate(sorted(set(fps))):
+                if self._cancel_processing:
+                    break
+
+                temp_filepath = os.path.join(temp_dir, "%s.bitmap" % i)
+                conv_flags = deepcopy(self.conversion_flags[fp])
+                conv_flags.extract_to = 0
+                try:
+                    shutil.copyfile(
+                        os.path.join(self.loaded_tags_dir, fp), temp_filepath)
+                    start = time()
+                    convert_bitmap_file(
+                        temp_filepath, conv_flags, self.bitmap_tag_infos[fp],
+                        self.use_stubbs_p8.get(), False, self.bitm_def,
+                        self.fast_p8.get())
+                    total_time += time() - start
+                    total_texels += texel_counts[fp]
+                except Exception:
+                    print(format_exc())
+                    print("Could not convert: %s" % fp)
+
+        if not total_texels:
+            return None
+        return total_time / total_texels
+
     def make_log(self):
         attempts = 0
         success = True
@@ -1290,6 +1761,12 @@ def make_log(self):
         logstr += "%s bitmaps total\n%sKB of bitmap data\n%sKB of TIFF data" % (
             len(self.bitmap_tag_infos), total_size // 1024, tiff_data_size // 1024)
 
+        try:
+            logstr += "\n\n" + "\n".join(self.estimate_conversion())
+        except Exception:
+            print(format_exc())
+            print("Could not estimate conversion.")
+
         tag_counts = [0, 0, 0]
         tag_header_strs = ("2D Textures", "3D Textures", "Cubemaps")
         base_str = "Bitmap %s\t--- WxHxD: %sx%sx%s\t--- Mipmaps: %s\n"
@@ -1357,16 +1834,36 @@ def make_log(self):
 
 
 class BitmapConverterList(tk.Frame, BinillaWidget, HaloBitmapDisplayBase):
+    '''
+    Lists the scanned bitmaps, their size, format and type. Only the rows
+    that fit on screen are put in the listboxes, and scrolling changes which
+    of the displayed paths they show, so tags directories with tens of
+    thousands of bitmaps can be sorted, filtered and scrolled instantly.
+    '''
     listboxes = ()
     reverse_listbox = False
     toggle_to = True
     sort_method = 'path'
 
+    # the paths being displayed, in the order they're displayed
     displayed_paths = ()
-    type_format_map = ()
+    # maps each sort method to every path sorted that way, and to a bytes
+    # object of the type/format key(see get_type_format_key) of each one.
+    sorted_paths = ()
+    sorted_keys = ()
     selected_paths = ()
+    # maps the paths in the path listbox to their index in it
+    path_indices = ()
+    # index in displayed_paths of the path in the first row of the listboxes
+    top_row = 0
+    # number of rows scrolled per mousewheel click
+    mousewheel_rows = 3
+    # the path shift clicking selects from. this is kept as a path rather
+    # than left to the listbox, since the listbox rows change on scrolling.
+    anchor_path = None
 
     _populating = False
+    _extending_selection = False
 
     def __init__(self, master, **options):
         BinillaWidget.__init__(self, master, **options)
@@ -1375,8 +1872,10 @@ def __init__(self, master, **options):
         self.formats_shown = [True] * HALO_1_FORMAT_COUNT
         self.types_shown   = [True] * HALO_1_TYPE_COUNT
         self.displayed_paths = []
-        self.type_format_map = []
+        self.sorted_paths = {}
+        self.sorted_keys = {}
         self.selected_paths = set()
+        self.path_indices = {}
         self.build_tag_sort_mappings()
 
         self.sort_menu = tk.Menu(self, tearoff=False)
@@ -1444,6 +1943,7 @@ def __init__(self, master, **options):
         self.listboxes.append(
             tk.Listbox(self, width=6, height=5, exportselection=False,
                        yscrollcommand=self._type_scrolled))
+        self.path_listbox.bind('<Configure>', self._path_listbox_resized)
 
         self.path_listbox.bind("<Button-3>", lambda e, m=self.sort_menu:
                                self.post_rightclick_menu(e, m))
@@ -1467,6 +1967,23 @@ def __init__(self, master, **options):
             if i != 0:
                 self.listboxes[i].bind('<<ListboxSelect>>', lambda e, idx=i:
                                        self.select_path_listbox(idx))
+            for seq in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+                self.listboxes[i].bind(seq, self._mousewheel_scrolled)
+
+        # clicking a path or moving with the keyboard replaces the
+        # selection, while control clicking adds to it, even if the rest
+        # of it isn't on screen. shift clicking selects a range of paths.
+        for seq, extending in (('<Button-1>', False),
+                               ('<KeyPress>', False),
+                               ('<Control-Button-1>', True)):
+            self.path_listbox.bind(seq, lambda e, ext=extending:
+                                   self._set_extending_selection(ext))
+        self.path_listbox.bind('<Shift-Button-1>', self._shift_clicked)
+
+        # the listbox only holds the rows on screen, so moving through
+        # the paths with the keyboard is done here so it can scroll.
+        for seq in ('<Up>', '<Down>', '<Prior>', '<Next>', '<Home>', '<End>'):
+            self.path_listbox.bind(seq, self._key_moved)
 
         self.hsb.pack(side="bottom", fill="x")
         self.vsb.pack(side="right",  fill="y")
@@ -1501,12 +2018,14 @@ def post_rightclick_menu(self, event, menu):
     def reset_listboxes(self):
         self.selected_paths = set()
         self.displayed_paths = []
+        self.top_row = 0
+        self.anchor_path = None
         for listbox in self.listboxes:
             listbox.delete(0, tk.END)
 
     def set_selected_tags_list(self, event=None):
         selected = set(self.path_listbox.curselection())
-        if len(selected) == 1:
+        if len(selected) == 1 and not self._extending_selection:
             self.selected_paths.clear()
         else:
             for i in range(self.path_listbox.size()):
@@ -1518,6 +2037,11 @@ def set_selected_tags_list(self, event=None):
         for i in selected:
             self.selected_paths.add(self.path_listbox.get(i))
 
+        # clicks and keyboard movement in the path listbox set its anchor
+        anchor_path = self.path_listbox.get(tk.ANCHOR)
+        if event is not None and anchor_path:
+            self.anchor_path = anchor_path
+
         self.master.populate_bitmap_info()
         self.master.populate_settings()
 
@@ -1560,15 +2084,10 @@ def update_sort_menu(self):
                 self.sort_menu.entryconfig(i, label=sort_menu_strs[i])
 
     def invert_selection(self):
-        for i in range(self.path_listbox.size()):
-            fp = self.path_listbox.get(i)
-            if fp in self.selected_paths:
-                self.selected_paths.remove(fp)
-            else:
-                self.selected_paths.add(fp)
-
+        self.selected_paths.symmetric_difference_update(self.displayed_paths)
         self.synchronize_selection()
-        self.set_selected_tags_list()
+        self.master.populate_bitmap_info()
+        self.master.populate_settings()
 
     def synchronize_selection(self):
         self.path_listbox.selection_clear(0, tk.END)
@@ -1667,31 +2186,47 @@ def toggle_formats_allowed(self, menu_idx, fmt):
     def build_tag_sort_mappings(self):
         self.selected_paths = set()
         self.displayed_paths = []
-        self.type_format_map = []
-        self.size_map = {}
-
-        for typ in range(HALO_1_TYPE_COUNT):
-            self.type_format_map.append([])
-            for fmt in range(HALO_1_FORMAT_COUNT):
-                self.type_format_map[typ].append([])
-
-        remove = set()
-        for fp, info in self.master.bitmap_tag_infos.items():
-            if not info.pixel_data_size in self.size_map:
-                self.size_map[info.pixel_data_size] = []
-
-            try:
-                self.type_format_map[info.type][info.format]
-                self.size_map[info.pixel_data_size]
-
-                self.type_format_map[info.type][info.format].append(fp)
-                self.size_map[info.pixel_data_size].append(fp)
-            except IndexError:
-                remove.add(fp)
-
+        self.sorted_paths = {}
+        self.sorted_keys = {}
+        self.top_row = 0
+        self.anchor_path = None
+
+        tag_infos = self.master.bitmap_tag_infos
+        remove = [fp for fp, info in tag_infos.items()
+                  if info.type not in range(HALO_1_TYPE_COUNT) or
+                  info.format not in range(HALO_1_FORMAT_COUNT)]
         for fp in remove:
             self.master.conversion_flags.pop(fp, None)
-            self.master.bitmap_tag_infos.pop(fp, None)
+            tag_infos.pop(fp, None)
+
+        # the paths are only sorted here. filtering and reversing
+        # them afterward doesn't change the order they're in.
+        paths = sorted(tag_infos)
+        for sort_by, sort_key in (
+                ('path', None),
+                ('size', lambda fp: tag_infos[fp].pixel_data_size),
+                ('format', lambda fp: (tag_infos[fp].format,
+                                       tag_infos[fp].type)),
+                ('type', lambda fp: (tag_infos[fp].type,
+                                     tag_infos[fp].format))):
+            sorted_paths = paths if sort_key is None else sorted(
+                paths, key=sort_key)
+            self.sorted_paths[sort_by] = sorted_paths
+            self.sorted_keys[sort_by] = bytes(
+                get_type_format_key(tag_infos[fp].type, tag_infos[fp].format)
+                for fp in sorted_paths)
+
+    def get_shown_key_mask(self):
+        '''
+        Returns a bytes object mapping each type/format key to 1 if bitmaps
+        of that type and format are shown, or 0 if they're filtered out.
+        '''
+        mask = bytearray(256)
+        for typ in range(HALO_1_TYPE_COUNT):
+            for fmt in range(HALO_1_FORMAT_COUNT):
+                if self.types_shown[typ] and self.formats_shown[fmt]:
+                    mask[get_type_format_key(typ, fmt)] = 1
+        return bytes(mask)
 
     def display_sorted_tags(self, sort_by=None, reverse=None):
         if sort_by is None:
@@ -1703,58 +2238,57 @@ def display_sorted_tags(self, sort_by=None, reverse=None):
         self.sort_displayed_tags(sort_by)
         self.after(0, self.populate_tag_list_boxes)
 
-    def sort_displayed_tags(self, sort_by):
-        self.displayed_paths = displayed_paths = []
-        if not self.master.bitmap_tag_infos:
-            return
+    def remove_missing_sorted_paths(self):
+        '''
+        Removes the paths that are no longer in the master's bitmap_tag_infos,
+        such as those that have been converted, from the sort orders.
+        '''
+        tag_infos = self.master.bitmap_tag_infos
+        for sort_by, sorted_paths in tuple(self.sorted_paths.items()):
+            kept = bytes(fp in tag_infos for fp in sorted_paths)
+            self.sorted_paths[sort_by] = list(compress(sorted_paths, kept))
+            self.sorted_keys[sort_by] = bytes(compress(
+                self.sorted_keys[sort_by], kept))
 
-        if sort_by == 'path':
-            for path in sorted(self.master.bitmap_tag_infos.keys()):
-                info = self.master.bitmap_tag_infos[path]
-                if (self.formats_shown[info.format] and
-                    self.types_shown[info.type]):
-                    displayed_paths.append(path)
-
-        elif sort_by == 'size':
-            for tagsize in sorted(self.size_map):
-                for path in self.size_map[tagsize]:
-                    info = self.master.bitmap_tag_infos[path]
-                    if (self.formats_shown[info.format] and
-                        self.types_shown[info.type]):
-                        displayed_paths.append(path)
-
-        elif sort_by == 'format':
-            for fmt in range(len(self.formats_shown)):
-                for typ in range(len(self.types_shown)):
-                    if self.formats_shown[fmt] and self.types_shown[typ]:
-                        displayed_paths.extend(self.type_format_map[typ][fmt])
-
-        elif sort_by == 'type':
-            for typ in range(len(self.types_shown)):
-                for fmt in range(len(self.formats_shown)):
-                    if self.formats_shown[fmt] and self.types_shown[typ]:
-                        displayed_paths.extend(self.type_format_map[typ][fmt])
-        else:
-            for path in self.master.bitmap_tag_infos.keys():
-                info = self.master.bitmap_tag_infos[path]
-                if (self.formats_shown[info.format] and
-                    self.types_shown[info.type]):
-                    displayed_paths.append(path)
+    def sort_displayed_tags(self, sort_by):
+        if sort_by not in self.sorted_paths:
+            sort_by = self.sort_method
 
-        self.sort_method = sort_by
+        # tags are only removed after being converted, and never
+        # added without rescanning, so the counts only differ then.
+        if (len(self.sorted_paths.get(sort_by, ())) !=
+                len(self.master.bitmap_tag_infos)):
+            self.remove_missing_sorted_paths()
+
+        # translating the keys of the sorted paths gives a mask of which
+        # ones are shown, so they're picked out without looking at the
+        # info of each bitmap.
+        shown = self.sorted_keys.get(sort_by, b'').translate(
+            self.get_shown_key_mask())
+        displayed_paths = list(compress(
+            self.sorted_paths.get(sort_by, ()), shown))
         if self.reverse_listbox:
             displayed_paths.reverse()
 
+        self.sort_method = sort_by
+        self.displayed_paths = displayed_paths
+        self.selected_paths.intersection_update(displayed_paths)
+
     def populate_tag_list_boxes(self):
         if self._populating:
             return
 
         self._populating = True
         try:
+            x_view = self.path_listbox.xview()[0]
             for listbox in self.listboxes:
                 listbox.delete(0, tk.END)
+            self.path_indices = {}
 
-            for fp in self.displayed_paths:
+            # only put the paths in the rows on screen into the listboxes
+            self.top_row = self.clamp_top_row(self.top_row)
+            end = self.top_row + self.get_visible_row_count() + 1
+            for fp in self.displayed_paths[self.top_row: end]:
                 try:
                     info = self.master.bitmap_tag_infos[fp]
                 except KeyError:
@@ -1768,6 +2302,7 @@ def populate_tag_list_boxes(self):
                 else:
                     size_str = str((size + 1024**2 // 2) // 1024**2) + "  MB"
 
+                self.path_indices[fp] = self.path_listbox.size()
                 self.path_listbox.insert(tk.END, fp)
                 self.format_listbox.insert(tk.END, BITMAP_FORMATS[info.format])
                 self.type_listbox.insert(tk.END, BITMAP_TYPES[info.type])
@@ -1775,12 +2310,25 @@ def populate_tag_list_boxes(self):
 
                 self.update_path_listbox_entry_color(tk.END)
 
+            for listbox in self.listboxes:
+                listbox.yview_moveto(0)
+            self.path_listbox.xview_moveto(x_view)
+
             self.synchronize_selection()
+            if self.anchor_path in self.path_indices:
+                self.path_listbox.selection_anchor(
+                    self.path_indices[self.anchor_path])
+            self.update_scrollbar()
         except Exception:
             print(format_exc())
 
         self._populating = False
 
+    def update_path_color(self, fp):
+        i = self.path_indices.get(fp)
+        if i is not None and i < self.path_listbox.size():
+            self.update_path_listbox_entry_color(i)
+
     def update_path_listbox_entry_color(self, i):
         fp = self.path_listbox.get(i)
         if self.master.get_will_be_processed(fp):
@@ -1789,15 +2337,156 @@ def update_path_listbox_entry_color(self, i):
             self.path_listbox.itemconfig(i, bg=self.enum_normal_color,
                                          fg=self.text_normal_color,)
 
+    def get_visible_row_count(self):
+        '''Returns the number of rows that fit entirely in the listboxes.'''
+        height = self.path_listbox.winfo_height()
+        if height <= 1:
+            # not drawn yet, so use the number of rows it was made with
+            return int(self.path_listbox.cget("height"))
+
+        # a pixel more than the font's linespace, so a row that would
+        # be cut off at the bottom isn't counted as fitting.
+        row_height = 1 + int(self.path_listbox.tk.call(
+            "font", "metrics", self.path_listbox.cget("font"), "-linespace"))
+        return max(1, height // row_height)
+
+    def clamp_top_row(self, top_row):
+        last_top_row = len(self.displayed_paths) - self.get_visible_row_count()
+        return max(0, min(top_row, last_top_row))
+
+    def set_top_row(self, top_row):
+        top_row = self.clamp_top_row(top_row)
+        if top_row != self.top_row:
+            self.top_row = top_row
+            self.populate_tag_list_boxes()
+
+    def update_scrollbar(self):
+        count = len(self.displayed_paths)
+        if not count:
+            self.vsb.set(0.0, 1.0)
+            return
+
+        self.vsb.set(self.top_row / count, min(
+            1.0, (self.top_row + self.get_visible_row_count()) / count))
+
+    def get_displayed_index(self, i):
+        '''
+        Returns the index in displayed_paths of the path in row i of the
+        path listbox.
+        '''
+        fp = self.path_listbox.get(i)
+        row = self.top_row + i
+        if self.displayed_paths[row: row + 1] != [fp]:
+            row = self.displayed_paths.index(fp)
+        return row
+
+    def _set_extending_selection(self, extending):
+        self._extending_selection = extending
+
+    def _shift_clicked(self, event):
+        '''
+        Selects every displayed path from the anchor path to the path
+        clicked, including those scrolled off screen.
+        '''
+        i = self.path_listbox.nearest(event.y)
+        if i not in range(self.path_listbox.size()):
+            return "break"
+
+        fp = self.path_listbox.get(i)
+        end = self.get_displayed_index(i)
+        try:
+            start = self.displayed_paths.index(self.anchor_path)
+        except ValueError:
+            start = end
+            self.anchor_path = fp
+
+        start, end = sorted((start, end))
+        self.selected_paths.clear()
+        self.selected_paths.update(self.displayed_paths[start: end + 1])
+        self._extending_selection = True
+
+        self.synchronize_selection()
+        self.path_listbox.activate(i)
+        self.path_listbox.focus_set()
+        self.master.populate_bitmap_info()
+        self.master.populate_settings()
+        # the listbox's own shift click would select from its anchor row
+        return "break"
+
+    def _key_moved(self, event):
+        '''
+        Moves the selection to the displayed path above or below the active
+        one, a page of rows up or down, or to the first or last path, and
+        scrolls so it's on screen. Holding shift selects every displayed
+        path from the anchor path to the one moved to instead.
+        '''
+        if not self.displayed_paths:
+            return "break"
+
+        i = self.path_listbox.index(tk.ACTIVE)
+        if i in range(self.path_listbox.size()):
+            row = self.get_displayed_index(i)
+        else:
+            row = self.top_row
+
+        page = self.get_visible_row_count()
+        row = dict(Up=row - 1, Down=row + 1, Prior=row - page,
+                   Next=row + page, Home=0).get(
+                       event.keysym, len(self.displayed_paths) - 1)
+        row = max(0, min(row, len(self.displayed_paths) - 1))
+        fp = self.displayed_paths[row]
+
+        try:
+            start = self.displayed_paths.index(self.anchor_path)
+        except ValueError:
+            start = None
+
+        self.selected_paths.clear()
+        if event.state & 0x0001 and start is not None:
+            # shift is held
+            self.selected_paths.update(
+                self.displayed_paths[min(start, row): max(start, row) + 1])
+        else:
+            self.selected_paths.add(fp)
+            self.anchor_path = fp
+
+        if row < self.top_row:
+            self.set_top_row(row)
+        elif row >= self.top_row + page:
+            self.set_top_row(row - page + 1)
+
+        self.synchronize_selection()
+        if self.anchor_path in self.path_indices:
+            self.path_listbox.selection_anchor(
+                self.path_indices[self.anchor_path])
+        self.path_listbox.activate(row - self.top_row)
+        self.master.populate_bitmap_info()
+        self.master.populate_settings()
+        return "break"
+
+    def _path_listbox_resized(self, event=None):
+        self.populate_tag_list_boxes()
+
+    def _mousewheel_scrolled(self, event):
+        self.set_top_row(
+            self.top_row + self.mousewheel_rows * get_mouse_delta(event))
+        return "break"
+
     def _scroll_all_yviews(self, *args):
-        for listbox in self.listboxes:
-            listbox.yview(*args)
+        if args[0] == "moveto":
+            self.set_top_row(int(float(args[1]) * len(self.displayed_paths)))
+        elif args[0] == "scroll":
+            rows = int(args[1])
+            if args[2] == "pages":
+                rows *= self.get_visible_row_count()
+            self.set_top_row(self.top_row + rows)
 
     def _sync_yviews(self, src_listbox, *args):
+        # the scrollbar follows top_row rather than the listboxes, since
+        # they only hold the rows on screen. this just keeps them lined up.
         for listbox in self.listboxes:
             if listbox is not src_listbox and src_listbox.yview() != listbox.yview():
                 listbox.yview_moveto(args[0])
-        self.vsb.set(*args)
 
     def _path_scrolled(self, *args):
         self._sync_yviews(self.path_listbox, *args)
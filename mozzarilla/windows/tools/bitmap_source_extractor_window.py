@@ -20,6 +20,7 @@
 from binilla.widgets.binilla_widget import BinillaWidget
 from binilla.windows.filedialog import askdirectory
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.tags_dir_index import iter_indexed_files
 
 window_base_class = tk.Toplevel
 if __name__ == "__main__":
@@ -152,83 +153,85 @@ def do_extract(self):
         tags_dir = self.tags_dir.get()
         data_dir = self.data_dir.get()
 
-        for root, dirs, files in os.walk(tags_dir):
-            for tag_name in files:
-                if self.stop_extraction:
-                    print("    Conversion cancelled by user.")
-                    return
-                elif os.path.splitext(tag_name)[-1].lower() != '.bitmap':
-                    continue
-                tag_path = os.path.join(root, tag_name)
-
-                source_path = data_dir + tag_path.split(tags_dir)[-1]
-                source_path = os.path.splitext(source_path)[0] + ".tga"
-                source_dir = os.path.dirname(source_path)
-
-                try:
-                    with open(tag_path, 'rb') as f:
-                        data = f.read()
-
-                    tag_id = data[36:40]
-                    engine_id = data[60:64]
-
-                    # make sure this is a bitmap tag
-                    if tag_id == b'bitm' and engine_id == b'blam':
-                        dims_off = 64+24
-                        size_off = 64+28
-                        data_off = 64+108
-                        end = ">"
-                    elif tag_id == b'mtib' and engine_id == b'!MLB':
-                        dims_off = 64+16+24
-                        size_off = 64+16+28
-                        data_off = 64+16
-                        # get the size of the bitmap body from the tbfd structure
-                        data_off += unpack("<i", data[data_off-4: data_off])[0]
-                        end = "<"
-                    else:
-                        #print("    This file doesnt appear to be a bitmap tag.")
-                        continue
-
-                    width, height = unpack(end+"HH", data[dims_off: dims_off+4])
-                    comp_size = unpack(end+"i", data[size_off: size_off+4])[0]
-                    data = data[data_off: data_off+comp_size]
-                except Exception:
-                    #print("    Could not load bitmap tag.")
+        for rel_tag_path, _, __ in iter_indexed_files(
+                tags_dir, (".bitmap", ), lambda: self.stop_extraction):
+            if self.stop_extraction:
+                print("    Conversion cancelled by user.")
+                return
+            tag_path = os.path.join(tags_dir, rel_tag_path)
+
+            source_path = os.path.join(data_dir, rel_tag_path)
+            source_path = os.path.splitext(source_path)[0] + ".tga"
+            source_dir = os.path.dirname(source_path)
+
+            try:
+                with open(tag_path, 'rb') as f:
+                    data = f.read()
+
+                tag_id = data[36:40]
+                engine_id = data[60:64]
+
+                # make sure this is a bitmap tag
+                if tag_id == b'bitm' and engine_id == b'blam':
+                    dims_off = 64+24
+                    size_off = 64+28
+                    data_off = 64+108
+                    end = ">"
+                elif tag_id == b'mtib' and engine_id == b'!MLB':
+                    dims_off = 64+16+24
+                    size_off = 64+16+28
+                    data_off = 64+16
+                    # get the size of the bitmap body from the tbfd structure
+                    data_off += unpack("<i", data[data_off-4: data_off])[0]
+                    end = "<"
+                else:
+                    #print("    This file doesnt appear to be a bitmap tag.")
                     continue
 
-                if not len(data):
-                    #print("    No source image to extract.")
+                width, height = unpack(end+"HH", data[dims_off: dims_off+4])
+                comp_size = unpack(end+"i", data[size_off: size_off+4])[0]
+                data = data[data_off: data_off+comp_size]
+            except Exception:
+                #print("    Could not load bitmap tag.")
+                continue
+
+            if not len(data):
+                #print("    No source image to extract.")
+                continue
+
+            try:
+                data_size = unpack(end+"I", data[:4])[0]
+                if not data_size:
+                    #print('    Source data is blank.')
                     continue
 
-                try:
-                    data_size = unpack(end+"I", data[:4])[0]
-                    if not data_size:
-                        #print('    Source data is blank.')
-                        continue
-
-                    data = bytearray(zlib.decompress(data[4:]))
-                except Exception:
-                    #print('    Could not decompress data.')
-                    continue
-
-                print('Extracting %s' % tag_path.split(tags_dir)[-1].lstrip("/\\"))
-                try:
-                    if not os.path.isdir(source_dir):
-                        os.makedirs(source_dir)
-                    with open(source_path, 'wb') as f:
-                        a_depth = len(data) // (width*height) - 3
-
-                        head = bytearray(18)
-                        pack_into('B',  head, 2,  2)
-                        pack_into('<H', head, 12, width)
-                        pack_into('<H', head, 14, height)
-                        pack_into('B',  head, 16, 32)
-                        pack_into('B',  head, 17, 32 + ((a_depth*8)&15))
-                        f.write(head)
-                        f.write(data)
-                except Exception:
-                    #print(format_exc())
-                    print("    Couldn't make Tga file.")
+                data = bytearray(zlib.decompress(data[4:]))
+            except Exception:
+                #print('    Could not decompress data.')
+                continue
+
+            print('Extracting %s' % rel_tag_path)
+            try:
+                if not os.path.isdir(source_dir):
+                    os.makedirs(source_dir)
+                with open(source_path, 'wb') as f:
+                    a_depth = len(data) // (width*height) - 3
+
+                    head = bytearray(18)
+                    pack_into('B',  head, 2,  2)
+                    pack_into('<H', head, 12, width)
+                    pack_into('<H', head, 14, height)
+                    pack_into('B',  head, 16, 32)
+                    pack_into('B',  head, 17, 32 + ((a_depth*8)&15))
+                    f.write(head)
+                    f.write(data)
+            except Exception:
+                #print(format_exc())
+                print("    Couldn't make Tga file.")
+
+        if self.stop_extraction:
+            print("    Conversion cancelled by user.")
+            return
 
         print('\nFinished. Took %s seconds' % (time() - start))
 
@@ -14,7 +14,6 @@
 from pathlib import Path
 from supyr_struct.util import path_split, is_in_dir
 from threading import Thread
-from time import time
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
@@ -23,6 +22,7 @@
 from reclaimer.halo_script.hsc import get_h1_scenario_script_object_type_strings
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.tags_dir_index import locate_tags
 
 
 class DataExtractionWindow(tk.Toplevel, BinillaWidget):
@@ -281,40 +281,18 @@ def do_dir_extract(self):
 
         print("Beginning tag data extracton in:\t%s" % self.handler.tagsdir)
 
-        s_time = time()
-        c_time = s_time
         p_int = self.print_interval
 
-        all_tag_paths = {self.listbox_index_to_def_id[int(i)]: [] for i in
-                         self.def_ids_listbox.curselection()}
+        def_ids = [self.listbox_index_to_def_id[int(i)] for i in
+                   self.def_ids_listbox.curselection()]
 
         print("Locating tags...")
-
-        for root, directories, files in os.walk(tags_path):
-            root = Path(root)
-            try:
-                root = root.relative_to(self.handler.tagsdir)
-            except ValueError:
-                continue
-
-            for filename in files:
-                filepath = root.joinpath(filename)
-
-                if time() - c_time > p_int:
-                    c_time = time()
-                    print(' '*4, filepath, sep="")
-                    self.app_root.update_idletasks()
-
-                if self.stop_extracting:
-                    print('Tag data extraction cancelled.\n')
-                    return
-
-                tag_paths = all_tag_paths.get(
-                    self.tag_class_ext_to_fcc.get(
-                        filepath.suffix[1:].lower()))
-
-                if tag_paths is not None:
-                    tag_paths.append(filepath)
+        all_tag_paths = locate_tags(
+            self.handler, tags_path, def_ids, lambda: self.stop_extracting,
+            p_int, self.app_root.update_idletasks)
+        if all_tag_paths is None:
+            print('Tag data extraction cancelled.\n')
+            return
 
         for def_id in sorted(all_tag_paths):
             extractor = self.tag_data_extractors[def_id]
@@ -7,18 +7,29 @@
 # See LICENSE for more information.
 #
 
-from pathlib import Path, PureWindowsPath
+from pathlib import Path
 import os
 import tkinter as tk
-import zipfile
 
 from threading import Thread
+from time import time
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
+from binilla.widgets.scroll_menu import ScrollMenu
 from binilla.windows.filedialog import askopenfilename, asksaveasfilename
 
-from supyr_struct.util import path_normalize, is_in_dir, tagpath_to_fullpath
+from supyr_struct.util import path_normalize, is_in_dir
+from mozzarilla.tagset.closure_report import build_closure_report,\
+     format_closure_report
+from mozzarilla.tagset.dependency_closure import resolve_dependency_closure,\
+     get_arcname
+from mozzarilla.tagset.package_manifest import hash_files, load_manifest,\
+     save_manifest, get_manifest_path, get_changed_names, MANIFEST_EXT
+from mozzarilla.tagset.reverse_ref_index import open_reverse_ref_index
+from mozzarilla.tagset.tag_cache import BatchTagCache, DEFAULT_MEMORY_BUDGET
+from mozzarilla.tagset.zip_writer import ParallelZipWriter,\
+     ZIP_COMPRESSION_NAMES, DEFAULT_COMPRESSION_LEVEL
 from mozzarilla.widgets.directory_frame import DirectoryFrame,\
      HierarchyFrame, DependencyFrame
 from mozzarilla import editor_constants as e_c
@@ -30,6 +41,17 @@ class DependencyWindow(tk.Toplevel, BinillaWidget):
 
     _zipping = False
     stop_zipping = False
+    _indexing = False
+    _reporting = False
+
+    reverse_ref_index = None
+    tag_cache = None
+    # the tag_memory_budget in bytes. kept separately so the tag cache
+    # can be made by other threads without touching tkinter variables.
+    tag_memory_budget_bytes = DEFAULT_MEMORY_BUDGET
+    # number of processes to read tags with when zipping using
+    # multiple processes. None means one per cpu.
+    process_count = None
 
     def __init__(self, app_root, *args, **kwargs):
         self.handler = app_root.handler
@@ -49,10 +71,75 @@ def __init__(self, app_root, *args, **kwargs):
 
         # make the tkinter variables
         self.tag_filepath = tk.StringVar(self)
+        self.tag_memory_budget = tk.StringVar(
+            self, str(DEFAULT_MEMORY_BUDGET // 1024**2))
+        self.tag_memory_budget.trace(
+            "w", lambda *a: self.update_tag_cache_budget())
+        self.zip_multiprocessed = tk.BooleanVar(self, False)
+        self.zip_changed_only = tk.BooleanVar(self, False)
+        self.zip_compression = tk.IntVar(
+            self, ZIP_COMPRESSION_NAMES.index("deflate"))
+        self.zip_compression_level = tk.IntVar(
+            self, DEFAULT_COMPRESSION_LEVEL)
 
         # make the frames
         self.filepath_frame = tk.LabelFrame(self, text="Select a tag")
         self.button_frame = tk.LabelFrame(self, text="Actions")
+        self.settings_frame = tk.LabelFrame(self, text="Settings")
+        self.zip_settings_frame = tk.LabelFrame(self, text="Zip settings")
+
+        self.tag_memory_budget_label = tk.Label(
+            self.settings_frame,
+            text="Memory for tags loaded by this window(MiB)")
+        self.tag_memory_budget_entry = tk.Entry(
+            self.settings_frame, width=8,
+            textvariable=self.tag_memory_budget, justify='right')
+        self.tag_memory_budget_entry.tooltip_string = (
+            "Tags that aren't open in an editor are loaded without\n"
+            "adding them to the tag set. The most recently used of\n"
+            "them are kept until their estimated size exceeds this.\n"
+            "Set this to 0 to release every tag after it's used.")
+        self.tag_memory_budget_label.tooltip_string = \
+            self.tag_memory_budget_entry.tooltip_string
+
+        self.zip_compression_label = tk.Label(
+            self.zip_settings_frame, text="Compression")
+        self.zip_compression_menu = ScrollMenu(
+            self.zip_settings_frame, variable=self.zip_compression,
+            menu_width=8, options=ZIP_COMPRESSION_NAMES)
+        self.zip_compression_level_label = tk.Label(
+            self.zip_settings_frame, text="Level")
+        self.zip_compression_level_menu = ScrollMenu(
+            self.zip_settings_frame, variable=self.zip_compression_level,
+            menu_width=3, options=tuple(str(i) for i in range(10)))
+        self.zip_compression_label.tooltip_string = \
+            self.zip_compression_menu.tooltip_string = (
+                "How to compress the tags in the zipfile. Tags are\n"
+                "compressed on every cpu core at once.\n"
+                "stored:  no compression. Fastest.\n"
+                "deflate: readable by every zip program.\n"
+                "lzma:    smallest, but not every zip program can read it.")
+        self.zip_compression_level_label.tooltip_string = \
+            self.zip_compression_level_menu.tooltip_string = (
+                "From 0(fastest) to 9(smallest). Ignored when stored.")
+
+        self.zip_multiprocessed_cbtn = tk.Checkbutton(
+            self.zip_settings_frame, text="Zip using multiple processes",
+            variable=self.zip_multiprocessed)
+        self.zip_multiprocessed_cbtn.tooltip_string = (
+            "Splits reading the tags to zip between one process per\n"
+            "cpu core. Starting the processes takes a few seconds, so\n"
+            "this is only faster when zipping a large number of tags.\n"
+            "Also used when making a dependency size report.")
+
+        self.zip_changed_only_cbtn = tk.Checkbutton(
+            self.zip_settings_frame, text="Only zip changed tags",
+            variable=self.zip_changed_only)
+        self.zip_changed_only_cbtn.tooltip_string = (
+            "Asks for the manifest of a previous zipfile, and only adds\n"
+            "the tags whose contents changed since it was made, so the\n"
+            "zipfile can be shipped as a patch. A manifest of every tag\n"
+            "is always written next to the zipfile.")
 
         self.display_button = tk.Button(
             self.button_frame, width=25, text='Show dependencies',
@@ -62,6 +149,18 @@ def __init__(self, app_root, *args, **kwargs):
             self.button_frame, width=25, text='Zip tag recursively',
             command=self.recursive_zip)
 
+        self.referenced_by_button = tk.Button(
+            self.button_frame, width=25, text='Show referencing tags',
+            command=self.populate_referencing_tree)
+
+        self.closure_report_button = tk.Button(
+            self.button_frame, width=25, text='Dependency size report',
+            command=self.closure_report)
+        self.closure_report_button.tooltip_string = (
+            "Prints how many bytes the tag and everything it depends on\n"
+            "take up, by tag class, and which tags pull in the most of it.\n"
+            "Only the tag references are read out of the tags.")
+
         self.dependency_frame = DependencyFrame(self, app_root=self.app_root)
 
         self.filepath_entry = tk.Entry(
@@ -70,14 +169,28 @@ def __init__(self, app_root, *args, **kwargs):
             self.filepath_frame, text="Browse", command=self.browse)
 
         self.display_button.pack(padx=4, pady=2, side='left')
+        self.referenced_by_button.pack(padx=4, pady=2, side='left')
+        self.closure_report_button.pack(padx=4, pady=2, side='left')
         self.zip_button.pack(padx=4, pady=2, side='right')
 
         self.filepath_entry.pack(padx=(4, 0), pady=2, side='left',
                                  expand=True, fill='x')
         self.browse_button.pack(padx=(0, 4), pady=2, side='left')
 
+        self.tag_memory_budget_label.pack(padx=4, pady=2, side='left')
+        self.tag_memory_budget_entry.pack(padx=4, pady=2, side='left')
+        self.zip_compression_label.pack(padx=(4, 0), pady=2, side='left')
+        self.zip_compression_menu.pack(padx=(0, 4), pady=2, side='left')
+        self.zip_compression_level_label.pack(padx=(4, 0), pady=2,
+                                              side='left')
+        self.zip_compression_level_menu.pack(padx=(0, 4), pady=2, side='left')
+        self.zip_multiprocessed_cbtn.pack(padx=4, pady=2, side='right')
+        self.zip_changed_only_cbtn.pack(padx=4, pady=2, side='right')
+
         self.filepath_frame.pack(fill='x', padx=1)
         self.button_frame.pack(fill='x', padx=1)
+        self.settings_frame.pack(fill='x', padx=1)
+        self.zip_settings_frame.pack(fill='x', padx=1)
         self.dependency_frame.pack(fill='both', padx=1, expand=True)
 
         self.transient(app_root)
@@ -112,76 +225,199 @@ def destroy(self):
         except AttributeError:
             pass
         self.stop_zipping = True
+        if self.reverse_ref_index is not None and not self._indexing:
+            self.reverse_ref_index.close()
+        if self.tag_cache is not None:
+            self.tag_cache.clear()
         tk.Toplevel.destroy(self)
 
-    def get_tag(self, tag_path):
+    def get_tag_memory_budget(self):
         try:
-            return self.handler.get_tag(tag_path, load_unloaded=True)
-        except KeyError:
-            print(format_exc())
+            return max(0, int(float(self.tag_memory_budget.get()) * 1024**2))
+        except ValueError:
+            return DEFAULT_MEMORY_BUDGET
+
+    def update_tag_cache_budget(self):
+        self.tag_memory_budget_bytes = self.get_tag_memory_budget()
+        if self.tag_cache is not None:
+            self.tag_cache.set_memory_budget(self.tag_memory_budget_bytes)
+
+    def is_tag_open(self, tag):
+        return self.app_root.get_tag_window_id_by_tag(tag) is not None
+
+    def get_tag_cache(self):
+        '''
+        Returns the BatchTagCache for the current handler, replacing
+        the old one if the tag set or tags directory was changed.
+        '''
+        tag_cache = self.tag_cache
+        if tag_cache is None or tag_cache.handler is not self.handler:
+            if tag_cache is not None:
+                tag_cache.clear()
+            tag_cache = self.tag_cache = BatchTagCache(
+                self.handler, self.tag_memory_budget_bytes, self.is_tag_open)
+        return tag_cache
+
+    def get_loaded_tag(self, tag_path):
+        '''
+        Returns the tag if it's already loaded(so tags open in an
+        editor are read as they are now), or None otherwise.
+        '''
+        handler = self.handler
+        try:
+            return handler.get_tag(tag_path, handler.get_def_id(tag_path))
+        except (KeyError, LookupError):
             return None
 
-    def get_dependencies(self, tag):
-        def_id = tag.def_id
-        dependency_cache = self.handler.tag_ref_cache.get(def_id)
-
-        if not dependency_cache:
-            return ()
-
-        nodes = self.handler.get_nodes_by_paths(
-            self.handler.tag_ref_cache[def_id], tag.data)
-
-        dependencies = []
-
-        for node in nodes:
-            # if the node's filepath is empty, just skip it
-            if not node.filepath:
-                continue
-
-            ext = '.' + node.tag_class.enum_name
-
-            if tagpath_to_fullpath(
-                self.handler.tagsdir, PureWindowsPath(node.filepath), extension=ext
-            ) is not None and (self.handler.treat_mode_as_mod2 and ext == '.model'):
-                ext = '.gbxmodel'
-
-            dependencies.append(node.filepath + ext)
-        return dependencies
-
-    def populate_dependency_tree(self):
+    def get_tag(self, tag_path):
+        '''
+        Returns the tag at the tagsdir-relative tag_path, or None if it
+        can't be loaded. Tags that aren't already loaded are not added to
+        the handler, so they are released once they fall out of the cache.
+        '''
+        return self.get_tag_cache().get_tag(tag_path)
+
+    def get_root_tag_path(self):
+        '''
+        Returns the tagsdir-relative path of the selected tag, or
+        None if there isn't one or it isn't in the tags directory.
+        '''
         filepath = self.tag_filepath.get()
         if not filepath:
-            return
+            return None
 
         app = self.app_root
         handler = self.handler = app.handler
         handler_name = app.handler_names[app._curr_handler_index]
         if handler_name not in app.tags_dir_relative:
             print("Change the current tag set.")
-            return
+            return None
 
         filepath = path_normalize(filepath)
 
         if not is_in_dir(filepath, self.handler.tagsdir):
             print("%s\nis not in tagsdir\n%s" %
                   (filepath, self.handler.tagsdir))
+            return None
+
+        return Path(filepath).relative_to(self.handler.tagsdir)
+
+    def populate_dependency_tree(self):
+        rel_filepath = self.get_root_tag_path()
+        if rel_filepath is None:
             return
 
-        rel_filepath = Path(filepath).relative_to(self.handler.tagsdir)
-        tag = self.get_tag(rel_filepath)
-        if tag is None:
-            print("Could not load tag:\n    %s" % filepath)
+        # the tag isn't loaded here, since the dependency frame
+        # reads it in the background without freezing the window.
+        tag_path = self.handler.tagsdir.joinpath(rel_filepath)
+        if not tag_path.is_file():
+            print("Could not load tag:\n    %s" % tag_path)
             return
 
-        self.dependency_frame.handler = handler
+        self.dependency_frame.handler = self.handler
         self.dependency_frame.tags_dir = self.handler.tagsdir
-        self.dependency_frame.root_tag_path = tag.filepath
+        self.dependency_frame.reverse_ref_index = None
+        self.dependency_frame.root_tag_path = str(tag_path)
         self.dependency_frame.root_tag_text = rel_filepath
 
         self.dependency_frame.reload()
 
+    def populate_referencing_tree(self):
+        if self._indexing or self._zipping:
+            return
+
+        rel_filepath = self.get_root_tag_path()
+        if rel_filepath is None:
+            return
+
+        self._indexing = True
+        index_thread = Thread(target=self._populate_referencing_tree,
+                              args=(rel_filepath, ))
+        index_thread.daemon = True
+        index_thread.start()
+
+    def _populate_referencing_tree(self, rel_filepath):
+        try:
+            self.do_populate_referencing_tree(rel_filepath)
+        except Exception:
+            print(format_exc())
+        self._indexing = False
+
+    def do_populate_referencing_tree(self, rel_filepath):
+        handler = self.handler
+        index = self.reverse_ref_index
+        if (index is None or index.handler is not handler or
+                index.tags_dir != str(handler.tagsdir)):
+            if index is not None:
+                index.close()
+            index = self.reverse_ref_index = open_reverse_ref_index(handler)
+            if index is None:
+                return
+
+        # only the tags that changed since the last update are read,
+        # so this is quick once the tags directory has been indexed.
+        print("Updating reverse dependency index...")
+        self.app_root.update_idletasks()
+        if not index.update(lambda: self.stop_zipping):
+            print("Updating reverse dependency index cancelled.")
+            return
+
+        frame = self.dependency_frame
+        frame.handler = handler
+        frame.tags_dir = handler.tagsdir
+        frame.reverse_ref_index = index
+        frame.root_tag_path = str(handler.tagsdir.joinpath(rel_filepath))
+        frame.root_tag_text = rel_filepath
+        frame.reload()
+        print("Showing the tags that reference '%s'" % rel_filepath)
+
+    def closure_report(self):
+        if self._reporting or self._zipping:
+            return
+
+        rel_filepath = self.get_root_tag_path()
+        if rel_filepath is None:
+            return
+
+        self._reporting = True
+        report_thread = Thread(target=self._closure_report,
+                               args=(rel_filepath, ))
+        report_thread.daemon = True
+        report_thread.start()
+
+    def _closure_report(self, rel_filepath):
+        try:
+            self.do_closure_report(rel_filepath)
+        except Exception:
+            print(format_exc())
+        self._reporting = False
+
+    def do_closure_report(self, rel_filepath):
+        handler = self.handler
+        process_count = 1
+        if self.zip_multiprocessed.get():
+            process_count = self.process_count
+
+        print("Finding dependencies of '%s'..." % rel_filepath)
+        start = time()
+        closure = resolve_dependency_closure(
+            handler, (rel_filepath, ), process_count,
+            self.get_loaded_tag, lambda: self.stop_zipping)
+        if not closure.finished:
+            print("Dependency size report cancelled.\n")
+            return
+        elif closure.dependencies[str(rel_filepath)] is None:
+            print("Could not load tag:\n    %s" %
+                  handler.tagsdir.joinpath(rel_filepath))
+            return
+
+        report = build_closure_report(handler, closure)
+        print("\n".join(format_closure_report(report)))
+        print("\nDependency size report completed in %.2f seconds.\n" %
+              (time() - start))
+
     def recursive_zip(self):
-        if self._zipping:
+        if self._zipping or self._reporting:
             return
         try: self.zip_thread.join()
         except Exception: pass
@@ -221,54 +457,112 @@ def do_recursive_zip(self):
         if not tagzip_path:
             return
 
+        old_hashes = None
+        if self.zip_changed_only.get():
+            manifest_path = askopenfilename(
+                initialdir=Path(tagzip_path).parent, parent=self,
+                title="Select the manifest of the previous zipfile",
+                filetypes=(("manifest", "*" + MANIFEST_EXT), ('All', '*')))
+            if not manifest_path:
+                return
+
+            try:
+                old_hashes = load_manifest(manifest_path)
+            except Exception:
+                print(format_exc())
+                print("Could not load manifest:\n    %s" % manifest_path)
+                return
+
         try:
             rel_filepath = tag_path.relative_to(self.handler.tagsdir)
-            tag = self.get_tag(rel_filepath)
         except ValueError:
-            tag = None
+            print("Could not load tag:\n    %s" % tag_path)
+            return
 
-        if tag is None:
+        process_count = 1
+        if self.zip_multiprocessed.get():
+            process_count = self.process_count
+            print("Reading tags using %s processes..." %
+                  (process_count or os.cpu_count() or 1))
+
+        print("Finding dependencies of '%s'..." % rel_filepath)
+        app.update_idletasks()
+        closure = resolve_dependency_closure(
+            handler, (rel_filepath, ), process_count,
+            self.get_loaded_tag, lambda: self.stop_zipping)
+        if not closure.finished:
+            print('Recursive zip operation cancelled.\n')
+            return
+        elif closure.dependencies[str(rel_filepath)] is None:
             print("Could not load tag:\n    %s" % tag_path)
             return
 
+        for filepath in closure.unreadable:
+            print("    Could not load '%s'." % filepath)
+
+        for filepath, _, missing_path in closure.missing_refs:
+            print("    '%s' references missing tag '%s'." %
+                  (filepath, missing_path))
+
+        filepaths = closure.get_sorted_filepaths()
+        print("Hashing %s tags..." % len(filepaths))
+        app.update_idletasks()
+        hashes, errors = hash_files(
+            {get_arcname(filepath): handler.tagsdir.joinpath(filepath)
+             for filepath in filepaths},
+            is_cancelled=lambda: self.stop_zipping)
+        if hashes is None:
+            print('Recursive zip operation cancelled.\n')
+            return
+
+        for filepath, error in errors:
+            print(error)
+            print("    Could not hash '%s'." %
+                  Path(filepath).relative_to(handler.tagsdir))
+
+        if old_hashes is not None:
+            changed, removed = get_changed_names(hashes, old_hashes)
+            for name in removed:
+                print("    '%s' is no longer a dependency." % name)
+
+            print("%s of %s tags changed since the previous manifest." %
+                  (len(changed), len(hashes)))
+            changed = set(changed)
+            filepaths = [filepath for filepath in filepaths
+                         if get_arcname(filepath) in changed]
+
         # make the zipfile to put everything in
         tagzip_path = os.path.splitext(tagzip_path)[0] + ".zip"
 
-        tags_to_zip = [rel_filepath]
-        new_tags_to_zip = []
-        seen_tags = set()
-
-        with zipfile.ZipFile(str(tagzip_path), mode='w') as tagzip:
-            # loop over all the tags and add them to the zipfile
-            while tags_to_zip:
-                for rel_filepath in tags_to_zip:
-                    tag_path = tagpath_to_fullpath(
-                        self.handler.tagsdir, PureWindowsPath(rel_filepath))
-                    if self.stop_zipping:
-                        print('Recursive zip operation cancelled.\n')
-                        return
-
-                    if rel_filepath in seen_tags:
-                        continue
-                    seen_tags.add(rel_filepath)
-
-                    try:
-                        print("Adding '%s' to zipfile" % rel_filepath)
-                        app.update_idletasks()
-                        tag = self.get_tag(rel_filepath)
-                        new_tags_to_zip.extend(self.get_dependencies(tag))
-
-                        # try to conserve memory a bit
-                        del tag
-
-                        tagzip.write(str(tag_path), arcname=str(rel_filepath))
-                    except Exception:
-                        print(format_exc())
-                        print("    Could not add '%s' to zipfile." %
-                              rel_filepath)
-
-                # replace the tags to zip with the newly collected ones
-                tags_to_zip[:] = new_tags_to_zip
-                del new_tags_to_zip[:]
+        # tags are added in sorted order so zipping the
+        # same tags always makes the same zipfile.
+        compression = ZIP_COMPRESSION_NAMES[self.zip_compression.get()]
+        with ParallelZipWriter(str(tagzip_path), compression,
+                               self.zip_compression_level.get()) as tagzip:
+            for filepath in filepaths:
+                if self.stop_zipping:
+                    tagzip.cancel()
+                    print('Recursive zip operation cancelled.\n')
+                    return
+
+                print("Adding '%s' to zipfile" % filepath)
+                app.update_idletasks()
+                tagzip.write(handler.tagsdir.joinpath(filepath),
+                             get_arcname(filepath))
+
+        for filepath, error in tagzip.errors:
+            rel_filepath = Path(filepath).relative_to(handler.tagsdir)
+            print(error)
+            print("    Could not add '%s' to zipfile." % rel_filepath)
+            # leave it out of the manifest so the next patch includes it
+            hashes.pop(get_arcname(rel_filepath), None)
+
+        manifest_path = get_manifest_path(tagzip_path)
+        try:
+            save_manifest(manifest_path, hashes)
+            print("Wrote manifest to:\n    %s" % manifest_path)
+        except Exception:
+            print(format_exc())
+            print("Could not write manifest:\n    %s" % manifest_path)
 
         print("\nRecursive zip completed.\n")
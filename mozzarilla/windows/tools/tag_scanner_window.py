@@ -24,6 +24,12 @@
 from supyr_struct.util import path_normalize, is_in_dir
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tagset.scan_cache import TagScanCache
+from mozzarilla.tagset.scan_report import TextScanReportWriter,\
+     JsonlScanReportWriter
+from mozzarilla.tagset.scan_metrics import ScanMetrics
+from mozzarilla.tagset.tag_scanner import iter_scan_results
+from mozzarilla.tagset.tags_dir_index import locate_tags
 
 
 platform = sys.platform.lower()
@@ -43,6 +49,8 @@ class TagScannerWindow(tk.Toplevel, BinillaWidget):
     _scanning = False
     stop_scanning = False
     print_interval = 5
+    # number of processes to scan with. None means one per cpu.
+    process_count = None
 
     listbox_index_to_def_id = ()
 
@@ -68,6 +76,10 @@ def __init__(self, app_root, *args, **kwargs):
 
         # make the tkinter variables
         self.open_logfile = tk.BooleanVar(self, True)
+        self.scan_multiprocessed = tk.BooleanVar(self, False)
+        self.use_scan_cache = tk.BooleanVar(self, True)
+        self.write_jsonl_log = tk.BooleanVar(self, False)
+        self.write_metrics_json = tk.BooleanVar(self, False)
         self.directory_path = tk.StringVar(self)
         self.logfile_path = tk.StringVar(self)
 
@@ -104,6 +116,31 @@ def __init__(self, app_root, *args, **kwargs):
         self.open_logfile_cbtn = tk.Checkbutton(
             self.logfile_frame, text="Open log when done scanning",
             variable=self.open_logfile)
+        self.scan_multiprocessed_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Scan using multiple processes",
+            variable=self.scan_multiprocessed)
+        self.scan_multiprocessed_cbtn.tooltip_string = (
+            "Splits the tags to scan between one process per cpu core.\n"
+            "Tags open in the editor are scanned as they are in the editor.")
+        self.use_scan_cache_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Only rescan changed tags",
+            variable=self.use_scan_cache)
+        self.use_scan_cache_cbtn.tooltip_string = (
+            "Reuses the results of the last scan for tags\n"
+            "whose files haven't changed since they were scanned.")
+        self.write_jsonl_log_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Also write a JSONL log",
+            variable=self.write_jsonl_log)
+        self.write_jsonl_log_cbtn.tooltip_string = (
+            "Writes every tag's results as one JSON object per line to\n"
+            "a .jsonl file next to the log, for use by other programs.")
+        self.write_metrics_json_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Write scan metrics",
+            variable=self.write_metrics_json)
+        self.write_metrics_json_cbtn.tooltip_string = (
+            "Writes how long each stage of the scan took for each tag type,\n"
+            "along with tags/sec and peak memory usage, to a .metrics.json\n"
+            "file next to the log. A summary is always written in the log.")
 
         self.def_ids_scrollbar = tk.Scrollbar(
             self.def_ids_frame, orient="vertical")
@@ -142,6 +179,10 @@ def __init__(self, app_root, *args, **kwargs):
         self.logfile_frame.pack(fill='x', padx=1)
         self.logfile_dir_frame.pack(fill='x')
         self.open_logfile_cbtn.pack(fill='x', side=tk.LEFT)
+        self.scan_multiprocessed_cbtn.pack(fill='x', side=tk.LEFT)
+        self.use_scan_cache_cbtn.pack(fill='x', side=tk.LEFT)
+        self.write_jsonl_log_cbtn.pack(fill='x', side=tk.LEFT)
+        self.write_metrics_json_cbtn.pack(fill='x', side=tk.LEFT)
         self.def_ids_frame.pack(fill='both', padx=1, expand=True)
 
         self.transient(app_root)
@@ -165,22 +206,16 @@ def select_all(self):
         for i in range(len(self.listbox_index_to_def_id)):
             self.def_ids_listbox.select_set(i)
 
-    def get_tag(self, filepath):
+    def get_loaded_tag(self, filepath):
+        '''
+        Returns the tag if it's already loaded(so tags open in an
+        editor are scanned as they are now), or None otherwise.
+        '''
         handler = self.handler
-        def_id = handler.get_def_id(filepath)
-
         try:
-            tag = handler.get_tag(filepath, def_id)
+            return handler.get_tag(filepath, handler.get_def_id(filepath))
         except (KeyError, LookupError):
-            tag = None
-        try:
-            if tag is None:
-                return handler.build_tag(
-                    filepath=self.handler.tagsdir.joinpath(filepath)
-                    )
-        except Exception:
-            pass
-        return tag
+            return None
 
     def dir_browse(self):
         if self._scanning:
@@ -252,227 +287,148 @@ def scan(self):
             print("Specified directory is not located within the tags directory")
             return
 
-        #this is the string to store the entire debug log
-        log_name = "HEK Tag Scanner log"
-        debuglog = "\n%s%s%s\n\n" % (
-            "-"*30, log_name, "-" * (50-len(log_name)))
-        debuglog += "tags directory = %s\nscan directory = %s\n\n" % (
-            self.handler.tagsdir, dirpath)
-        debuglog += "Broken dependencies are listed below.\n"
-        tag_specific_errors = {}
-
-        get_nodes = handler.get_nodes_by_paths
-        get_tagref_invalid = handler.get_tagref_invalid
-
         s_time = time()
         c_time = s_time
         p_int = self.print_interval
 
-        all_tag_paths = {self.listbox_index_to_def_id[int(i)]: [] for i in
-                         self.def_ids_listbox.curselection()}
-        ext_id_map = handler.ext_id_map
+        def_ids = [self.listbox_index_to_def_id[int(i)] for i in
+                   self.def_ids_listbox.curselection()]
         id_ext_map = handler.id_ext_map
+        is_cancelled = lambda: self.stop_scanning
 
+        metrics = ScanMetrics()
         print("Locating tags...")
+        with metrics.time_stage("locate"):
+            all_tag_paths = locate_tags(
+                handler, dirpath, def_ids, is_cancelled, p_int,
+                self.app_root.update_idletasks)
+        if all_tag_paths is None:
+            print('Tag scanning operation cancelled.\n')
+            return
 
-        for root, directories, files in os.walk(dirpath):
-            root = path_normalize(os.path.join(root, ""))
-
-            rel_root = Path(root).relative_to(self.handler.tagsdir)
-
-            for filename in files:
-                filepath = rel_root.joinpath(filename)
-
-                if time() - c_time > p_int:
-                    c_time = time()
-                    print(' '*4, filepath, sep="")
-                    self.app_root.update_idletasks()
-
-                if self.stop_scanning:
-                    print('Tag scanning operation cancelled.\n')
-                    return
-
-                tag_paths = all_tag_paths.get(
-                    ext_id_map.get(os.path.splitext(filename)[-1].lower()))
-
-                if tag_paths is not None:
-                    tag_paths.append(filepath)
-
-        # make the debug string by scanning the tags directory
-        for def_id in sorted(all_tag_paths.keys()):
-            tag_ref_paths = handler.tag_ref_cache.get(def_id)
-
-            self.app_root.update_idletasks()
-            print("Scanning '%s' tags..." % id_ext_map[def_id][1:])
-            tags_coll = all_tag_paths[def_id]
+        scan_cache = None
+        if self.use_scan_cache.get():
+            try:
+                scan_cache = TagScanCache(handler)
+                scan_cache.remove_missing(
+                    Path(dirpath).relative_to(handler.tagsdir), all_tag_paths)
+            except Exception:
+                print(format_exc())
+                print("Could not load the tag scan cache.")
+                scan_cache = None
+
+        process_count = 1
+        if self.scan_multiprocessed.get():
+            process_count = self.process_count
+            print("Scanning tags using %s processes..." %
+                  (process_count or os.cpu_count() or 1))
+
+        metrics.process_count = process_count or os.cpu_count() or 1
+
+        results = iter_scan_results(
+            handler, all_tag_paths, process_count, scan_cache, is_cancelled,
+            lambda filepath: self.get_loaded_tag(
+                handler.tagsdir.joinpath(filepath)))
+
+        if not logpath:
+            logpath = path_normalize(Path(handler.tagsdir, "tag_scanner.log"))
+        jsonl_logpath = os.path.splitext(logpath)[0] + ".jsonl"
+        metrics_path = os.path.splitext(logpath)[0] + ".metrics.json"
+
+        # the results are written to the logs as they are scanned, so
+        # whatever was scanned is kept even if the scan doesn't finish.
+        report_writers = []
+        try:
+            report_writers.append(
+                TextScanReportWriter(logpath, handler.tagsdir, dirpath))
+        except Exception:
+            print(format_exc())
+            print("Could not create log. Printing log to console instead.\n\n")
+            logpath = None
+            report_writers.append(
+                TextScanReportWriter(sys.stdout, handler.tagsdir, dirpath))
 
-            # always display the first tag's filepath
-            c_time = time() - (p_int + 100)
+        if self.write_jsonl_log.get():
+            try:
+                report_writers.append(JsonlScanReportWriter(
+                    jsonl_logpath, handler.tagsdir, dirpath))
+                print("Writing JSONL log to %s" % jsonl_logpath)
+            except Exception:
+                print(format_exc())
+                print("Could not create JSONL log.")
 
-            for filepath in sorted(tags_coll):
+        finished = False
+        try:
+            curr_def_id = None
+            for result in results:
                 if self.stop_scanning:
-                    print('Tag scanning operation cancelled.\n')
                     break
 
+                filepath = result.filepath
+                if result.def_id != curr_def_id:
+                    curr_def_id = result.def_id
+                    print("Scanning '%s' tags..." %
+                          id_ext_map[curr_def_id][1:])
+                    # always display the first tag's filepath
+                    c_time = time() - (p_int + 100)
+
                 if time() - c_time > p_int:
                     c_time = time()
                     print(' '*4, filepath, sep="")
                     self.app_root.update_idletasks()
 
-                tag = self.get_tag(self.handler.tagsdir.joinpath(filepath))
-                if tag is None:
+                if not result.loaded:
                     print("    Could not load '%s'" % filepath)
-                    continue
-
-                # find tag specific errors
-                self.tag_specific_scan(tag, tag_specific_errors)
-
+                elif result.scan_error:
+                    print(result.scan_error)
+                    print("    Could not scan '%s'" % filepath)
+
+                metrics.add_result(result)
+                with metrics.time_stage("write", result.def_id):
+                    for writer in report_writers:
+                        writer.add_result(result)
+
+            finished = not self.stop_scanning
+        finally:
+            # stops any worker processes if the scan was cancelled
+            results.close()
+            metrics.finish(finished)
+            for writer in report_writers:
                 try:
-                    if tag_ref_paths is None:
-                        # no dependencies for this tag. continue on
-                        continue
-
-                    missed = get_nodes(tag_ref_paths, tag.data,
-                                       get_tagref_invalid)
-
-                    if not missed:
-                        continue
-
-                    debuglog += "\n\n%s\n" % filepath
-                    block_name = None
-
-                    for block in missed:
-                        if block.NAME != block_name:
-                            debuglog += '%s%s\n' % (' '*4, block.NAME)
-                            block_name = block.NAME
-                        try:
-                            ext = '.' + block.tag_class.enum_name
-                        except Exception:
-                            ext = ''
-                        debuglog += '%s%s\n' % (' '*8, block.STEPTREE + ext)
-
+                    writer.close(finished, metrics)
                 except Exception:
                     print(format_exc())
-                    print("    Could not scan '%s'" % tag.filepath)
-                    continue
-
-            if self.stop_scanning:
-                break
 
-        if tag_specific_errors:
-            debuglog += "\nTag specific errors are listed below.\n"
+            if scan_cache is not None:
+                # save even if cancelled so the work done so far isn't lost
+                try:
+                    scan_cache.save()
+                except Exception:
+                    print(format_exc())
+                    print("Could not save the tag scan cache.")
+                scan_cache.close()
 
-        for def_id in sorted(tag_specific_errors.keys()):
-            debuglog += "\n\n%s specific errors:\n%s" % (
-                def_id, tag_specific_errors[def_id])
+        if self.stop_scanning:
+            print('Tag scanning operation cancelled.\n')
 
         print("\nScanning took %s seconds." % int(time() - s_time))
-        print("Writing logfile to %s..." % logpath)
-        self.app_root.update_idletasks()
-
-        # make and write to the logfile
-        try:
-            handler.make_log_file(debuglog, logpath)
+        print(metrics.format_summary())
+        if self.write_metrics_json.get():
             try:
-                print("Scan completed.\n")
-                if self.open_logfile.get():
-                    open_in_default_program(logpath)
-
+                metrics.write_json(metrics_path)
+                print("Scan metrics written to %s" % metrics_path)
             except Exception:
-                print("Could not open written log.")
-            return
-        except Exception:
-            print("Could not create log. Printing log to console instead.\n\n")
-            for line in debuglog.split('\n'):
-                try:
-                    print(line)
-                except Exception:
-                    print("<COULD NOT PRINT THIS LINE>")
+                print(format_exc())
+                print("Could not write scan metrics.")
 
+        if logpath is None:
             print("Scan completed.\n")
+            return
 
-    def tag_specific_scan(self, tag, errors):
-        assert isinstance(errors, dict)
-        cls = tag.def_id
-        err = ""
-
-        if cls == "snd!":
-            bad_ogg = []
-            for pr in tag.data.tagdata.pitch_ranges.STEPTREE:
-                for perm in pr.permutations.STEPTREE:
-                    if perm.compression.enum_name != "ogg":
-                        continue
-                    elif perm.ogg_sample_count == 0 and perm.samples.data:
-                        bad_ogg.append((pr.name, perm.name))
-
-            if bad_ogg:
-                err += ("    Bad PCM buffer size. " +
-                        "Fix by recompiling this sound.")
-        elif cls == "coll":
-            bad_nodes = {}
-            tagdata = tag.data.tagdata
-            nodes = tagdata.nodes.STEPTREE
-            mat_ct = len(tagdata.materials.STEPTREE)
-            highest_mat_num = lowest_mat_num = 0
-
-            for i in range(len(nodes)):
-                node = nodes[i]
-                bad_bsps = {}
-                for j in range(len(node.bsps.STEPTREE)):
-                    bsp = node.bsps.STEPTREE[j]
-                    bad_surfaces = []
-                    for k in range(len(bsp.surfaces.STEPTREE)):
-                        mat = bsp.surfaces.STEPTREE[k].material
-                        if mat > -1 and mat < mat_ct:
-                            continue
-
-                        highest_mat_num = max(highest_mat_num, mat)
-                        lowest_mat_num  = min(lowest_mat_num, mat)
-                        bad_surfaces.append(k)
-
-                    if bad_surfaces:
-                        bad_bsps[j] = bad_surfaces
-
-                if bad_bsps:
-                    bad_nodes[i] = bad_bsps
-
-            if bad_nodes:
-                err += "    Bad collision material numbers.\n"
-                if lowest_mat_num > -1:
-                    # none of the material numbers are below zero, so
-                    # it's possible to fix this by adding more materials.
-                    err += (("    Change the material numbers of these " +
-                             "surfaces to be <= %s or add %s materials.\n")
-                            % (mat_ct - 1, (highest_mat_num + 1) - mat_ct))
-                else:
-                    err += (("    Change the material numbers of these " +
-                             "surfaces to be >= 0 and <= %s\n") % (mat_ct - 1))
-
-                for i in sorted(bad_nodes.keys()):
-                    bad_bsps = bad_nodes[i]
-                    err += "    %s(node #%s)\n" % (nodes[i].name, i)
-                    for j in sorted(bad_bsps.keys()):
-                        bad_surfaces = bad_bsps[j]
-                        err += "        bsp #%s\n" % j
-                        err += "            surfaces = %s\n" % bad_surfaces
-                    err += "\n"
-                err = err[:-1]
-
-        elif cls == "effe":
-            i = 0
-            events = tag.data.tagdata.events.STEPTREE
-            for i in range(len(events)):
-                # tool exceptions if any parts reference a damage effect
-                # tag type, but have an empty filepath for the reference
-                parts = events[i].parts.STEPTREE
-                for j in range(len(parts)):
-                    part = parts[j]
-                    if (part.type.tag_class.enum_name == "damage_effect" and
-                        not part.type.filepath):
-                        err += ("     Missing filepath in damage_effect "
-                                "reference in part %s of event %s\n." % (j, i))
-
-        if err:
-            rel_tag_path = str(tag.filepath.relative_to(self.handler.tagsdir))
-            errors[cls] = "%s\n%s\n%s\n" % (
-                errors.get(cls, ""), rel_tag_path, err)
+        print("Log written to %s" % logpath)
+        print("Scan completed.\n")
+        try:
+            if self.open_logfile.get():
+                open_in_default_program(logpath)
+        except Exception:
+            print("Could not open written log.")
@@ -40,6 +40,7 @@
     packages=[
         'mozzarilla',
         'mozzarilla.defs',
+        'mozzarilla.tagset',
         'mozzarilla.widgets',
         'mozzarilla.widgets.field_widgets',
         'mozzarilla.windows',